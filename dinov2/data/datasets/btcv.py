@@ -59,6 +59,7 @@ class BTCV(MedicalVisionDataset):
                                            "rad", "lad"],
                                     columns=["class_id"])
         self.class_names = np.array(self.class_id_mapping.index)
+        self._affine_matrices = {}
 
     def _check_size(self):
         num_of_images = len(os.listdir(self._split_dir + os.sep + "img"))
@@ -70,6 +71,14 @@ class BTCV(MedicalVisionDataset):
     def is_3d(self) -> bool:
         return True
 
+    def get_affine_matrix(self, index: int) -> np.ndarray:
+        # only the header is read, the affine of each volume is cached
+        if index not in self._affine_matrices:
+            image_folder_path = self._image_path + os.sep + self.images[index]
+            image_path = image_folder_path + os.sep + os.listdir(image_folder_path)[0]
+            self._affine_matrices[index] = nib.load(image_path).affine
+        return self._affine_matrices[index]
+
     def get_image_data(self, index: int, seed: int = 0, return_affine_matrix=False) -> np.ndarray:
         image_folder_path = self._image_path + os.sep + self.images[index]
         image_path = image_folder_path + os.sep + os.listdir(image_folder_path)[0]  
@@ -4,7 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from typing import Sequence
+from typing import Optional, Sequence
 
 import numpy as np
 import torch
@@ -152,20 +152,24 @@ def make_segmentation_train_transforms(
 
 def make_segmentation_eval_transforms(
     *,
-    resize_size: int = 448,
+    resize_size: Optional[int] = 448,
     interpolation=transforms.InterpolationMode.BICUBIC,
     mean: Sequence[float] = IMAGENET_DEFAULT_MEAN,
     std: Sequence[float] = IMAGENET_DEFAULT_STD,
 ) -> transforms.Compose:
+    # resize_size=None keeps the original resolution (tiled inference)
     train_transforms_list = [
-        transforms.Resize((resize_size, resize_size), interpolation=interpolation),
         MaybeToTensor(),
         RescaleImage(),
         make_normalize_transform(mean=mean, std=std)
     ]
     target_transform_list = [
-        transforms.Resize((resize_size, resize_size), interpolation=transforms.InterpolationMode.NEAREST_EXACT),
         MaybeToTensor(),
     ] 
+    if resize_size is not None:
+        train_transforms_list.insert(0, transforms.Resize((resize_size, resize_size), interpolation=interpolation))
+        target_transform_list.insert(
+            0, transforms.Resize((resize_size, resize_size), interpolation=transforms.InterpolationMode.NEAREST_EXACT)
+        )
     return (transforms.Compose(train_transforms_list),
             transforms.Compose(target_transform_list))
\ No newline at end of file
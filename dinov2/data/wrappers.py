@@ -33,4 +33,22 @@ class SystemicSamplerWrapper(torch.utils.data.Subset):
         return self.subset.__getitem__(index)
 
     def __len__(self):
-        return self.subset.__len__()
\ No newline at end of file
+        return self.subset.__len__()
+
+
+class HoldoutSplitWrapper(torch.utils.data.Subset):
+    """
+    Deterministic holdout split of a dataset: `holdout=True` keeps `holdout_fraction` of the samples,
+    `holdout=False` keeps the rest. Attributes of the wrapped dataset (split, class_names, ...) stay accessible.
+    """
+    def __init__(self, dataset, holdout_fraction=0.2, holdout=True, seed=0):
+        dataset_len = dataset.__len__()
+        permutation = np.random.default_rng(seed).permutation(dataset_len)
+        n_holdout = max(int(round(dataset_len * holdout_fraction)), 1)
+        indices = np.sort(permutation[:n_holdout] if holdout else permutation[n_holdout:])
+        super().__init__(dataset, indices.tolist())
+
+    def __getattr__(self, name):
+        if name in ("dataset", "indices"):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
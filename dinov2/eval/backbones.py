@@ -0,0 +1,125 @@
+import importlib
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+
+logger = logging.getLogger("dinov2")
+
+
+@dataclass(frozen=True)
+class BackboneSpec:
+    """
+    What an eval backbone provides, known without building it (or importing its dependencies):
+        - embed_dim / patch_size: None when they depend on the model config (DINOv2) or do not apply (CNNs),
+        - num_layers: number of blocks that `get_intermediate_layers` can tap, None if only the final output,
+        - patch_tokens: whether `forward_features` returns patch tokens (dense tasks such as segmentation),
+        - requires: third-party packages imported when the backbone is built.
+    """
+
+    name: str
+    wrapper: str  # "module:class" of the wrapper, imported when the backbone is built
+    embed_dim: Optional[int] = None
+    patch_size: Optional[int] = None
+    num_layers: Optional[int] = None
+    patch_tokens: bool = False
+    requires: Tuple[str, ...] = ()
+
+    @property
+    def layer_taps(self) -> Tuple[int, ...]:
+        return tuple(range(self.num_layers)) if self.num_layers is not None else ()
+
+
+_BACKBONES: Dict[str, BackboneSpec] = {}
+
+DINOV2_BACKBONE = "dinov2"
+
+
+def register_backbone(spec: BackboneSpec) -> BackboneSpec:
+    assert spec.name not in _BACKBONES, f"Backbone {spec.name} is already registered"
+    _BACKBONES[spec.name] = spec
+    return spec
+
+
+def get_backbone_spec(name: str) -> BackboneSpec:
+    """Capabilities of the backbone `name`, unknown names are DINOv2 models (built from the config)"""
+    return _BACKBONES.get(name, _BACKBONES[DINOV2_BACKBONE])
+
+
+def list_backbones():
+    return sorted(_BACKBONES)
+
+
+def build_backbone(name: str):
+    """Instantiates the wrapper of a registered third-party backbone"""
+    spec = get_backbone_spec(name)
+    assert spec.name != DINOV2_BACKBONE, "DINOv2 backbones are built from the model config"
+    module_name, class_name = spec.wrapper.split(":")
+    model = getattr(importlib.import_module(module_name), class_name)()
+    logger.info(f"Using {spec.name} backbone")
+    return model
+
+
+register_backbone(BackboneSpec(DINOV2_BACKBONE, wrapper="", num_layers=None, patch_tokens=True))
+register_backbone(
+    BackboneSpec(
+        "vit-large-imagenet21k",
+        wrapper="dinov2.eval.utils:ViTLargeImagenet21k",
+        embed_dim=1024,
+        patch_size=16,
+        num_layers=24,
+        patch_tokens=True,
+        requires=("transformers",),
+    )
+)
+register_backbone(
+    BackboneSpec(
+        "mae-large-imagenet1k",
+        wrapper="dinov2.eval.utils:MAEViTLargeImagenet1k",
+        embed_dim=1024,
+        patch_size=16,
+        num_layers=24,
+        patch_tokens=True,
+        requires=("transformers",),
+    )
+)
+register_backbone(
+    BackboneSpec(
+        "msn-large-imagenet1k",
+        wrapper="dinov2.eval.utils:ViTLargeMSN",
+        embed_dim=1024,
+        patch_size=16,
+        num_layers=24,
+        patch_tokens=True,
+        requires=("transformers",),
+    )
+)
+register_backbone(
+    BackboneSpec(
+        "clip-large",
+        wrapper="dinov2.eval.utils:CLIPLarge",
+        embed_dim=1024,
+        patch_size=14,
+        num_layers=24,
+        patch_tokens=True,
+        requires=("transformers",),
+    )
+)
+register_backbone(
+    BackboneSpec(
+        "openclip-huge",
+        wrapper="dinov2.eval.utils:OpenCLIPHuge",
+        embed_dim=1280,
+        patch_size=14,
+        num_layers=32,
+        patch_tokens=True,
+        requires=("transformers",),
+    )
+)
+register_backbone(
+    BackboneSpec("biomedclip-base", wrapper="dinov2.eval.utils:BiomedCLIPBase", embed_dim=512, requires=("open_clip",))
+)
+register_backbone(BackboneSpec("sam-large", wrapper="dinov2.eval.utils:SAMLarge", embed_dim=1024, requires=("transformers",)))
+register_backbone(BackboneSpec("resnet-152-imagenet1k", wrapper="dinov2.eval.utils:ResNet152ImageNet1k", embed_dim=2048))
+register_backbone(BackboneSpec("densenet-201-imagenet1k", wrapper="dinov2.eval.utils:DenseNet201ImageNet1k", embed_dim=1920))
+register_backbone(BackboneSpec("vgg-19-imagenet1k", wrapper="dinov2.eval.utils:VGG19ImageNet1k", embed_dim=4096))
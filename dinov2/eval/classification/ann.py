@@ -0,0 +1,239 @@
+import logging
+import time
+
+import torch
+from torch import nn
+
+
+logger = logging.getLogger("dinov2")
+
+
+def merge_topk(topk_sims, topk_indices, sims, indices, k):
+    """
+    Merges a new block of candidates into a running top-k (both sorted, largest first).
+    `topk_sims` / `topk_indices` may be None for the first block.
+    """
+    if topk_sims is not None:
+        sims = torch.cat([topk_sims, sims], dim=1)
+        indices = torch.cat([topk_indices, indices], dim=1)
+    k = min(k, sims.shape[1])
+    topk_sims, positions = sims.topk(k, dim=1, largest=True, sorted=True)
+    return topk_sims, torch.gather(indices, 1, positions)
+
+
+def kmeans(x, n_clusters, n_iter=10, spherical=False, chunk_size=65536, seed=0):
+    """
+    Lloyd k-means in torch. With `spherical=True`, the centroids are L2-normalized and points are assigned
+    by inner product (cosine k-means), otherwise by euclidean distance.
+    """
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    n = x.shape[0]
+    centroids = x[torch.randperm(n, generator=generator)[:n_clusters].to(x.device)].clone()
+    if n < n_clusters:  # not enough points, duplicate some of them
+        extra = torch.randint(0, n, (n_clusters - n,), generator=generator).to(x.device)
+        centroids = torch.cat([centroids, x[extra]])
+
+    for _ in range(n_iter):
+        assignments = kmeans_assign(x, centroids, spherical=spherical, chunk_size=chunk_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength=n_clusters).to(x.dtype)
+        empty = counts == 0
+        if empty.any():  # re-seed empty clusters with random points
+            reseed = torch.randint(0, n, (int(empty.sum()),), generator=generator).to(x.device)
+            sums[empty] = x[reseed]
+            counts[empty] = 1
+        centroids = sums / counts.unsqueeze(1)
+        if spherical:
+            centroids = nn.functional.normalize(centroids, dim=1, p=2)
+    return centroids
+
+
+def kmeans_assign(x, centroids, spherical=False, chunk_size=65536):
+    assignments = torch.empty(x.shape[0], dtype=torch.long, device=x.device)
+    half_norms = None if spherical else 0.5 * (centroids * centroids).sum(dim=1)
+    for start in range(0, x.shape[0], chunk_size):
+        scores = torch.mm(x[start : start + chunk_size], centroids.T)
+        if half_norms is not None:  # argmin ||x - c||^2 == argmax <x, c> - ||c||^2 / 2
+            scores -= half_norms
+        assignments[start : start + chunk_size] = scores.argmax(dim=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate inner-product index for k-NN on L2-normalized features, in pure torch (CPU).
+
+    The train vectors are partitioned with a coarse (cosine) k-means into `n_lists` inverted lists, and a
+    query only scans the `nprobe` lists whose centroids are closest to it. Vectors in the lists are stored:
+        - "none": as float32,
+        - "int8": with per-dimension symmetric int8 scalar quantization (4x smaller),
+        - "pq": as product-quantized residuals to their coarse centroid, `pq_m` bytes per vector,
+          scanned with asymmetric distance lookup tables.
+    """
+
+    QUANTIZATIONS = ("none", "int8", "pq")
+
+    def __init__(
+        self,
+        n_lists=1024,
+        nprobe=16,
+        quantization="none",
+        pq_m=16,
+        pq_bits=8,
+        kmeans_iter=10,
+        max_train_points_per_list=256,
+        query_batch_size=1024,
+        seed=0,
+    ):
+        assert quantization in self.QUANTIZATIONS, f"Unknown quantization {quantization}"
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.quantization = quantization
+        self.pq_m = pq_m
+        self.pq_bits = pq_bits
+        self.kmeans_iter = kmeans_iter
+        self.max_train_points_per_list = max_train_points_per_list
+        self.query_batch_size = query_batch_size
+        self.seed = seed
+        self.is_trained = False
+        self.ntotal = 0
+
+    def train(self, x):
+        x = x.float().cpu()
+        n_lists = min(self.n_lists, x.shape[0])
+        max_train_points = self.max_train_points_per_list * n_lists
+        if x.shape[0] > max_train_points:
+            generator = torch.Generator().manual_seed(self.seed)
+            x = x[torch.randperm(x.shape[0], generator=generator)[:max_train_points]]
+
+        self.centroids = kmeans(x, n_lists, n_iter=self.kmeans_iter, spherical=True, seed=self.seed)
+        self.n_lists = n_lists
+
+        if self.quantization == "pq":
+            assert x.shape[1] % self.pq_m == 0, f"Feature dim {x.shape[1]} is not divisible by pq_m={self.pq_m}"
+            residuals = x - self.centroids[kmeans_assign(x, self.centroids, spherical=True)]
+            sub_residuals = residuals.view(x.shape[0], self.pq_m, -1)
+            self.pq_codebooks = torch.stack(
+                [
+                    kmeans(sub_residuals[:, j].contiguous(), 2**self.pq_bits, n_iter=self.kmeans_iter, seed=self.seed + j)
+                    for j in range(self.pq_m)
+                ]
+            )  # [pq_m, 2 ** pq_bits, dim // pq_m]
+        self.is_trained = True
+        return self
+
+    def add(self, x):
+        assert self.is_trained, "The index needs to be trained before adding vectors"
+        assert self.ntotal == 0, "Vectors can only be added once"
+        x = x.float().cpu()
+        assignments = kmeans_assign(x, self.centroids, spherical=True)
+        order = torch.argsort(assignments, stable=True)
+        counts = torch.bincount(assignments, minlength=self.n_lists)
+        self.list_offsets = torch.zeros(self.n_lists + 1, dtype=torch.long)
+        self.list_offsets[1:] = torch.cumsum(counts, dim=0)
+        self.ids = order
+        x, assignments = x[order], assignments[order]
+
+        if self.quantization == "none":
+            self.codes = x
+        elif self.quantization == "int8":
+            self.int8_scale = x.abs().amax(dim=0).clamp(min=1e-12) / 127.0
+            self.codes = torch.round(x / self.int8_scale).clamp(-127, 127).to(torch.int8)
+        else:
+            sub_residuals = (x - self.centroids[assignments]).view(x.shape[0], self.pq_m, -1)
+            self.codes = torch.stack(
+                [kmeans_assign(sub_residuals[:, j].contiguous(), self.pq_codebooks[j]) for j in range(self.pq_m)],
+                dim=1,
+            ).to(torch.uint8 if self.pq_bits <= 8 else torch.int16)
+        self.ntotal = x.shape[0]
+        return self
+
+    def memory_bytes(self):
+        return self.codes.numel() * self.codes.element_size() + self.ids.numel() * self.ids.element_size()
+
+    def _scan_list(self, queries, list_index):
+        start, end = self.list_offsets[list_index].item(), self.list_offsets[list_index + 1].item()
+        codes = self.codes[start:end]
+        if self.quantization == "none":
+            sims = torch.mm(queries, codes.T)
+        elif self.quantization == "int8":
+            sims = torch.mm(queries * self.int8_scale, codes.float().T)
+        else:
+            # <q, c + r> = <q, c> + sum_j <q_j, codebook_j[code_j]>
+            sub_queries = queries.view(queries.shape[0], self.pq_m, -1)
+            tables = torch.einsum("bmd,mcd->bmc", sub_queries, self.pq_codebooks)  # [B, pq_m, 2 ** pq_bits]
+            flat_codes = codes.long() + torch.arange(self.pq_m).unsqueeze(0) * tables.shape[2]
+            sims = tables.flatten(1).index_select(1, flat_codes.flatten())
+            sims = sims.view(queries.shape[0], -1, self.pq_m).sum(dim=2)
+            sims += torch.mv(queries, self.centroids[list_index]).unsqueeze(1)
+        return sims, self.ids[start:end]
+
+    @torch.no_grad()
+    def search(self, queries, k):
+        """Returns the (approximate) top-k inner products and train indices, both [num_queries, k]"""
+        device = queries.device
+        queries = queries.float().cpu()
+        nprobe = min(self.nprobe, self.n_lists)
+        all_sims = torch.full((queries.shape[0], k), -float("inf"))
+        all_indices = torch.full((queries.shape[0], k), -1, dtype=torch.long)
+
+        for start in range(0, queries.shape[0], self.query_batch_size):
+            batch = queries[start : start + self.query_batch_size]
+            probes = torch.mm(batch, self.centroids.T).topk(nprobe, dim=1).indices  # [B, nprobe]
+            topk_sims = all_sims[start : start + batch.shape[0]]
+            topk_indices = all_indices[start : start + batch.shape[0]]
+            # scan every probed list once, for all the queries of the batch probing it
+            for list_index in torch.unique(probes).tolist():
+                query_indices = (probes == list_index).any(dim=1).nonzero().squeeze(1)
+                sims, ids = self._scan_list(batch[query_indices], list_index)
+                if sims.shape[1] == 0:
+                    continue
+                merged_sims, merged_indices = merge_topk(
+                    topk_sims[query_indices], topk_indices[query_indices], sims, ids.expand(len(query_indices), -1), k
+                )
+                topk_sims[query_indices] = merged_sims
+                topk_indices[query_indices] = merged_indices
+        return all_sims.to(device), all_indices.to(device)
+
+
+def build_ivf_index(train_features, **kwargs):
+    start = time.time()
+    index = IVFIndex(**kwargs).train(train_features).add(train_features)
+    logger.info(
+        f"IVF index built in {time.time() - start:.1f}s: {index.ntotal} vectors, {index.n_lists} lists, "
+        f"quantization={index.quantization}, {index.memory_bytes() / 2 ** 20:.1f} MiB"
+    )
+    return index
+
+
+@torch.no_grad()
+def compute_recall(index, train_features, queries, k=10, batch_size=1024, max_queries=1000):
+    """Recall@k of the approximate index against exact brute-force inner-product search"""
+    train_features = train_features.float().cpu()
+    queries = queries[:max_queries].float().cpu()
+
+    start = time.time()
+    _, approximate_indices = index.search(queries, k)
+    approximate_time = time.time() - start
+
+    start = time.time()
+    found = 0
+    for i in range(0, queries.shape[0], batch_size):
+        exact_indices = torch.mm(queries[i : i + batch_size], train_features.T).topk(k, dim=1).indices
+        matches = exact_indices.unsqueeze(2) == approximate_indices[i : i + batch_size].unsqueeze(1)
+        found += matches.any(dim=2).sum().item()
+    exact_time = time.time() - start
+
+    recall = found / (queries.shape[0] * k)
+    logger.info(
+        f"IVF recall@{k}: {recall:.4f} (nprobe={index.nprobe}), "
+        f"search {approximate_time:.2f}s vs exact {exact_time:.2f}s"
+    )
+    return {"recall": recall, "search_time": approximate_time, "exact_time": exact_time}
+
+
+def make_ann_kwargs(args):
+    """Index options from the --ann-* command line arguments, None for exact search"""
+    if not args.ann_lists:
+        return None
+    return dict(n_lists=args.ann_lists, nprobe=args.ann_nprobe, quantization=args.ann_quantization)
@@ -18,6 +18,7 @@ from torch.nn.functional import one_hot, softmax
 import dinov2.distributed as distributed
 from dinov2.data import SamplerType, make_data_loader, make_dataset
 from dinov2.data.transforms import make_classification_eval_transform
+from dinov2.eval.classification.ann import IVFIndex, build_ivf_index, compute_recall, make_ann_kwargs, merge_topk
 from dinov2.eval.metrics import MetricAveraging, build_topk_accuracy_metric
 from dinov2.eval.setup import get_args_parser as get_setup_args_parser
 from dinov2.eval.setup import setup_and_build_model
@@ -84,6 +85,39 @@ def get_args_parser(
         type=int,
         help="Number of tries",
     )
+    parser.add_argument(
+        "--ann-lists",
+        type=int,
+        help="Number of inverted lists of the approximate nearest-neighbor index, 0 for exact search",
+    )
+    parser.add_argument(
+        "--ann-nprobe",
+        type=int,
+        help="Number of inverted lists scanned per query by the approximate index",
+    )
+    parser.add_argument(
+        "--ann-quantization",
+        type=str,
+        choices=list(IVFIndex.QUANTIZATIONS),
+        help="How vectors are stored in the approximate index",
+    )
+    parser.add_argument(
+        "--knn-chunk-size",
+        type=int,
+        help="Number of train features compared with a batch of test features at a time, 0 for all of them",
+    )
+    parser.add_argument(
+        "--train-features-dtype",
+        type=str,
+        choices=list(KnnModule.TRAIN_DTYPES),
+        help="Storage type of the train features for the k-NN search",
+    )
+    parser.add_argument(
+        "--knn-device",
+        type=str,
+        choices=["cuda", "cpu"],
+        help="Device of the k-NN search, on cpu each process searches the whole train set using all its cores",
+    )
     parser.set_defaults(
         train_dataset_str="ImageNet:split=TRAIN",
         val_dataset_str="ImageNet:split=VAL",
@@ -92,6 +126,12 @@ def get_args_parser(
         batch_size=16,
         n_per_class_list=[-1],
         n_tries=1,
+        ann_lists=0,
+        ann_nprobe=16,
+        ann_quantization="none",
+        knn_chunk_size=65536,
+        train_features_dtype="float32",
+        knn_device="cuda",
     )
     return parser
 
@@ -104,28 +144,101 @@ class KnnModule(torch.nn.Module):
     In `compute_neighbors`, for each rank one after the other, its chunk of test features
     is sent to all devices, partial knns are computed with each chunk of train features
     then collated back on the original device.
+
+    The similarities are computed against tiles of `train_chunk_size` train features at a time,
+    merged into a running top-k, so that memory does not grow with the train set size. Train
+    features can be stored in float16 or int8 (per-dimension symmetric scale) with `train_dtype`.
+    On a CPU `device`, or without torch.distributed, each process searches the whole train set
+    locally without any communication.
+
+    With `ann_kwargs`, each rank searches its chunk with an approximate IVF index (on CPU)
+    instead of the brute-force similarity matrix.
     """
 
-    def __init__(self, train_features, train_labels, nb_knn, T, device, num_classes=1000):
+    TRAIN_DTYPES = ("float32", "float16", "int8")
+
+    def __init__(
+        self,
+        train_features,
+        train_labels,
+        nb_knn,
+        T,
+        device,
+        num_classes=1000,
+        ann_kwargs=None,
+        train_chunk_size=65536,
+        train_dtype="float32",
+    ):
         super().__init__()
+        assert train_dtype in self.TRAIN_DTYPES, f"Unknown train features dtype {train_dtype}"
 
-        self.global_rank = distributed.get_global_rank()
-        self.global_size = distributed.get_global_size()
+        self.device = torch.device(device)
+        self.local = self.device.type == "cpu" or not distributed.is_enabled()
+        self.global_rank = 0 if self.local else distributed.get_global_rank()
+        self.global_size = 1 if self.local else distributed.get_global_size()
 
-        self.device = device
-        self.train_features_rank_T = train_features.chunk(self.global_size)[self.global_rank].T.to(self.device)
+        train_features_rank = train_features.chunk(self.global_size)[self.global_rank].to(self.device)
         self.candidates = train_labels.chunk(self.global_size)[self.global_rank].view(1, -1).to(self.device)
 
+        self.train_dtype = train_dtype
+        self.train_chunk_size = train_chunk_size or train_features_rank.shape[0]
+        if train_dtype == "int8":
+            self.int8_scale = train_features_rank.abs().amax(dim=0).clamp(min=1e-12) / 127.0
+            train_features_rank = torch.round(train_features_rank / self.int8_scale).clamp(-127, 127)
+            train_features_rank = train_features_rank.to(torch.int8)
+        elif train_dtype == "float16":
+            train_features_rank = train_features_rank.half()
+        self.train_features_rank_T = train_features_rank.T
+
         self.nb_knn = nb_knn
         self.max_k = max(self.nb_knn)
         self.T = T
         self.num_classes = num_classes
 
+        self.index = None
+        if ann_kwargs is not None:
+            self.index = build_ivf_index(self._dequantized_train_features(), **ann_kwargs)
+            self.recall_reported = False
+
+    def _dequantized_train_features(self):
+        train_features = self.train_features_rank_T.T.float()
+        if self.train_dtype == "int8":
+            train_features = train_features * self.int8_scale
+        return train_features
+
     def _get_knn_sims_and_labels(self, similarity, train_labels):
         topk_sims, indices = similarity.topk(self.max_k, largest=True, sorted=True)
         neighbors_labels = torch.gather(train_labels, 1, indices)
         return topk_sims, neighbors_labels
 
+    def _tile_similarity(self, queries, start, end):
+        tile = self.train_features_rank_T[:, start:end]
+        if self.train_dtype == "int8":
+            return torch.mm(queries * self.int8_scale.to(queries.dtype), tile.to(queries.dtype))
+        if tile.dtype != queries.dtype and tile.is_cuda:
+            return torch.mm(queries.to(tile.dtype), tile).to(queries.dtype)
+        return torch.mm(queries, tile.to(queries.dtype))
+
+    def _search(self, queries):
+        if self.index is not None:
+            if not self.recall_reported:
+                compute_recall(self.index, self._dequantized_train_features(), queries, k=self.max_k)
+                self.recall_reported = True
+            topk_sims, indices = self.index.search(queries, self.max_k)
+            neighbors_labels = self.candidates[0][indices.clamp(min=0)]  # lists with less than k candidates
+            return topk_sims.to(queries.dtype), neighbors_labels
+
+        # Compute the neighbors among `train_features_rank_T`, one tile of train features at a time
+        topk_sims = neighbors_labels = None
+        for start in range(0, self.train_features_rank_T.shape[1], self.train_chunk_size):
+            end = start + self.train_chunk_size
+            similarity_tile = self._tile_similarity(queries, start, end)
+            candidate_labels = self.candidates[:, start:end].expand(len(similarity_tile), -1)
+            topk_sims, neighbors_labels = merge_topk(
+                topk_sims, neighbors_labels, similarity_tile, candidate_labels, self.max_k
+            )
+        return topk_sims, neighbors_labels
+
     def _similarity_for_rank(self, features_rank, source_rank):
         # Send the features from `source_rank` to all ranks
         broadcast_shape = torch.tensor(features_rank.shape).to(self.device)
@@ -137,9 +250,7 @@ class KnnModule(torch.nn.Module):
         torch.distributed.broadcast(broadcasted, source_rank)
 
         # Compute the neighbors for `source_rank` among `train_features_rank_T`
-        similarity_rank = torch.mm(broadcasted, self.train_features_rank_T)
-        candidate_labels = self.candidates.expand(len(similarity_rank), -1)
-        return self._get_knn_sims_and_labels(similarity_rank, candidate_labels)
+        return self._search(broadcasted)
 
     def _gather_all_knn_for_rank(self, topk_sims, neighbors_labels, target_rank):
         # Gather all neighbors for `target_rank`
@@ -160,6 +271,8 @@ class KnnModule(torch.nn.Module):
         return None
 
     def compute_neighbors(self, features_rank):
+        if self.local:
+            return self._search(features_rank.to(self.device))
         for rank in range(self.global_size):
             topk_sims, neighbors_labels = self._similarity_for_rank(features_rank, rank)
             results = self._gather_all_knn_for_rank(topk_sims, neighbors_labels, rank)
@@ -180,7 +293,7 @@ class KnnModule(torch.nn.Module):
             one_hot(neighbors_labels, num_classes=self.num_classes),
             topk_sims_transform.view(batch_size, -1, 1),
         )
-        probas_for_k = {k: torch.sum(matmul[:, :k, :], 1) for k in self.nb_knn}
+        probas_for_k = {k: torch.sum(matmul[:, :k, :], 1).to(features_rank.device) for k in self.nb_knn}
         return probas_for_k
 
 
@@ -254,8 +367,15 @@ def eval_knn(
     gather_on_cpu,
     n_per_class_list=[-1],
     n_tries=1,
+    ann_kwargs=None,
+    knn_chunk_size=65536,
+    train_features_dtype="float32",
+    knn_device="cuda",
 ):
     model = ModelWithNormalize(model)
+    if knn_device == "cpu":
+        gather_on_cpu = True
+        torch.set_num_threads(max(1, os.cpu_count() // distributed.get_local_size()))
 
     logger.info("Extracting features for train set...")
     train_features, train_labels = extract_features(
@@ -272,11 +392,55 @@ def eval_knn(
         shuffle=False,
         persistent_workers=True,
     )
+    return eval_knn_on_features(
+        feature_model=model,
+        train_features=train_features,
+        train_labels=train_labels,
+        val_dataloader=val_dataloader,
+        accuracy_averaging=accuracy_averaging,
+        nb_knn=nb_knn,
+        temperature=temperature,
+        n_per_class_list=n_per_class_list,
+        n_tries=n_tries,
+        ann_kwargs=ann_kwargs,
+        knn_chunk_size=knn_chunk_size,
+        train_features_dtype=train_features_dtype,
+        knn_device=knn_device,
+    )
+
+
+def eval_knn_on_features(
+    feature_model,
+    train_features,
+    train_labels,
+    val_dataloader,
+    accuracy_averaging,
+    nb_knn,
+    temperature,
+    n_per_class_list=[-1],
+    n_tries=1,
+    ann_kwargs=None,
+    knn_chunk_size=65536,
+    train_features_dtype="float32",
+    knn_device="cuda",
+):
+    """
+    k-NN classification of the samples of `val_dataloader` against already extracted train features.
+    `feature_model` maps the batches of the loader to normalized features, None if they are features already.
+    """
     num_classes = train_labels.max() + 1
     metric_collection = build_topk_accuracy_metric(accuracy_averaging, num_classes=num_classes)
 
     device = torch.cuda.current_device()
-    partial_module = partial(KnnModule, T=temperature, device=device, num_classes=num_classes)
+    partial_module = partial(
+        KnnModule,
+        T=temperature,
+        device="cpu" if knn_device == "cpu" else device,
+        num_classes=num_classes,
+        ann_kwargs=ann_kwargs,
+        train_chunk_size=knn_chunk_size,
+        train_dtype=train_features_dtype,
+    )
     knn_module_dict = create_module_dict(
         module=partial_module,
         n_per_class_list=n_per_class_list,
@@ -293,7 +457,9 @@ def eval_knn(
                 **{(n_per_class, t, k): DictKeysModule([n_per_class, t, k]) for k in knn_try.nb_knn},
             }
             metrics = {**metrics, **{(n_per_class, t, k): metric_collection.clone() for k in knn_try.nb_knn}}
-    model_with_knn = torch.nn.Sequential(model, knn_module_dict)
+    model_with_knn = knn_module_dict
+    if feature_model is not None:
+        model_with_knn = torch.nn.Sequential(feature_model, knn_module_dict)
 
     # ============ evaluation ... ============
     logger.info("Start the k-NN classification.")
@@ -330,6 +496,10 @@ def eval_knn_with_model(
     num_workers=5,
     n_per_class_list=[-1],
     n_tries=1,
+    ann_kwargs=None,
+    knn_chunk_size=65536,
+    train_features_dtype="float32",
+    knn_device="cuda",
 ):
     transform = transform or make_classification_eval_transform()
 
@@ -355,6 +525,10 @@ def eval_knn_with_model(
             gather_on_cpu=gather_on_cpu,
             n_per_class_list=n_per_class_list,
             n_tries=n_tries,
+            ann_kwargs=ann_kwargs,
+            knn_chunk_size=knn_chunk_size,
+            train_features_dtype=train_features_dtype,
+            knn_device=knn_device,
         )
 
     results_dict = {}
@@ -393,6 +567,10 @@ def main(args):
         num_workers=2,
         n_per_class_list=args.n_per_class_list,
         n_tries=args.n_tries,
+        ann_kwargs=make_ann_kwargs(args),
+        knn_chunk_size=args.knn_chunk_size,
+        train_features_dtype=args.train_features_dtype,
+        knn_device=args.knn_device,
     )
     return 0
 
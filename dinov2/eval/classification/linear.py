@@ -26,19 +26,19 @@ from fvcore.common.checkpoint import Checkpointer, PeriodicCheckpointer
 from dinov2.data import SamplerType, make_data_loader, make_dataset
 from dinov2.data.transforms import make_classification_eval_transform, make_classification_train_transform
 import dinov2.distributed as distributed
+from dinov2.eval.backbones import list_backbones
 from dinov2.eval.metrics import MetricType, build_metric
 from dinov2.eval.setup import get_args_parser as get_setup_args_parser
 from dinov2.eval.setup import setup_and_build_model
 from dinov2.eval.utils import (ModelWithIntermediateLayers, evaluate, apply_method_to_nested_values,
                                 make_datasets, make_data_loaders, extract_hyperparameters_from_model,
-                                is_padded_matrix, collate_fn_3d, str2bool, trainable_parameters, bitfit)
-from dinov2.eval.classification.utils import (setup_linear_classifiers, LinearPostprocessor)
+                                is_padded_matrix, collate_fn_3d, str2bool, trainable_parameters, bitfit,
+                                SuccessiveHalving)
+from dinov2.eval.classification.utils import (setup_linear_classifiers, setup_warm_start_classifier, LinearPostprocessor)
 from dinov2.logging import MetricLogger
-from dinov2.data.wrappers import FewShotDatasetWrapper, SystemicSamplerWrapper
+from dinov2.data.wrappers import FewShotDatasetWrapper, SystemicSamplerWrapper, HoldoutSplitWrapper
 from dinov2.models.vision_transformer import DinoVisionTransformer
 
-from peft import LoraConfig, get_peft_model
-
 logger = logging.getLogger("dinov2")
 
 def get_args_parser(
@@ -156,13 +156,19 @@ def get_args_parser(
     parser.add_argument(
         "--backbone",
         type=str,
-        help="The name of the backbone model to use [dinov2, vit-large-imagenet21k]",
+        help=f"The name of the backbone model to use {list_backbones()}",
     )
     parser.add_argument(
         "--peft",
         type=str,
         help="The name of the peft technique to use [lora]",
     )
+    parser.add_argument(
+        "--activation-checkpointing",
+        type=str2bool,
+        help="Recompute the backbone block activations in the backward pass when fine-tuning (--fine-tune or "
+        "--peft), trading compute for memory",
+    )
     parser.add_argument(
         "--image-size",
         type=int,
@@ -173,6 +179,34 @@ def get_args_parser(
         type=int,
         help="Num of samples to take from the dataset"
     )
+    parser.add_argument(
+        "--prune-fraction",
+        type=float,
+        help="Fraction of the remaining classifiers to prune at every evaluation (successive halving), 0 to disable"
+    )
+    parser.add_argument(
+        "--min-heads",
+        type=int,
+        help="Minimum number of classifiers kept by successive halving"
+    )
+    parser.add_argument(
+        "--retrain-mode",
+        type=str,
+        choices=["full", "warm-start", "holdout"],
+        help="How to use the validation set once the best classifier is selected: retrain it from scratch on "
+        "train + val (full), fine-tune it on val only (warm-start), or train the grid on train + val from the "
+        "start and select on a holdout of val (holdout)"
+    )
+    parser.add_argument(
+        "--warm-start-epochs",
+        type=int,
+        help="Number of epochs on the validation set when warm-starting the best classifier"
+    )
+    parser.add_argument(
+        "--holdout-fraction",
+        type=float,
+        help="Fraction of the validation set held out for selection in holdout mode"
+    )
     parser.set_defaults(
         train_dataset_str="NIHChestXray:split=TRAIN",
         val_dataset_str=None,
@@ -194,8 +228,14 @@ def get_args_parser(
         shots=None,
         backbone="dinov2",
         peft=None,
+        activation_checkpointing=False,
         image_size=224,
         num_samples=None,
+        prune_fraction=0.0,
+        min_heads=1,
+        retrain_mode="full",
+        warm_start_epochs=1,
+        holdout_fraction=0.2,
     )
     return parser
 
@@ -243,9 +283,11 @@ def evaluate_linear_classifiers(
     max_score = 0
     best_classifier = ""
     eval_metric = str(list(metric)[0])
+    scores = {}
 
     for i, (classifier_string, metric) in enumerate(results_dict_temp.items()):
         logger.info(f"{prefixstring} -- Classifier: {classifier_string} * {metric}")
+        scores[classifier_string] = metric[eval_metric].item()
         if (
             best_classifier_on_val is None and metric[eval_metric].item() > max_score
         ) or classifier_string == best_classifier_on_val:
@@ -266,6 +308,7 @@ def evaluate_linear_classifiers(
                 f.write(json.dumps({k: v}) + "\n")
             f.write("\n")
 
+    results_dict["scores"] = scores
     return results_dict
 
 
@@ -288,6 +331,7 @@ def eval_linear(
     resume=True,
     classifier_fpath=None,
     is_multilabel=True,
+    pruner=None,
 ):
     if feature_model.fine_tune:
         checkpointer = Checkpointer(nn.Sequential(feature_model, linear_classifiers), output_dir, optimizer=optimizer, scheduler=scheduler)
@@ -296,6 +340,7 @@ def eval_linear(
     start_iter = checkpointer.resume_or_load(classifier_fpath or "", resume=resume).get("iteration", 0) + 1
 
     periodic_checkpointer = PeriodicCheckpointer(checkpointer, checkpoint_period, max_iter=max_iter)
+    checkpoint_extras = {"pruned_heads": pruner.pruned} if pruner is not None else {}
     iteration = start_iter
     logger.info("Starting training from iteration {}".format(start_iter))
     metric_logger = MetricLogger(delimiter="  ")
@@ -352,12 +397,12 @@ def eval_linear(
                 torch.cuda.synchronize()
                 if distributed.is_main_process():
                     logger.info("Checkpointing running_checkpoint")
-                    periodic_checkpointer.save("running_checkpoint_linear_eval", iteration=iteration)
+                    periodic_checkpointer.save("running_checkpoint_linear_eval", iteration=iteration, **checkpoint_extras)
                 torch.cuda.synchronize()
-        periodic_checkpointer.step(iteration)
+        periodic_checkpointer.step(iteration, **checkpoint_extras)
 
         if eval_period > 0 and iteration % eval_period == 0 and iteration != max_iter:
-            _ = evaluate_linear_classifiers(
+            results_dict = evaluate_linear_classifiers(
                 feature_model=feature_model,
                 linear_classifiers=remove_ddp_wrapper(linear_classifiers),
                 data_loader=val_data_loader,
@@ -367,6 +412,11 @@ def eval_linear(
                 num_of_classes=num_of_classes,
                 iteration=iteration,
             )
+            if pruner is not None:
+                pruned = pruner.step(remove_ddp_wrapper(linear_classifiers).classifiers_dict, results_dict["scores"],
+                                     optimizer, scheduler)
+                if pruned and has_ddp_wrapper(linear_classifiers):
+                    linear_classifiers = DistributedDataParallel(remove_ddp_wrapper(linear_classifiers))
             torch.cuda.synchronize()
 
         iteration = iteration + 1
@@ -409,8 +459,14 @@ def run_eval_linear(
     shots=None,
     backbone="dinov2",
     peft=None,
+    activation_checkpointing=False,
     image_size=224,
-    num_samples=None
+    num_samples=None,
+    prune_fraction=0.0,
+    min_heads=1,
+    retrain_mode="full",
+    warm_start_epochs=1,
+    holdout_fraction=0.2,
 ):
     seed = 0
     torch.manual_seed(seed)
@@ -434,6 +490,17 @@ def run_eval_linear(
         logger.info(f"Running dataset with {num_samples} samples only")
         train_dataset = SystemicSamplerWrapper(train_dataset, num_samples=num_samples)
 
+    if retrain_mode == "holdout" and val_dataset is not None:
+        logger.info(f"Training on train + val, selecting on a {holdout_fraction} holdout of the validation set")
+        if shots == None and num_samples == None: # If few-shot is enabled, keep training set.
+            val_train_dataset = make_dataset(
+                dataset_str=val_dataset_str,
+                transform=train_transform,
+            )
+            val_train_dataset = HoldoutSplitWrapper(val_train_dataset, holdout_fraction, holdout=False, seed=seed)
+            train_dataset = torch.utils.data.ConcatDataset([train_dataset, val_train_dataset])
+        val_dataset = HoldoutSplitWrapper(val_dataset, holdout_fraction, holdout=True, seed=seed)
+
     batch_size = train_dataset.__len__() if batch_size > train_dataset.__len__() else batch_size
     num_of_classes = test_dataset.get_num_classes()
     num_of_classes = 1 if num_of_classes == 2 else num_of_classes
@@ -443,7 +510,17 @@ def run_eval_linear(
 
     n_last_blocks = max(n_last_blocks_list)
     autocast_ctx = partial(torch.cuda.amp.autocast, enabled=True, dtype=autocast_dtype)
-    feature_model = ModelWithIntermediateLayers(model, n_last_blocks, autocast_ctx, is_3d=is_3d, fine_tune=fine_tune)
+    # LoRA and BitFit train parameters of the backbone: like --fine-tune, its forward needs gradients
+    train_backbone = fine_tune or peft is not None
+    if peft is not None:
+        logger.info(f"{peft}: running the backbone with gradients, checkpoints hold the backbone and the classifiers")
+    if activation_checkpointing and train_backbone:
+        if hasattr(model, "set_activation_checkpointing"):
+            logger.info("Using activation checkpointing in the backbone blocks")
+            model.set_activation_checkpointing(True)
+        else:
+            logger.warning(f"Activation checkpointing is not supported by the {backbone} backbone")
+    feature_model = ModelWithIntermediateLayers(model, n_last_blocks, autocast_ctx, is_3d=is_3d, fine_tune=train_backbone)
 
     sample_input = train_dataset[0][0][0] if is_3d else train_dataset[0][0] 
     sample_input = sample_input.unsqueeze(0).cuda()
@@ -474,6 +551,8 @@ def run_eval_linear(
         checkpoint_model = nn.Sequential(feature_model, linear_classifiers)
     elif peft == "lora":
         logger.info("Using LoRA for fine tuning")
+        from peft import LoraConfig, get_peft_model  # only imported when LoRA is selected
+
         config = LoraConfig(
             r=48,
             lora_alpha=16,
@@ -502,6 +581,14 @@ def run_eval_linear(
     optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
     checkpointer = Checkpointer(checkpoint_model, output_dir, optimizer=optimizer, scheduler=scheduler)
+
+    pruner = None
+    if prune_fraction > 0:
+        logger.info(f"Successive halving enabled, pruning {prune_fraction} of the classifiers at every evaluation")
+        pruner = SuccessiveHalving(prune_fraction=prune_fraction, min_heads=min_heads)
+        if pruner.restore(checkpointer, remove_ddp_wrapper(linear_classifiers).classifiers_dict, optimizer, scheduler,
+                          resume=resume) and has_ddp_wrapper(linear_classifiers):
+            linear_classifiers = DistributedDataParallel(remove_ddp_wrapper(linear_classifiers))
     
     start_iter = checkpointer.resume_or_load(classifier_fpath or "", resume=resume).get("iteration", 0) + 1
 
@@ -530,13 +617,35 @@ def run_eval_linear(
         resume=resume,
         classifier_fpath=classifier_fpath,
         is_multilabel=is_multilabel,
+        pruner=pruner,
     )
 
-    if val_dataset_str != None: # retrain model with validation set.
+    if val_dataset_str != None and retrain_mode == "holdout": # heads were trained on train + val, only test the best one.
+        logger.info("Testing the most optimal classifier selected on the holdout set.")
+        val_results_dict = evaluate_linear_classifiers(
+            feature_model=feature_model,
+            linear_classifiers=remove_ddp_wrapper(linear_classifiers),
+            data_loader=test_data_loader,
+            metrics_file_path=metrics_file_path,
+            prefixstring=f"ITER: {iteration} {test_data_loader.dataset.split.value}",
+            metric_type=val_metric_type,
+            num_of_classes=num_of_classes,
+            iteration=iteration,
+            best_classifier_on_val=val_results_dict["best_classifier"]["name"],
+        )
+    elif val_dataset_str != None: # retrain model with validation set.
 
         start_iter = 1
+        best_classifier_name = val_results_dict["best_classifier"]["name"]
+        hyperparameters = extract_hyperparameters_from_model(best_classifier_name)
+        learning_rate, avgpool, block = hyperparameters["lr"], hyperparameters["avgpool"], hyperparameters["blocks"]
 
-        if shots == None or num_samples == None: # If few-shot is enabled, keep training set. 
+        if retrain_mode == "warm-start": # continue from the selected classifier, on the validation data only.
+            train_dataset = make_dataset(
+                dataset_str=val_dataset_str,
+                transform=train_transform,
+            )
+        elif shots == None or num_samples == None: # If few-shot is enabled, keep training set. 
             val_dataset = make_dataset(
                 dataset_str=val_dataset_str,
                 transform=train_transform,
@@ -559,24 +668,29 @@ def run_eval_linear(
             persistent_workers=False,
             collate_fn=collate_fn
         )
-        logger.info("Retraining model with combined dataset from train and validation, using the most optimal hp.")
-        hyperparameters = extract_hyperparameters_from_model(val_results_dict["best_classifier"]["name"])
-        learning_rate, avgpool, block = hyperparameters["lr"], hyperparameters["avgpool"], hyperparameters["blocks"]
-      
-        linear_classifiers, optim_param_groups = setup_linear_classifiers(
-            sample_output=sample_output,
-            n_last_blocks_list=block,
-            learning_rates=learning_rate,
-            avgpools=avgpool,
-            num_classes=num_of_classes,
-            is_3d=is_3d
-        )
+        if retrain_mode == "warm-start":
+            logger.info(f"Warm-starting the most optimal classifier on the validation set for {warm_start_epochs} epochs.")
+            linear_classifiers, optim_param_groups = setup_warm_start_classifier(
+                remove_ddp_wrapper(linear_classifiers), best_classifier_name, learning_rate[0]
+            )
+            retrain_epochs = warm_start_epochs
+        else:
+            logger.info("Retraining model with combined dataset from train and validation, using the most optimal hp.")
+            linear_classifiers, optim_param_groups = setup_linear_classifiers(
+                sample_output=sample_output,
+                n_last_blocks_list=block,
+                learning_rates=learning_rate,
+                avgpools=avgpool,
+                num_classes=num_of_classes,
+                is_3d=is_3d
+            )
+            retrain_epochs = epochs
 
         output_dir += os.sep + 'optimal'
         os.makedirs(output_dir, exist_ok=True)
 
         optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
-        max_iter = epochs * epoch_length
+        max_iter = retrain_epochs * epoch_length
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
         checkpointer = Checkpointer(linear_classifiers, output_dir, optimizer=optimizer, scheduler=scheduler)
 
@@ -632,8 +746,14 @@ def main(args):
             fine_tune=args.fine_tune,
             backbone=args.backbone,
             peft=args.peft,
+            activation_checkpointing=args.activation_checkpointing,
             image_size=args.image_size,
-            num_samples=args.num_samples
+            num_samples=args.num_samples,
+            prune_fraction=args.prune_fraction,
+            min_heads=args.min_heads,
+            retrain_mode=args.retrain_mode,
+            warm_start_epochs=args.warm_start_epochs,
+            holdout_fraction=args.holdout_fraction,
             )
     if args.shots != None:
         for shot in args.shots:
@@ -14,13 +14,6 @@ from typing import List, Optional
 
 
 import numpy as np
-from scipy import sparse
-from sklearn import multiclass
-import sklearn.metrics 
-from sklearn.datasets import make_multilabel_classification
-from sklearn.neighbors import NearestNeighbors
-
-from skmultilearn.utils import get_matrix_in_format
 
 import torch
 from torch.nn.functional import one_hot, softmax
@@ -28,9 +21,11 @@ from torch.nn.functional import one_hot, softmax
 import dinov2.distributed as distributed
 from dinov2.data import SamplerType, make_data_loader, make_dataset
 from dinov2.data.transforms import make_classification_eval_transform
+from dinov2.eval.backbones import list_backbones
 from dinov2.eval.metrics import MetricCollection, MetricType, MetricAveraging, build_topk_accuracy_metric, build_metric
 from dinov2.eval.setup import get_args_parser as get_setup_args_parser, setup_and_build_model
 from dinov2.eval.utils import ModelWithNormalize, MLkNN, evaluate, extract_features, apply_method_to_nested_values
+from dinov2.eval.classification.ann import IVFIndex, build_ivf_index, compute_recall, make_ann_kwargs
 
 logger = logging.getLogger("dinov2")
 
@@ -95,7 +90,23 @@ def get_args_parser(
     parser.add_argument(
         "--backbone",
         type=str,
-        help="The name of the backbone model to use [dinov2, vit-large-imagenet21k]",
+        help=f"The name of the backbone model to use {list_backbones()}",
+    )
+    parser.add_argument(
+        "--ann-lists",
+        type=int,
+        help="Number of inverted lists of the approximate nearest-neighbor index, 0 for exact search",
+    )
+    parser.add_argument(
+        "--ann-nprobe",
+        type=int,
+        help="Number of inverted lists scanned per query by the approximate index",
+    )
+    parser.add_argument(
+        "--ann-quantization",
+        type=str,
+        choices=list(IVFIndex.QUANTIZATIONS),
+        help="How vectors are stored in the approximate index",
     )
     parser.set_defaults(
         train_dataset_str="NIHChestXray:split=TRAIN",
@@ -106,6 +117,9 @@ def get_args_parser(
         n_per_class_list=[-1],
         n_tries=1,
         backbone="dinov2",
+        ann_lists=0,
+        ann_nprobe=16,
+        ann_quantization="none",
     )
     return parser
 
@@ -118,7 +132,8 @@ def eval_knn(
     batch_size,
     num_workers,
     gather_on_cpu,
-    metric_type=MetricType.MULTILABEL_AUROC
+    metric_type=MetricType.MULTILABEL_AUROC,
+    ann_kwargs=None,
 ):
     model = ModelWithNormalize(model)
 
@@ -134,11 +149,40 @@ def eval_knn(
         model, test_dataset, batch_size, num_workers, gather_on_cpu=gather_on_cpu
     )
 
-    labels = list(test_dataset.class_names)
-    num_classes = test_dataset.get_num_classes()
+    return eval_knn_on_features(
+        train_features=train_features,
+        train_labels=train_labels,
+        test_features=test_features,
+        test_labels=test_labels,
+        labels=list(test_dataset.class_names),
+        num_classes=test_dataset.get_num_classes(),
+        nb_knn=nb_knn,
+        metric_type=metric_type,
+        ann_kwargs=ann_kwargs,
+    )
+
 
-    train_features, train_labels = train_features.cpu().numpy(), train_labels.cpu().numpy()
-    test_features, test_labels = test_features.cpu().numpy(), test_labels.cpu().numpy()
+def eval_knn_on_features(
+    train_features,
+    train_labels,
+    test_features,
+    test_labels,
+    labels,
+    num_classes,
+    nb_knn,
+    metric_type=MetricType.MULTILABEL_AUROC,
+    ann_kwargs=None,
+):
+    """Multilabel k-NN classification of already extracted (normalized) test features"""
+    # everything stays on the device the features were gathered on
+    device = train_features.device
+    test_features, test_labels = test_features.to(device), test_labels.to(device)
+
+    index = None
+    if ann_kwargs is not None:
+        logger.info(f"Using an approximate nearest-neighbor index: {ann_kwargs}")
+        index = build_ivf_index(train_features, **ann_kwargs)
+        compute_recall(index, train_features, test_features, k=max(nb_knn))
 
     results_dict = {}
     # ============ evaluation ... ============
@@ -147,13 +191,12 @@ def eval_knn(
 
         results_dict[f"{k}"] = {}
 
-        classifier = MLkNN(k)
+        classifier = MLkNN(k, index=index)
         classifier.fit(train_features, train_labels)
-        results = torch.tensor(classifier.predict_proba(test_features).toarray()).cuda()
-        
-        metric = build_metric(metric_type, num_classes=num_classes, labels=labels)
-        metric.update(**{"target": torch.tensor(test_labels).cuda(), "preds": results})
-        metric.compute()
+        results = classifier.predict_proba(test_features)
+
+        metric = build_metric(metric_type, num_classes=num_classes, labels=labels).to(device)
+        metric.update(**{"target": test_labels.long(), "preds": results})
 
         results_dict[f"{k}"] = apply_method_to_nested_values(metric, "compute", nested_types=(MetricCollection, dict))
 
@@ -172,6 +215,7 @@ def eval_knn_with_model(
     gather_on_cpu=False,
     batch_size=256,
     num_workers=5,
+    ann_kwargs=None,
 ):
     
     transform = transform or make_classification_eval_transform()
@@ -200,6 +244,7 @@ def eval_knn_with_model(
             batch_size=batch_size,
             num_workers=num_workers,
             gather_on_cpu=gather_on_cpu,
+            ann_kwargs=ann_kwargs,
         )
 
     metrics_file_path = os.path.join(output_dir, "results_eval_knn.json")
@@ -225,6 +270,7 @@ def main(args):
         gather_on_cpu=args.gather_on_cpu,
         batch_size=args.batch_size,
         num_workers=2,
+        ann_kwargs=make_ann_kwargs(args),
     )
     return 0
 
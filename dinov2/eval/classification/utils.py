@@ -93,4 +93,18 @@ def setup_linear_classifiers(sample_output, n_last_blocks_list, learning_rates,
     if distributed.is_enabled():
         linear_classifiers = nn.parallel.DistributedDataParallel(linear_classifiers)
 
-    return linear_classifiers, optim_param_groups
\ No newline at end of file
+    return linear_classifiers, optim_param_groups
+
+def setup_warm_start_classifier(linear_classifiers, name, learning_rate):
+    """
+    Keeps only the already trained classifier `name` of the grid, so that the final training can
+    continue from its weights instead of starting from scratch
+    """
+    linear_classifier = linear_classifiers.classifiers_dict[name]
+    optim_param_groups = [{"params": linear_classifier.parameters(), "lr": learning_rate}]
+
+    linear_classifiers = AllClassifiers({name: linear_classifier})
+    if distributed.is_enabled():
+        linear_classifiers = nn.parallel.DistributedDataParallel(linear_classifiers)
+
+    return linear_classifiers, optim_param_groups
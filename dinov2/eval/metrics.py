@@ -106,6 +106,107 @@ def build_segmentation_metrics(average_type: MetricAveraging, num_labels: int=2,
     }
     return MetricCollection(metrics)
 
+class MultiHeadSegmentationMetrics(Metric):
+    """
+    Jaccard and Dice (macro, ignoring the background class) of several segmentation heads evaluated on
+    the same targets. A single [num_heads, num_classes, num_classes] int64 confusion matrix is accumulated
+    with one `bincount` per batch, the scores of every head are derived from it in `compute`.
+
+    With `per_volume`, batches of 3D volumes (see `update`) additionally report "volume_jaccard" and
+    "volume_dice": the scores of each class computed on each volume, averaged over the volumes where the
+    class is present in the target or the prediction. Only the confusion matrices of the current batch are
+    kept, the states reduced across processes have a fixed size.
+    """
+    is_differentiable: bool = False
+    higher_is_better: Optional[bool] = True
+    full_state_update: bool = False
+
+    def __init__(self, head_names, num_classes: int, ignore_index: int = 0, per_volume: bool = False, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.head_names = list(head_names)
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+        self.per_volume = per_volume
+        num_heads = len(self.head_names)
+        self.add_state("confmat", torch.zeros(num_heads, num_classes, num_classes, dtype=torch.long), dist_reduce_fx="sum")
+        if per_volume:
+            self.add_state("volume_jaccard_sum", torch.zeros(num_heads, num_classes, dtype=torch.double), dist_reduce_fx="sum")
+            self.add_state("volume_dice_sum", torch.zeros(num_heads, num_classes, dtype=torch.double), dist_reduce_fx="sum")
+            self.add_state("volume_count", torch.zeros(num_heads, num_classes, dtype=torch.long), dist_reduce_fx="sum")
+
+    def update(self, preds: Tensor, target: Tensor, volume_sizes: Optional[list] = None) -> None:  # type: ignore
+        # preds [num_heads, *target.shape] predicted labels, target [...] labels
+        # volume_sizes: number of slices of each of the volumes concatenated along the first dim of target
+        num_heads, num_classes = len(self.head_names), self.num_classes
+        num_volumes = 1 if volume_sizes is None else len(volume_sizes)
+        target = target.reshape(1, -1).long()
+        indices = target * num_classes + preds.reshape(num_heads, -1).long()
+        if volume_sizes is not None:
+            pixels_per_slice = target.numel() // sum(volume_sizes)
+            volume_index = torch.repeat_interleave(
+                torch.arange(num_volumes, device=target.device),
+                torch.as_tensor(volume_sizes, device=target.device) * pixels_per_slice,
+            )
+            indices += volume_index.unsqueeze(0) * num_classes * num_classes
+        head_offsets = torch.arange(num_heads, device=target.device).unsqueeze(1) * num_volumes * num_classes * num_classes
+        indices += head_offsets
+        counts = torch.bincount(indices.flatten(), minlength=num_heads * num_volumes * num_classes * num_classes)
+        counts = counts.view(num_heads, num_volumes, num_classes, num_classes)
+
+        self.confmat += counts.sum(dim=1)
+        if self.per_volume and volume_sizes is not None:
+            self._update_volumes(counts)
+
+    def _update_volumes(self, confmat: Tensor) -> None:
+        # confmat [num_heads, num_volumes, target, pred]
+        confmat = confmat.double()
+        tp = torch.diagonal(confmat, dim1=2, dim2=3)
+        fp = confmat.sum(dim=2) - tp
+        fn = confmat.sum(dim=3) - tp
+        present = tp + fp + fn > 0
+        present[..., self.ignore_index] = False
+        self.volume_jaccard_sum += torch.where(present, tp / (tp + fp + fn).clamp(min=1), 0.0).sum(dim=1)
+        self.volume_dice_sum += torch.where(present, 2 * tp / (2 * tp + fp + fn).clamp(min=1), 0.0).sum(dim=1)
+        self.volume_count += present.sum(dim=1)
+
+    def compute(self) -> Dict[str, Dict[str, Tensor]]:
+        confmat = self.confmat.double()  # [num_heads, target, pred]
+        tp = torch.diagonal(confmat, dim1=1, dim2=2)
+        fp = confmat.sum(dim=1) - tp
+        fn = confmat.sum(dim=2) - tp
+        classes = torch.ones(self.num_classes, dtype=torch.bool, device=confmat.device)
+        classes[self.ignore_index] = False
+
+        # jaccard: pixels of the ignored class are not counted at all
+        kept_confmat = confmat.clone()
+        kept_confmat[:, self.ignore_index] = 0
+        kept_tp = torch.diagonal(kept_confmat, dim1=1, dim2=2)
+        union = kept_confmat.sum(dim=1) + kept_confmat.sum(dim=2) - kept_tp
+        jaccard = torch.where(union > 0, kept_tp / union.clamp(min=1), torch.zeros_like(union))
+        jaccard_weights = (classes & (union > 0)).double()
+        jaccard = (jaccard * jaccard_weights).sum(dim=1) / jaccard_weights.sum(dim=1).clamp(min=1)
+
+        # dice: the ignored class is left out, as well as classes absent from both targets and predictions
+        denominator = 2 * tp + fp + fn
+        dice_weights = (classes & (denominator > 0)).double()
+        dice = torch.where(denominator > 0, 2 * tp / denominator.clamp(min=1), torch.zeros_like(denominator))
+        dice = (dice * dice_weights).sum(dim=1) / dice_weights.sum(dim=1).clamp(min=1)
+
+        results = {"jaccard": jaccard, "dice": dice}
+        if self.per_volume:
+            # mean over the volumes for each class, then over the classes present in at least one volume
+            count = self.volume_count.double()
+            class_weights = (count > 0).double()
+            for name, volume_sum in (("volume_jaccard", self.volume_jaccard_sum), ("volume_dice", self.volume_dice_sum)):
+                per_class = volume_sum / count.clamp(min=1)
+                results[name] = (per_class * class_weights).sum(dim=1) / class_weights.sum(dim=1).clamp(min=1)
+
+        return {
+            name: {k: v[i].float() for k, v in results.items()}
+            for i, name in enumerate(self.head_names)
+        }
+
+
 def build_multilabel_accuracy_metric(average_type: MetricAveraging, num_labels: int):
     metrics: Dict[str, Metric] = {
          f"accuracy": MultilabelAccuracy(num_labels=num_labels, average=average_type.value)
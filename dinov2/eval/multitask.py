@@ -0,0 +1,740 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import argparse
+from functools import partial
+import json
+import logging
+import math
+import os
+import sys
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset, TensorDataset
+from fvcore.common.checkpoint import Checkpointer
+from monai.losses.dice import DiceLoss, DiceCELoss
+
+from dinov2.data import SamplerType, make_data_loader, make_dataset
+from dinov2.data.adapters import DatasetWithEnumeratedTargets
+from dinov2.data.transforms import make_classification_eval_transform, make_segmentation_eval_transforms
+import dinov2.distributed as distributed
+from dinov2.eval.metrics import MetricAveraging, MetricType
+from dinov2.eval.setup import get_args_parser as get_setup_args_parser
+from dinov2.eval.setup import setup_and_build_model
+from dinov2.eval.utils import all_gather_and_flatten, make_data_loaders, str2bool
+from dinov2.eval.classification import knn, mlknn
+from dinov2.eval.classification.linear import eval_linear, evaluate_linear_classifiers, remove_ddp_wrapper
+from dinov2.eval.classification.utils import setup_linear_classifiers
+from dinov2.eval.backbones import list_backbones
+from dinov2.eval.segmentation.feature_store import StoredFeatureEncoder, make_feature_store
+from dinov2.eval.segmentation.segmentation import eval_decoders, evaluate_segmentors
+from dinov2.eval.segmentation.utils import DINOV2Encoder, setup_decoders
+from dinov2.logging import MetricLogger
+
+
+logger = logging.getLogger("dinov2")
+
+PROTOCOLS = ("linear", "knn", "mlknn", "segmentation")
+
+
+def get_args_parser(
+    description: Optional[str] = None,
+    parents: Optional[List[argparse.ArgumentParser]] = [],
+    add_help: bool = True,
+):
+    setup_args_parser = get_setup_args_parser(parents=parents, add_help=False)
+    parents = [setup_args_parser]
+    parser = argparse.ArgumentParser(
+        description=description,
+        parents=parents,
+        add_help=add_help,
+    )
+    parser.add_argument(
+        "--protocols",
+        nargs="+",
+        type=str,
+        choices=list(PROTOCOLS),
+        help="Evaluation protocols fed from the shared backbone pass",
+    )
+    parser.add_argument(
+        "--train-dataset",
+        dest="train_dataset_str",
+        type=str,
+        help="Training dataset of the classification protocols",
+    )
+    parser.add_argument(
+        "--val-dataset",
+        dest="val_dataset_str",
+        type=str,
+        help="Validation dataset of the classification protocols",
+    )
+    parser.add_argument(
+        "--test-dataset",
+        dest="test_dataset_str",
+        type=str,
+        help="Test dataset of the classification protocols",
+    )
+    parser.add_argument(
+        "--segmentation-train-dataset",
+        dest="segmentation_train_dataset_str",
+        type=str,
+        help="Training dataset of the segmentation protocol",
+    )
+    parser.add_argument(
+        "--segmentation-val-dataset",
+        dest="segmentation_val_dataset_str",
+        type=str,
+        help="Validation dataset of the segmentation protocol",
+    )
+    parser.add_argument(
+        "--segmentation-test-dataset",
+        dest="segmentation_test_dataset_str",
+        type=str,
+        help="Test dataset of the segmentation protocol",
+    )
+    parser.add_argument(
+        "--backbone",
+        type=str,
+        help=f"The name of the backbone model to use {list_backbones()}",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Batch Size (per GPU)",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        help="Number de Workers",
+    )
+    parser.add_argument(
+        "--image-size",
+        type=int,
+        help="Size of input image for the classification protocols",
+    )
+    parser.add_argument(
+        "--segmentation-image-size",
+        type=int,
+        help="Size of input image for the segmentation protocol",
+    )
+    parser.add_argument(
+        "--epochs",
+        type=int,
+        help="Number of training epochs of the linear classifiers and decoders",
+    )
+    parser.add_argument(
+        "--eval-period-epochs",
+        type=int,
+        help="Number of epochs between two evaluations.",
+    )
+    parser.add_argument(
+        "--learning-rates",
+        nargs="+",
+        type=float,
+        help="Learning rates to grid search for the linear classifiers.",
+    )
+    parser.add_argument(
+        "--n-last-blocks",
+        nargs="+",
+        type=int,
+    )
+    parser.add_argument(
+        "--avgpools",
+        nargs="+",
+        type=str2bool,
+    )
+    parser.add_argument(
+        "--val-metric-type",
+        type=MetricType,
+        choices=list(MetricType),
+        help="Validation metric of the linear classifiers and multilabel k-NN",
+    )
+    parser.add_argument(
+        "--nb_knn",
+        nargs="+",
+        type=int,
+        help="Number of NN to use. 20 is usually working the best.",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        help="Temperature used in the voting coefficient",
+    )
+    parser.add_argument(
+        "--decoder-type",
+        type=str,
+        help="The type of decoder to use [linear, unet]",
+    )
+    parser.add_argument(
+        "--segmentation-learning-rates",
+        nargs="+",
+        type=float,
+        help="Learning rates to grid search for the decoders.",
+    )
+    parser.add_argument(
+        "--loss-function",
+        type=str,
+        help="The loss function used by the decoders",
+    )
+    parser.set_defaults(
+        protocols=["linear", "mlknn"],  # the default dataset is multilabel, which the k-NN does not support
+        train_dataset_str="NIHChestXray:split=TRAIN",
+        val_dataset_str=None,
+        test_dataset_str="NIHChestXray:split=TEST",
+        segmentation_train_dataset_str="MC:split=TRAIN",
+        segmentation_val_dataset_str=None,
+        segmentation_test_dataset_str="MC:split=TEST",
+        backbone="dinov2",
+        batch_size=128,
+        num_workers=8,
+        image_size=224,
+        segmentation_image_size=448,
+        epochs=10,
+        eval_period_epochs=5,
+        learning_rates=[1e-3, 5e-3, 1e-2, 5e-2],
+        n_last_blocks=[1, 4],
+        avgpools=[True, False],
+        val_metric_type=MetricType.MULTILABEL_AUROC,
+        nb_knn=[5, 20],
+        temperature=0.07,
+        decoder_type="linear",
+        segmentation_learning_rates=[1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 1e-1],
+        loss_function="dice",
+    )
+    return parser
+
+
+class MultiTaskFeatureModel(nn.Module):
+    """
+    Runs the frozen backbone once per batch and keeps everything the classification protocols need from
+    `get_intermediate_layers`: the class tokens of the last `n_last_blocks` blocks and the average pooled
+    patch tokens of the last block.
+    """
+
+    def __init__(self, feature_model, n_last_blocks, autocast_ctx):
+        super().__init__()
+        self.feature_model = feature_model
+        self.feature_model.eval()
+        self.n_last_blocks = n_last_blocks
+        self.autocast_ctx = autocast_ctx
+
+    def forward(self, images):
+        with torch.no_grad():
+            with self.autocast_ctx():
+                outputs = self.feature_model.get_intermediate_layers(
+                    images, self.n_last_blocks, return_class_token=True
+                )
+        return {
+            "class_tokens": torch.stack([class_token for _, class_token in outputs], dim=1).float(),
+            "pooled_patch_tokens": outputs[-1][0].mean(dim=1).float(),
+        }
+
+
+@torch.inference_mode()
+def extract_feature_bank(feature_model, dataset, batch_size, num_workers):
+    """Single pass over `dataset`, returns the features of `feature_model` and the targets, on CPU"""
+    dataset_with_enumerated_targets = DatasetWithEnumeratedTargets(dataset)
+    sample_count = len(dataset_with_enumerated_targets)
+    data_loader = make_data_loader(
+        dataset=dataset_with_enumerated_targets,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        sampler_type=SamplerType.DISTRIBUTED,
+        drop_last=False,
+        shuffle=False,
+    )
+    gather = all_gather_and_flatten if distributed.is_enabled() else (lambda tensor: tensor)
+
+    metric_logger = MetricLogger(delimiter="  ")
+    features, targets = None, None
+    for samples, (index, targets_rank) in metric_logger.log_every(data_loader, 10):
+        samples = samples.cuda(non_blocking=True)
+        index = gather(index.cuda(non_blocking=True)).cpu()
+        targets_rank = torch.as_tensor(targets_rank).cuda(non_blocking=True)
+        features_rank = feature_model(samples)
+
+        # init storage, the padding of the distributed sampler is overwritten with the same values
+        if features is None:
+            features = {
+                k: torch.zeros(sample_count, *v.shape[1:], dtype=v.dtype) for k, v in features_rank.items()
+            }
+            targets = torch.zeros(sample_count, *targets_rank.shape[1:], dtype=targets_rank.dtype)
+            logger.info(f"Storing features {({k: tuple(v.shape) for k, v in features.items()})}")
+
+        for k, v in features_rank.items():
+            features[k].index_copy_(0, index, gather(v).cpu())
+        targets.index_copy_(0, index, gather(targets_rank).cpu())
+
+    return features, targets
+
+
+class FeatureBank:
+    """Features of the splits of a protocol, concatenated so that one feature model serves all of them"""
+
+    def __init__(self, banks):
+        self.offsets = {}
+        offset = 0
+        for split, (features, targets) in banks.items():
+            self.offsets[split] = offset
+            offset += len(targets)
+        all_features = [features for features, _ in banks.values()]
+        self.features = {k: torch.cat([features[k] for features in all_features]) for k in all_features[0]}
+        self.targets = {split: targets for split, (_, targets) in banks.items()}
+
+    def split_features(self, split, key):
+        start = self.offsets[split]
+        return self.features[key][start : start + len(self.targets[split])]
+
+    def knn_features(self, split):
+        class_tokens = self.split_features(split, "class_tokens")[:, -1]
+        return nn.functional.normalize(class_tokens, dim=1, p=2)
+
+    def dataset(self, split, dataset):
+        return FeatureBankDataset(dataset, self.targets[split], self.offsets[split])
+
+
+class FeatureBankDataset(Dataset):
+    """Yields (index in the feature bank, target) in place of (image, target) for a split of a `FeatureBank`"""
+
+    def __init__(self, dataset, targets, offset):
+        self.dataset = dataset
+        self.targets = targets
+        self.offset = offset
+
+    def __getitem__(self, index):
+        return self.offset + index, self.targets[index]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getattr__(self, name):
+        # class names, split, number of classes... of the original dataset
+        if name in ("dataset", "targets", "offset"):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+class CachedFeatureModel(nn.Module):
+    """
+    Stands in for the backbone wrapper of the linear evaluator (`ModelWithIntermediateLayers`), returning the
+    features of a `FeatureBank` for batches of bank indices
+    """
+
+    def __init__(self, bank):
+        super().__init__()
+        self.bank = bank
+        self.fine_tune = False
+
+    def forward_(self, indices):
+        indices = indices.cpu()
+        device = torch.cuda.current_device()
+        # same layout as `get_intermediate_layers`, the average of one pooled token is the pooled token itself
+        pooled = self.bank.features["pooled_patch_tokens"][indices].to(device, non_blocking=True)
+        class_tokens = self.bank.features["class_tokens"][indices].to(device, non_blocking=True)
+        return [(pooled.unsqueeze(1), class_token) for class_token in class_tokens.unbind(dim=1)]
+
+    def forward(self, indices):
+        return [self.forward_(indices)]
+
+
+def make_feature_bank(feature_model, datasets, batch_size, num_workers):
+    banks = {}
+    for split, dataset in datasets.items():
+        if dataset is None:
+            continue
+        logger.info(f"Extracting features for the {split} set...")
+        banks[split] = extract_feature_bank(feature_model, dataset, batch_size, num_workers)
+    return FeatureBank(banks)
+
+
+def run_knn(bank, nb_knn, temperature, batch_size, num_workers):
+    test_features, test_targets = bank.knn_features("test"), bank.targets["test"]
+    val_dataloader = make_data_loader(
+        dataset=TensorDataset(test_features, test_targets),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        sampler_type=SamplerType.DISTRIBUTED,
+        drop_last=False,
+        shuffle=False,
+    )
+    results_dict_knn = knn.eval_knn_on_features(
+        feature_model=None,
+        train_features=bank.knn_features("train").cuda(),
+        train_labels=bank.targets["train"].cuda(),
+        val_dataloader=val_dataloader,
+        accuracy_averaging=MetricAveraging.MEAN_ACCURACY,
+        nb_knn=nb_knn,
+        temperature=temperature,
+    )
+    results_dict = {}
+    for knn_, results in results_dict_knn.items():
+        results_dict[f"{knn_} Top 1"] = results["top-1"].item() * 100.0
+        results_dict[f"{knn_} Top 5"] = results["top-5"].item() * 100.0
+    return results_dict
+
+
+def run_mlknn(bank, datasets, nb_knn, metric_type):
+    # as in the multilabel k-NN evaluation, the validation set is part of the memory bank
+    train_splits = [split for split in ("train", "val") if split in bank.targets]
+    train_features = torch.cat([bank.knn_features(split) for split in train_splits]).cuda()
+    train_labels = torch.cat([bank.targets[split] for split in train_splits]).cuda()
+    test_dataset = datasets["test"]
+    return mlknn.eval_knn_on_features(
+        train_features=train_features,
+        train_labels=train_labels,
+        test_features=bank.knn_features("test").cuda(),
+        test_labels=bank.targets["test"].cuda(),
+        labels=list(test_dataset.class_names),
+        num_classes=test_dataset.get_num_classes(),
+        nb_knn=nb_knn,
+        metric_type=metric_type,
+    )
+
+
+def run_linear(
+    bank,
+    datasets,
+    output_dir,
+    batch_size,
+    num_workers,
+    epochs,
+    eval_period_epochs,
+    learning_rates,
+    n_last_blocks_list,
+    avgpools,
+    metric_type,
+):
+    test_dataset = datasets["test"]
+    num_of_classes = test_dataset.get_num_classes()
+    num_of_classes = 1 if num_of_classes == 2 else num_of_classes
+    feature_model = CachedFeatureModel(bank)
+    train_dataset = bank.dataset("train", datasets["train"])
+    val_dataset = bank.dataset("val", datasets["val"]) if datasets["val"] is not None else None
+    test_dataset = bank.dataset("test", test_dataset)
+
+    sample_output = feature_model.forward_(torch.tensor([0]))
+    linear_classifiers, optim_param_groups = setup_linear_classifiers(
+        sample_output=sample_output,
+        n_last_blocks_list=n_last_blocks_list,
+        learning_rates=learning_rates,
+        avgpools=avgpools,
+        num_classes=num_of_classes,
+    )
+
+    epoch_length = math.ceil(len(train_dataset) / batch_size)
+    max_iter = epochs * epoch_length
+    optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
+    checkpointer = Checkpointer(linear_classifiers, output_dir, optimizer=optimizer, scheduler=scheduler)
+    start_iter = checkpointer.resume_or_load("", resume=True).get("iteration", 0) + 1
+
+    train_data_loader, val_data_loader, test_data_loader = make_data_loaders(
+        train_dataset=train_dataset, test_dataset=test_dataset, val_dataset=val_dataset,
+        sampler_type=SamplerType.INFINITE, start_iter=start_iter, batch_size=batch_size, num_workers=num_workers,
+    )
+    metrics_file_path = os.path.join(output_dir, "results_eval_linear.json")
+    val_results_dict, feature_model, linear_classifiers, iteration = eval_linear(
+        feature_model=feature_model,
+        linear_classifiers=linear_classifiers,
+        train_data_loader=train_data_loader,
+        val_data_loader=test_data_loader if val_data_loader is None else val_data_loader,
+        metrics_file_path=metrics_file_path,
+        optimizer=optimizer,
+        scheduler=scheduler,
+        output_dir=output_dir,
+        max_iter=max_iter,
+        checkpoint_period=epoch_length * epochs,
+        running_checkpoint_period=epoch_length,
+        eval_period=eval_period_epochs * epoch_length,
+        metric_type=metric_type,
+        num_of_classes=num_of_classes,
+        is_multilabel=test_dataset.is_multilabel(),
+    )
+    if val_data_loader is not None:
+        val_results_dict = evaluate_linear_classifiers(
+            feature_model=feature_model,
+            linear_classifiers=remove_ddp_wrapper(linear_classifiers),
+            data_loader=test_data_loader,
+            metrics_file_path=metrics_file_path,
+            prefixstring=f"ITER: {iteration} {test_data_loader.dataset.split.value}",
+            metric_type=metric_type,
+            num_of_classes=num_of_classes,
+            iteration=iteration,
+            best_classifier_on_val=val_results_dict["best_classifier"]["name"],
+        )
+    return {"best_classifier": val_results_dict["best_classifier"]}
+
+
+def run_segmentation(
+    datasets,
+    model,
+    output_dir,
+    batch_size,
+    num_workers,
+    epochs,
+    eval_period_epochs,
+    learning_rates,
+    decoder_type,
+    image_size,
+    loss_function,
+):
+    # datasets: feature stores of the splits (see `build_feature_store`)
+    train_dataset, val_dataset, test_dataset = datasets["train"], datasets["val"], datasets["test"]
+    num_of_classes = test_dataset.get_num_classes()
+    n_last_blocks = 5 if decoder_type == "unet" else 1
+    feature_model = StoredFeatureEncoder(n_last_blocks)
+
+    decoders, optim_param_groups = setup_decoders(
+        model.embed_dim,
+        learning_rates,
+        num_of_classes,
+        decoder_type,
+        image_size=image_size,
+        patch_size=model.patch_size,
+    )
+
+    epoch_length = math.ceil(len(train_dataset) / batch_size)
+    max_iter = epochs * epoch_length
+    optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
+    checkpointer = Checkpointer(decoders, output_dir, optimizer=optimizer, scheduler=scheduler)
+    start_iter = checkpointer.resume_or_load("", resume=True).get("iteration", 0) + 1
+    if loss_function == "combined":
+        loss_function = DiceCELoss(softmax=True, to_onehot_y=True)
+    else:
+        loss_function = DiceLoss(softmax=True, to_onehot_y=True)
+
+    train_data_loader, val_data_loader, test_data_loader = make_data_loaders(
+        train_dataset=train_dataset, test_dataset=test_dataset, val_dataset=val_dataset,
+        sampler_type=SamplerType.INFINITE, start_iter=start_iter, batch_size=batch_size, num_workers=num_workers,
+    )
+    metrics_file_path = os.path.join(output_dir, "results_eval_linear.json")
+    val_results_dict, feature_model, decoders, iteration = eval_decoders(
+        feature_model=feature_model,
+        decoders=decoders,
+        train_data_loader=train_data_loader,
+        val_data_loader=test_data_loader if val_data_loader is None else val_data_loader,
+        metrics_file_path=metrics_file_path,
+        optimizer=optimizer,
+        scheduler=scheduler,
+        output_dir=output_dir,
+        max_iter=max_iter,
+        checkpoint_period=epoch_length * epochs,
+        running_checkpoint_period=epoch_length,
+        eval_period=eval_period_epochs * epoch_length,
+        metric_type=MetricType.SEGMENTATION_METRICS,
+        num_of_classes=num_of_classes,
+        loss_function=loss_function,
+    )
+    if val_data_loader is not None:
+        val_results_dict = evaluate_segmentors(
+            feature_model=feature_model,
+            decoders=remove_ddp_wrapper(decoders),
+            data_loader=test_data_loader,
+            metrics_file_path=metrics_file_path,
+            prefixstring=f"ITER: {iteration} {test_data_loader.dataset.split.value}",
+            metric_type=MetricType.SEGMENTATION_METRICS,
+            num_of_classes=num_of_classes,
+            iteration=iteration,
+            best_segmentor_on_val=val_results_dict["best_segmentor"]["name"],
+        )
+    return {"best_segmentor": val_results_dict["best_segmentor"]}
+
+
+def make_split_datasets(train_dataset_str, val_dataset_str, test_dataset_str, transform, target_transform=None):
+    datasets = {
+        split: make_dataset(dataset_str=dataset_str, transform=transform, target_transform=target_transform)
+        if dataset_str is not None else None
+        for split, dataset_str in (("train", train_dataset_str), ("val", val_dataset_str), ("test", test_dataset_str))
+    }
+    if datasets["test"].is_3d():
+        raise ValueError("3D datasets are not supported by the multi-task evaluation")
+    return datasets
+
+
+def run_eval_multitask(
+    model,
+    output_dir,
+    autocast_dtype,
+    protocols,
+    train_dataset_str,
+    test_dataset_str,
+    val_dataset_str=None,
+    segmentation_train_dataset_str=None,
+    segmentation_test_dataset_str=None,
+    segmentation_val_dataset_str=None,
+    batch_size=128,
+    num_workers=8,
+    image_size=224,
+    segmentation_image_size=448,
+    epochs=10,
+    eval_period_epochs=5,
+    learning_rates=[1e-3, 5e-3, 1e-2, 5e-2],
+    n_last_blocks_list=[1, 4],
+    avgpools=[True, False],
+    val_metric_type=MetricType.MULTILABEL_AUROC,
+    nb_knn=[5, 20],
+    temperature=0.07,
+    decoder_type="linear",
+    segmentation_learning_rates=[1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 1e-1],
+    loss_function="dice",
+    backbone="dinov2",
+    pretrained_weights=None,
+):
+    """
+    Each dataset goes once through the frozen backbone (with its eval transform), then the linear classifiers,
+    k-NN, multilabel k-NN and segmentation decoders are trained and evaluated on the stored features.
+    The linear classifiers and decoders are thus trained without data augmentation. The classification
+    features are kept in memory, the patch tokens of the segmentation datasets are written to memory-mapped
+    feature stores in `output_dir`/segmentation/feature_store, as they do not fit in memory for large datasets.
+    """
+    torch.manual_seed(0)
+    autocast_ctx = partial(torch.cuda.amp.autocast, enabled=True, dtype=autocast_dtype)
+    results_dict = {}
+
+    classification_protocols = [protocol for protocol in protocols if protocol != "segmentation"]
+    if classification_protocols:
+        transform = make_classification_eval_transform(resize_size=image_size, crop_size=image_size)
+        datasets = make_split_datasets(train_dataset_str, val_dataset_str, test_dataset_str, transform)
+        if "knn" in classification_protocols and datasets["test"].is_multilabel():
+            # the k-NN votes for a single class per sample, multilabel datasets are handled by the ML-kNN
+            logger.warning("Skipping the k-NN classification, which does not support multilabel datasets")
+            classification_protocols.remove("knn")
+        n_last_blocks = max(n_last_blocks_list) if "linear" in protocols else 1
+        feature_model = MultiTaskFeatureModel(model, n_last_blocks, autocast_ctx)
+        bank = make_feature_bank(feature_model, datasets, batch_size, num_workers)
+
+        if "knn" in classification_protocols:
+            logger.info("Start the k-NN classification.")
+            results_dict["knn"] = run_knn(bank, nb_knn, temperature, batch_size, num_workers)
+        if "mlknn" in protocols:
+            logger.info("Start the Multilabel k-NN classification.")
+            results_dict["mlknn"] = run_mlknn(bank, datasets, nb_knn, val_metric_type)
+        if "linear" in protocols:
+            logger.info("Start the linear classification.")
+            linear_output_dir = os.path.join(output_dir, "linear")
+            os.makedirs(linear_output_dir, exist_ok=True)
+            results_dict["linear"] = run_linear(
+                bank,
+                datasets,
+                output_dir=linear_output_dir,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                epochs=epochs,
+                eval_period_epochs=eval_period_epochs,
+                learning_rates=learning_rates,
+                n_last_blocks_list=n_last_blocks_list,
+                avgpools=avgpools,
+                metric_type=val_metric_type,
+            )
+        del bank
+
+    if "segmentation" in protocols:
+        image_transform, target_transform = make_segmentation_eval_transforms(resize_size=segmentation_image_size)
+        datasets = make_split_datasets(
+            segmentation_train_dataset_str,
+            segmentation_val_dataset_str,
+            segmentation_test_dataset_str,
+            image_transform,
+            target_transform,
+        )
+        n_last_blocks = 5 if decoder_type == "unet" else 1
+        encoder = DINOV2Encoder(model, autocast_ctx=autocast_ctx, n_last_blocks=n_last_blocks)
+        segmentation_output_dir = os.path.join(output_dir, "segmentation")
+        store_metadata = {
+            "backbone": backbone,
+            "pretrained_weights": pretrained_weights,
+            "resize_size": segmentation_image_size,
+        }
+        dataset_strs = {
+            "train": segmentation_train_dataset_str,
+            "val": segmentation_val_dataset_str,
+            "test": segmentation_test_dataset_str,
+        }
+        for split, dataset in datasets.items():
+            if dataset is None:
+                continue
+            logger.info(f"Extracting patch tokens for the {split} set...")
+            datasets[split] = make_feature_store(
+                encoder,
+                dataset,
+                split,
+                dataset_strs[split],
+                store_dir=os.path.join(segmentation_output_dir, "feature_store"),
+                metadata=store_metadata,
+                batch_size=batch_size,
+                num_workers=num_workers,
+            )
+
+        logger.info("Start the segmentation.")
+        os.makedirs(segmentation_output_dir, exist_ok=True)
+        results_dict["segmentation"] = run_segmentation(
+            datasets,
+            model,
+            output_dir=segmentation_output_dir,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            epochs=epochs,
+            eval_period_epochs=eval_period_epochs,
+            learning_rates=segmentation_learning_rates,
+            decoder_type=decoder_type,
+            image_size=segmentation_image_size,
+            loss_function=loss_function,
+        )
+
+    if distributed.is_main_process():
+        metrics_file_path = os.path.join(output_dir, "results_eval_multitask.json")
+        with open(metrics_file_path, "a") as f:
+            for k, v in results_dict.items():
+                f.write(json.dumps({k: v}) + "\n")
+    logger.info("Multi-task Results Dict " + str(results_dict))
+
+    if distributed.is_enabled():
+        torch.distributed.barrier()
+    return results_dict
+
+
+def main(args):
+    model, autocast_dtype = setup_and_build_model(args)
+    run_eval_multitask(
+        model=model,
+        output_dir=args.output_dir,
+        autocast_dtype=autocast_dtype,
+        protocols=args.protocols,
+        train_dataset_str=args.train_dataset_str,
+        val_dataset_str=args.val_dataset_str,
+        test_dataset_str=args.test_dataset_str,
+        segmentation_train_dataset_str=args.segmentation_train_dataset_str,
+        segmentation_val_dataset_str=args.segmentation_val_dataset_str,
+        segmentation_test_dataset_str=args.segmentation_test_dataset_str,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        image_size=args.image_size,
+        segmentation_image_size=args.segmentation_image_size,
+        epochs=args.epochs,
+        eval_period_epochs=args.eval_period_epochs,
+        learning_rates=args.learning_rates,
+        n_last_blocks_list=args.n_last_blocks,
+        avgpools=args.avgpools,
+        val_metric_type=args.val_metric_type,
+        nb_knn=args.nb_knn,
+        temperature=args.temperature,
+        decoder_type=args.decoder_type,
+        segmentation_learning_rates=args.segmentation_learning_rates,
+        loss_function=args.loss_function,
+        backbone=args.backbone,
+        pretrained_weights=args.pretrained_weights,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    description = "DINOv2 multi-task evaluation"
+    args_parser = get_args_parser(description=description)
+    args = args_parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+import torch
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import roc_auc_score
+from sklearn.multiclass import OneVsRestClassifier
+
+from dinov2.data import make_dataset
+from dinov2.data.transforms import make_classification_eval_transform
+from dinov2.eval.setup import get_args_parser as get_setup_args_parser
+from dinov2.logging import setup_logging
+from dinov2.models import build_model_from_cfg
+from dinov2.models.quantization import quantize_dynamic_int8
+from dinov2.utils.config import get_cfg_from_args
+import dinov2.utils.utils as dinov2_utils
+
+
+logger = logging.getLogger("dinov2")
+
+
+def get_args_parser(
+    description: Optional[str] = None,
+    parents: Optional[List[argparse.ArgumentParser]] = [],
+    add_help: bool = True,
+):
+    setup_args_parser = get_setup_args_parser(parents=parents, add_help=False)
+    parents = [setup_args_parser]
+    parser = argparse.ArgumentParser(
+        description=description,
+        parents=parents,
+        add_help=add_help,
+    )
+    parser.add_argument(
+        "--train-dataset",
+        dest="train_dataset_str",
+        type=str,
+        help="Training dataset, a sample of it is used to fit the linear probes",
+    )
+    parser.add_argument(
+        "--val-dataset",
+        dest="val_dataset_str",
+        type=str,
+        help="Validation dataset, a sample of it is used to compare the features and the probes",
+    )
+    parser.add_argument(
+        "--num-samples",
+        type=int,
+        help="Number of samples drawn from each dataset",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        help="Batch size of the feature extraction",
+    )
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        help="Number of CPU threads, all of them by default",
+    )
+    parser.set_defaults(
+        train_dataset_str="NIHChestXray:split=TRAIN:root=/mnt/z/data/NIH",
+        val_dataset_str="NIHChestXray:split=VAL:root=/mnt/z/data/NIH",
+        num_samples=1000,
+        batch_size=32,
+        num_threads=None,
+    )
+    return parser
+
+
+def sample_dataset(dataset, num_samples, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    indices = torch.randperm(len(dataset), generator=generator)[:num_samples].tolist()
+    return torch.utils.data.Subset(dataset, indices)
+
+
+@torch.no_grad()
+def extract_cpu_features(model, dataset, batch_size):
+    """Class tokens and mean-pooled patch tokens of `dataset` on CPU, with the extraction time"""
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+    class_tokens, pooled_tokens, labels = [], [], []
+    elapsed = 0.0
+    for images, targets in data_loader:
+        start = time.perf_counter()
+        output = model.forward_features(images)
+        elapsed += time.perf_counter() - start
+        class_tokens.append(output["x_norm_clstoken"])
+        pooled_tokens.append(output["x_norm_patchtokens"].mean(dim=1))
+        labels.append(torch.as_tensor(targets))
+    return torch.cat(class_tokens), torch.cat(pooled_tokens), torch.cat(labels), elapsed
+
+
+def _probe_auroc(probe, features, labels):
+    scores = probe.predict_proba(features)
+    if labels.ndim == 1 and scores.shape[1] == 2:  # binary
+        return roc_auc_score(labels, scores[:, 1])
+    if labels.ndim == 1:  # multi-class, one-vs-rest
+        return roc_auc_score(labels, scores, multi_class="ovr", labels=probe.classes_)
+    return roc_auc_score(labels, scores, average="macro")
+
+
+def fit_probe(features, labels):
+    features = features.numpy()
+    labels = labels.numpy()
+    probe = LogisticRegression(max_iter=1000)
+    if labels.ndim > 1:  # multi-label
+        probe = OneVsRestClassifier(probe)
+    return probe.fit(features, labels)
+
+
+def run_quantization_report(model, train_dataset, val_dataset, batch_size, output_dir=None):
+    """
+    Compares the dynamically quantized int8 copy of `model` to the float32 model on CPU: cosine similarity of the
+    class and pooled patch features, extraction time, and AUROC of linear probes on the class tokens (each
+    model's own probe, and the float32 probe applied to the int8 features).
+    """
+    model = model.cpu().float().eval()
+    quantized_model = quantize_dynamic_int8(model)
+
+    features = {}
+    for name, m in (("fp32", model), ("int8", quantized_model)):
+        train = extract_cpu_features(m, train_dataset, batch_size)
+        val = extract_cpu_features(m, val_dataset, batch_size)
+        features[name] = {"train": train, "val": val}
+        logger.info(f"{name} features extracted in {train[3] + val[3]:.1f}s")
+
+    fp32_val, int8_val = features["fp32"]["val"], features["int8"]["val"]
+    cosine = torch.nn.functional.cosine_similarity
+    report = {
+        "class_token_cosine": cosine(fp32_val[0], int8_val[0]).mean().item(),
+        "pooled_patch_cosine": cosine(fp32_val[1], int8_val[1]).mean().item(),
+        "fp32_seconds_per_image": (fp32_val[3] + features["fp32"]["train"][3])
+        / (len(train_dataset) + len(val_dataset)),
+        "int8_seconds_per_image": (int8_val[3] + features["int8"]["train"][3])
+        / (len(train_dataset) + len(val_dataset)),
+    }
+    probes = {name: fit_probe(f["train"][0], f["train"][2]) for name, f in features.items()}
+    val_labels = fp32_val[2].numpy()
+    report["fp32_auroc"] = _probe_auroc(probes["fp32"], fp32_val[0].numpy(), val_labels)
+    report["int8_auroc"] = _probe_auroc(probes["int8"], int8_val[0].numpy(), val_labels)
+    report["int8_features_fp32_probe_auroc"] = _probe_auroc(probes["fp32"], int8_val[0].numpy(), val_labels)
+
+    logger.info("Quantization report: " + json.dumps(report))
+    if output_dir is not None:
+        with open(os.path.join(output_dir, "results_quantization.json"), "w") as f:
+            f.write(json.dumps(report) + "\n")
+    return report, quantized_model
+
+
+def main(args):
+    # CPU only: the config is read without the distributed setup of the GPU evaluations
+    config = get_cfg_from_args(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    setup_logging(output=args.output_dir, level=logging.INFO)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    model, _ = build_model_from_cfg(config, only_teacher=True)
+    dinov2_utils.load_pretrained_weights(model, args.pretrained_weights, "teacher")
+
+    transform = make_classification_eval_transform()
+    train_dataset = sample_dataset(make_dataset(dataset_str=args.train_dataset_str, transform=transform), args.num_samples)
+    val_dataset = sample_dataset(make_dataset(dataset_str=args.val_dataset_str, transform=transform), args.num_samples)
+    run_quantization_report(model, train_dataset, val_dataset, args.batch_size, output_dir=args.output_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    description = "DINOv2 dynamic int8 quantization report"
+    args_parser = get_args_parser(description=description)
+    args = args_parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import dinov2.distributed as distributed
+from dinov2.data import make_data_loader
+
+
+logger = logging.getLogger("dinov2")
+
+
+class FeatureStoreDataset(torch.utils.data.Dataset):
+    """
+    Patch-token maps precomputed by `build_feature_store`, memory-mapped from fp16 .npy files. Yields
+    ([n_last_blocks, num_patches, embed_dim] features, target) instead of (image, target). With `augment`,
+    random flips and 90 degree rotations are applied consistently to the patch grid and to the target.
+    Attributes of the original dataset (split, class_names, ...) stay accessible.
+    """
+
+    def __init__(self, dataset, features_path, targets_path, augment=False):
+        self.dataset = dataset
+        self.features_path = features_path
+        self.targets_path = targets_path
+        self.augment = augment
+        self._features = self._targets = None  # opened lazily, in each data loader worker
+
+    def _open(self):
+        self._features = np.load(self.features_path, mmap_mode="r")
+        self._targets = np.load(self.targets_path, mmap_mode="r")
+
+    def __getitem__(self, index):
+        if self._features is None:
+            self._open()
+        features = torch.from_numpy(np.array(self._features[index]))
+        target = torch.from_numpy(np.array(self._targets[index]))
+        if self.augment:
+            features, target = self._augment(features, target)
+        return features, target
+
+    def _augment(self, features, target):
+        n_blocks, num_patches, embed_dim = features.shape
+        grid_size = int(num_patches**0.5)
+        features = features.view(n_blocks, grid_size, grid_size, embed_dim)
+        if torch.rand(1).item() < 0.5:  # horizontal flip
+            features, target = features.flip(2), target.flip(-1)
+        if torch.rand(1).item() < 0.5:  # vertical flip
+            features, target = features.flip(1), target.flip(-2)
+        k = int(torch.randint(0, 4, (1,)).item())
+        if k > 0:
+            features, target = torch.rot90(features, k, dims=(1, 2)), torch.rot90(target, k, dims=(-2, -1))
+        return features.reshape(n_blocks, num_patches, embed_dim), target.contiguous()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        if name in ("dataset", "features_path", "targets_path", "augment", "_features", "_targets"):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_features"] = state["_targets"] = None
+        return state
+
+
+class StoredFeatureEncoder(nn.Module):
+    """Stands in for `DINOV2Encoder` on batches of a `FeatureStoreDataset`, with the same outputs"""
+
+    def __init__(self, n_last_blocks=1):
+        super().__init__()
+        self.n_last_blocks = n_last_blocks
+        self.is_3d = False
+
+    def forward(self, x):
+        x = x.float()
+        if self.n_last_blocks == 1:
+            return x[:, 0]
+        return tuple(x.unbind(dim=1))
+
+
+@torch.inference_mode()
+def _write_feature_store(encoder, dataset, features_path, targets_path, batch_size, num_workers):
+    data_loader = make_data_loader(
+        dataset=dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        sampler_type=None,
+        shuffle=False,
+        drop_last=False,
+    )
+    features_store = targets_store = None
+    start = 0
+    for images, targets in data_loader:
+        features = encoder(images.cuda(non_blocking=True))
+        if isinstance(features, torch.Tensor):
+            features = (features,)
+        features = torch.stack(features, dim=1).half().cpu().numpy()  # [B, n_last_blocks, num_patches, embed_dim]
+        targets = torch.as_tensor(targets).numpy()
+
+        if features_store is None:
+            features_store = np.lib.format.open_memmap(
+                features_path + ".tmp", mode="w+", dtype=np.float16, shape=(len(dataset), *features.shape[1:])
+            )
+            targets_store = np.lib.format.open_memmap(
+                targets_path + ".tmp", mode="w+", dtype=targets.dtype, shape=(len(dataset), *targets.shape[1:])
+            )
+            logger.info(f"Storing patch tokens of shape {features_store.shape} into {features_path}")
+        features_store[start : start + len(features)] = features
+        targets_store[start : start + len(targets)] = targets
+        start += len(features)
+
+    features_store.flush()
+    targets_store.flush()
+    del features_store, targets_store
+    # only complete stores are picked up by later runs
+    os.replace(targets_path + ".tmp", targets_path)
+    os.replace(features_path + ".tmp", features_path)
+
+
+def _read_metadata(metadata_path):
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path) as f:
+        return json.load(f)
+
+
+def _write_metadata(metadata_path, metadata):
+    with open(metadata_path + ".tmp", "w") as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(metadata_path + ".tmp", metadata_path)
+
+
+def build_feature_store(encoder, dataset, store_dir, name, batch_size, num_workers, augment=False, metadata=None):
+    """
+    Runs the frozen `encoder` once over `dataset` (built with deterministic eval transforms) and returns a
+    `FeatureStoreDataset` over its patch tokens. `metadata` (backbone, pretrained weights, dataset string,
+    image size, ...) is written next to the store, in {name}_metadata.json, and an existing store is only
+    reused when its metadata and length match, otherwise it is recomputed. `augment` is applied when loading
+    the features, it does not change the stored ones.
+    """
+    features_path = os.path.join(store_dir, f"{name}_features.npy")
+    targets_path = os.path.join(store_dir, f"{name}_targets.npy")
+    metadata_path = os.path.join(store_dir, f"{name}_metadata.json")
+    metadata = dict(metadata or {}, n_last_blocks=encoder.n_last_blocks, num_samples=len(dataset))
+
+    exists = os.path.exists(features_path) and os.path.exists(targets_path)
+    if exists and np.load(features_path, mmap_mode="r").shape[:2] != (len(dataset), encoder.n_last_blocks):
+        logger.warning(f"Feature store {features_path} does not match the dataset, recomputing it")
+        exists = False
+    if exists and _read_metadata(metadata_path) != metadata:
+        logger.warning(
+            f"Feature store {features_path} was built with {_read_metadata(metadata_path)}, not {metadata}, "
+            "recomputing it"
+        )
+        exists = False
+    if not exists and distributed.is_main_process():
+        os.makedirs(store_dir, exist_ok=True)
+        if os.path.exists(metadata_path):  # a store interrupted while being rewritten is never picked up
+            os.remove(metadata_path)
+        _write_feature_store(encoder, dataset, features_path, targets_path, batch_size, num_workers)
+        _write_metadata(metadata_path, metadata)
+    if distributed.is_enabled():
+        torch.distributed.barrier()
+    if exists:
+        logger.info(f"Using the feature store {features_path}")
+
+    return FeatureStoreDataset(dataset, features_path, targets_path, augment=augment)
+
+
+def make_feature_store(
+    encoder, dataset, name, dataset_str, store_dir, metadata, batch_size, num_workers, augment=False
+):
+    """`build_feature_store` of the split `name`, keyed by the run `metadata` and by `dataset_str`"""
+    return build_feature_store(
+        encoder,
+        dataset,
+        store_dir=store_dir,
+        name=name,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        augment=augment,
+        metadata=dict(metadata, dataset_str=dataset_str),
+    )
@@ -28,14 +28,19 @@ from dinov2.data import SamplerType, make_data_loader, make_dataset
 from dinov2.data.transforms import (make_classification_eval_transform, make_classification_train_transform,
                                     make_segmentation_train_transforms, make_segmentation_eval_transforms)
 import dinov2.distributed as distributed
-from dinov2.eval.metrics import MetricType, build_metric
+from dinov2.eval.metrics import MetricType, MultiHeadSegmentationMetrics, build_metric
 from dinov2.eval.setup import get_args_parser as get_setup_args_parser
 from dinov2.eval.setup import setup_and_build_model
+from dinov2.eval.backbones import get_backbone_spec, list_backbones
 from dinov2.eval.utils import (extract_hyperparameters_from_model, ModelWithIntermediateLayers, evaluate,
-                                apply_method_to_nested_values, make_datasets, make_data_loaders, collate_fn_3d)
-from dinov2.eval.segmentation.utils import (setup_decoders, LinearPostprocessor, DINOV2Encoder, save_test_results)
+                                apply_method_to_nested_values, make_datasets, make_data_loaders, collate_fn_3d,
+                                SuccessiveHalving)
+from dinov2.eval.segmentation.utils import (setup_decoders, setup_warm_start_decoder, LinearPostprocessor,
+                                            AllDecodersPostprocessor, DINOV2Encoder, save_test_results)
+from dinov2.eval.segmentation.feature_store import StoredFeatureEncoder, make_feature_store
+from dinov2.eval.segmentation.tta import TTA_TRANSFORMS, TTAEngine, evaluate_tta
 from dinov2.logging import MetricLogger
-from dinov2.data.wrappers import FewShotDatasetWrapper
+from dinov2.data.wrappers import FewShotDatasetWrapper, HoldoutSplitWrapper
 
 
 logger = logging.getLogger("dinov2")
@@ -170,7 +175,79 @@ def get_args_parser(
     parser.add_argument(
         "--backbone",
         type=str,
-        help="The name of the backbone model to use [dinov2, vit-large-imagenet21k]",
+        help=f"The name of the backbone model to use {list_backbones()}",
+    )
+    parser.add_argument(
+        "--prune-fraction",
+        type=float,
+        help="Fraction of the remaining decoders to prune at every evaluation (successive halving), 0 to disable",
+    )
+    parser.add_argument(
+        "--min-heads",
+        type=int,
+        help="Minimum number of decoders kept by successive halving",
+    )
+    parser.add_argument(
+        "--retrain-mode",
+        type=str,
+        choices=["full", "warm-start", "holdout"],
+        help="How to use the validation set once the best decoder is selected: retrain it from scratch on "
+        "train + val (full), fine-tune it on val only (warm-start), or train the grid on train + val from the "
+        "start and select on a holdout of val (holdout)",
+    )
+    parser.add_argument(
+        "--warm-start-epochs",
+        type=int,
+        help="Number of epochs on the validation set when warm-starting the best decoder",
+    )
+    parser.add_argument(
+        "--holdout-fraction",
+        type=float,
+        help="Fraction of the validation set held out for selection in holdout mode",
+    )
+    parser.add_argument(
+        "--feature-store-dir",
+        type=str,
+        help="Directory of precomputed fp16 patch tokens to train the decoders on, without running the backbone "
+        "(augmentation is then limited to flips and rotations in feature space)",
+    )
+    parser.add_argument(
+        "--inference-stride",
+        type=int,
+        help="Stride of the sliding windows when saving full-resolution test predictions, half a window by default",
+    )
+    parser.add_argument(
+        "--inference-batch-size",
+        type=int,
+        help="Number of sliding windows sent through the backbone at once when saving test predictions",
+    )
+    parser.add_argument(
+        "--prediction-compression",
+        type=str,
+        choices=["none", "fast", "best"],
+        help="Compression of the saved test predictions: uncompressed .nii, or gzip level 1 (fast) or 9 (best)",
+    )
+    parser.add_argument(
+        "--prediction-writers",
+        type=int,
+        help="Number of background threads writing the test predictions while the next volumes are predicted",
+    )
+    parser.add_argument(
+        "--tta-transforms",
+        nargs="+",
+        choices=list(TTA_TRANSFORMS),
+        help="Test-time augmentations whose predictions are averaged in a final test evaluation",
+    )
+    parser.add_argument(
+        "--ensemble-size",
+        type=int,
+        help="Number of best decoders (on the validation set) averaged in the final test evaluation, "
+        "among the decoders left after training",
+    )
+    parser.add_argument(
+        "--tta-micro-batch-size",
+        type=int,
+        help="Maximum number of augmented views sent through the backbone at once during test-time augmentation",
     )
     parser.set_defaults(
         train_dataset_str="MC:split=TRAIN",
@@ -190,7 +267,20 @@ def get_args_parser(
         shots=None,
         image_size=448,
         loss_function="dice",
-        backbone="dinov2"
+        backbone="dinov2",
+        prune_fraction=0.0,
+        min_heads=1,
+        retrain_mode="full",
+        warm_start_epochs=1,
+        holdout_fraction=0.2,
+        feature_store_dir=None,
+        inference_stride=None,
+        inference_batch_size=16,
+        prediction_compression="fast",
+        prediction_writers=4,
+        tta_transforms=None,
+        ensemble_size=1,
+        tta_micro_batch_size=32,
     )
     return parser
 
@@ -218,8 +308,13 @@ def evaluate_segmentors(
 
     labels = list(data_loader.dataset.class_names)
     metric = build_metric(metric_type, num_classes=num_of_classes, labels=labels)
-    postprocessors = {k: LinearPostprocessor(v) for k, v in decoders.decoders_dict.items()}
-    metrics = {k: metric.clone() for k in decoders.decoders_dict}
+    if metric_type == MetricType.SEGMENTATION_METRICS: # one confusion matrix update for all the decoders
+        postprocessors = {"decoders": AllDecodersPostprocessor(decoders)}
+        metrics = {"decoders": MultiHeadSegmentationMetrics(decoders.decoders_dict.keys(), num_classes=num_of_classes,
+                                                            per_volume=data_loader.dataset.is_3d())}
+    else:
+        postprocessors = {k: LinearPostprocessor(v) for k, v in decoders.decoders_dict.items()}
+        metrics = {k: metric.clone() for k in decoders.decoders_dict}
 
     _, results_dict_temp = evaluate(
         feature_model,
@@ -228,15 +323,19 @@ def evaluate_segmentors(
         metrics,
         torch.cuda.current_device(),
     )
+    if metric_type == MetricType.SEGMENTATION_METRICS:
+        results_dict_temp = results_dict_temp["decoders"]
 
     logger.info("")
     results_dict = {}
     max_score = 0
     best_segmentor = ""
     eval_metric = str(list(metric)[0])
+    scores = {}
 
     for i, (segmentor_string, metric) in enumerate(results_dict_temp.items()):
         logger.info(f"{prefixstring} -- Segmentor: {segmentor_string} * {metric}")
+        scores[segmentor_string] = metric[eval_metric].item()
         if (
             best_segmentor_on_val is None and metric[eval_metric].item() > max_score
         ) or segmentor_string == best_segmentor_on_val:
@@ -257,6 +356,7 @@ def evaluate_segmentors(
                 f.write(json.dumps({k: v}) + "\n")
             f.write("\n")
 
+    results_dict["scores"] = scores
     return results_dict
 
 def eval_decoders(
@@ -278,12 +378,14 @@ def eval_decoders(
     resume=True,
     segmentor_fpath=None,
     is_3d=False,
-    loss_function=DiceLoss()
+    loss_function=DiceLoss(),
+    pruner=None,
 ):
     checkpointer = Checkpointer(decoders, output_dir, optimizer=optimizer, scheduler=scheduler)
     start_iter = checkpointer.resume_or_load(segmentor_fpath or "", resume=resume).get("iteration", 0) + 1
 
     periodic_checkpointer = PeriodicCheckpointer(checkpointer, checkpoint_period, max_iter=max_iter)
+    checkpoint_extras = {"pruned_heads": pruner.pruned} if pruner is not None else {}
     iteration = start_iter
     logger.info("Starting training from iteration {}".format(start_iter))
     metric_logger = MetricLogger(delimiter="  ")
@@ -330,12 +432,12 @@ def eval_decoders(
                 torch.cuda.synchronize()
                 if distributed.is_main_process():
                     logger.info("Checkpointing running_checkpoint")
-                    periodic_checkpointer.save("running_checkpoint_linear_eval", iteration=iteration)
+                    periodic_checkpointer.save("running_checkpoint_linear_eval", iteration=iteration, **checkpoint_extras)
                 torch.cuda.synchronize()
-        periodic_checkpointer.step(iteration)
+        periodic_checkpointer.step(iteration, **checkpoint_extras)
 
         if eval_period > 0 and iteration % eval_period == 0 and iteration != max_iter:
-            _ = evaluate_segmentors(
+            results_dict = evaluate_segmentors(
                 feature_model=feature_model,
                 decoders=remove_ddp_wrapper(decoders),
                 data_loader=val_data_loader,
@@ -345,6 +447,11 @@ def eval_decoders(
                 num_of_classes=num_of_classes,
                 iteration=iteration,
             )
+            if pruner is not None:
+                pruned = pruner.step(remove_ddp_wrapper(decoders).decoders_dict, results_dict["scores"],
+                                     optimizer, scheduler)
+                if pruned and has_ddp_wrapper(decoders):
+                    decoders = DistributedDataParallel(remove_ddp_wrapper(decoders))
             torch.cuda.synchronize()
 
         iteration = iteration + 1
@@ -384,29 +491,89 @@ def run_eval_segmentation(
     shots=None,
     image_size=448,
     loss_function="dice",
-    backbone="dinov2"
+    backbone="dinov2",
+    prune_fraction=0.0,
+    min_heads=1,
+    retrain_mode="full",
+    warm_start_epochs=1,
+    holdout_fraction=0.2,
+    feature_store_dir=None,
+    pretrained_weights=None,
+    inference_stride=None,
+    inference_batch_size=16,
+    prediction_compression="fast",
+    prediction_writers=4,
+    tta_transforms=None,
+    ensemble_size=1,
+    tta_micro_batch_size=32,
 ):
     seed = 0
     torch.manual_seed(seed)
 
     if test_dataset_str == None:
         raise ValueError("Test dataset cannot be None")
-    
+    if feature_store_dir is not None and (tta_transforms is not None or ensemble_size > 1):
+        raise ValueError("Test-time augmentation needs images, it is not supported with feature stores")
+    if ensemble_size > 1 and val_dataset_str is not None and retrain_mode != "holdout":
+        # the grid is replaced by the best decoder retrained on train + val (full) or on val (warm-start)
+        logger.warning(f"Only the retrained decoder is left with retrain mode {retrain_mode}, "
+                       f"the ensemble size {ensemble_size} is ignored")
+        ensemble_size = 1
+
     # make datasets
     train_image_transform, train_target_transform = make_segmentation_train_transforms(resize_size=image_size)
     eval_image_transform, eval_target_transform  = make_segmentation_eval_transforms(resize_size=image_size)
+    if feature_store_dir is not None: # deterministic views, augmented in feature space instead
+        train_image_transform, train_target_transform = eval_image_transform, eval_target_transform
     train_dataset, val_dataset, test_dataset = make_datasets(train_dataset_str=train_dataset_str, val_dataset_str=val_dataset_str,
                                                             test_dataset_str=test_dataset_str, train_transform=train_image_transform,
                                                             eval_transform=eval_image_transform, train_target_transform=train_target_transform,
                                                             eval_target_transform=eval_target_transform)
+    is_3d = test_dataset.is_3d()
+
+    # Define feature model
+    autocast_ctx = partial(torch.cuda.amp.autocast, enabled=True, dtype=autocast_dtype)
+    n_last_blocks = 5 if decoder_type == "unet" else 1 
+    encoder = DINOV2Encoder(model, autocast_ctx=autocast_ctx, n_last_blocks=n_last_blocks, is_3d=is_3d)
+    feature_model = encoder
+
+    store_metadata = {"backbone": backbone, "pretrained_weights": pretrained_weights, "resize_size": image_size}
+    store_kwargs = dict(store_dir=feature_store_dir, metadata=store_metadata, num_workers=num_workers)
+    if feature_store_dir is not None:
+        if is_3d:
+            raise ValueError("Feature stores only support 2D datasets")
+        logger.info(f"Training the decoders on precomputed patch tokens from {feature_store_dir}")
+        train_dataset = make_feature_store(encoder, train_dataset, "train", train_dataset_str, batch_size=batch_size,
+                                           augment=True, **store_kwargs)
+        if val_dataset is not None:
+            val_dataset = make_feature_store(encoder, val_dataset, "val", val_dataset_str, batch_size=batch_size,
+                                             **store_kwargs)
+        test_dataset = make_feature_store(encoder, test_dataset, "test", test_dataset_str, batch_size=batch_size,
+                                          **store_kwargs)
+        feature_model = StoredFeatureEncoder(n_last_blocks)
+
     if shots != None:
         logger.info(f"Running dataset in {shots}-shot setting")
         train_dataset = FewShotDatasetWrapper(train_dataset, shots=shots)
 
+    if retrain_mode == "holdout" and val_dataset is not None:
+        logger.info(f"Training on train + val, selecting on a {holdout_fraction} holdout of the validation set")
+        if shots == None: # If few-shot is enabled, keep training set.
+            val_train_dataset = make_dataset(
+                dataset_str=val_dataset_str,
+                transform=train_image_transform,
+                target_transform=train_target_transform
+            )
+            if feature_store_dir is not None:
+                val_train_dataset = make_feature_store(encoder, val_train_dataset, "val", val_dataset_str,
+                                                       batch_size=batch_size, augment=True, **store_kwargs)
+            val_train_dataset = HoldoutSplitWrapper(val_train_dataset, holdout_fraction, holdout=False, seed=seed)
+            train_dataset = torch.utils.data.ConcatDataset([train_dataset, val_train_dataset])
+        val_dataset = HoldoutSplitWrapper(val_dataset, holdout_fraction, holdout=True, seed=seed)
+
     patch_size = model.patch_size
     batch_size = train_dataset.__len__() if batch_size > train_dataset.__len__() else batch_size
     embed_dim = model.embed_dim
-    is_3d = test_dataset.is_3d()
     collate_fn = None if not is_3d else collate_fn_3d
     num_of_classes = test_dataset.get_num_classes()
     decoders, optim_param_groups = setup_decoders(
@@ -424,11 +591,6 @@ def run_eval_segmentation(
     eval_period_epochs_ = eval_period_epochs * epoch_length
     checkpoint_period = save_checkpoint_frequency * epoch_length
 
-    # Define feature model
-    autocast_ctx = partial(torch.cuda.amp.autocast, enabled=True, dtype=autocast_dtype)
-    n_last_blocks = 5 if decoder_type == "unet" else 1 
-    feature_model = DINOV2Encoder(model, autocast_ctx=autocast_ctx, n_last_blocks=n_last_blocks, is_3d=is_3d)
-
     # Define checkpoint, optimizer, and scheduler
     optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
     if val_epochs is not None:
@@ -437,6 +599,15 @@ def run_eval_segmentation(
         max_iter = epoch_length * epochs 
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
     checkpointer = Checkpointer(decoders, output_dir, optimizer=optimizer, scheduler=scheduler)
+
+    pruner = None
+    if prune_fraction > 0:
+        logger.info(f"Successive halving enabled, pruning {prune_fraction} of the decoders at every evaluation")
+        pruner = SuccessiveHalving(prune_fraction=prune_fraction, min_heads=min_heads)
+        if pruner.restore(checkpointer, remove_ddp_wrapper(decoders).decoders_dict, optimizer, scheduler,
+                          resume=resume) and has_ddp_wrapper(decoders):
+            decoders = DistributedDataParallel(remove_ddp_wrapper(decoders))
+
     start_iter = checkpointer.resume_or_load(segmentor_fpath or "", resume=resume).get("iteration", 0) + 1
     if loss_function == "combined":
         loss_function = DiceCELoss(softmax=True, to_onehot_y=True)
@@ -471,19 +642,47 @@ def run_eval_segmentation(
         resume=resume,
         segmentor_fpath=segmentor_fpath,
         is_3d=is_3d,
-        loss_function=loss_function
+        loss_function=loss_function,
+        pruner=pruner,
     )
+    selection_scores = val_results_dict["scores"]
 
-    if val_dataset != None: # retrain model with validation set.
+    if val_dataset != None and retrain_mode == "holdout": # decoders were trained on train + val, only test the best one.
+        logger.info("Testing the most optimal segmentor selected on the holdout set.")
+        val_results_dict = evaluate_segmentors(
+            feature_model=feature_model,
+            decoders=remove_ddp_wrapper(decoders),
+            data_loader=test_data_loader,
+            metrics_file_path=metrics_file_path,
+            prefixstring=f"ITER: {iteration} {test_data_loader.dataset.split.value}",
+            metric_type=val_metric_type,
+            num_of_classes=num_of_classes,
+            iteration=iteration,
+            best_segmentor_on_val=val_results_dict["best_segmentor"]["name"],
+        )
+    elif val_dataset != None: # retrain model with validation set.
 
         start_iter = 1
+        best_segmentor_name = val_results_dict["best_segmentor"]["name"]
 
-        if shots == None: # If few-shot is enabled, keep training set. 
+        if retrain_mode == "warm-start": # continue from the selected decoder, on the validation data only.
+            train_dataset = make_dataset(
+                dataset_str=val_dataset_str,
+                transform=train_image_transform,
+                target_transform=train_target_transform
+            )
+            if feature_store_dir is not None:
+                train_dataset = make_feature_store(encoder, train_dataset, "val", val_dataset_str,
+                                                   batch_size=batch_size, augment=True, **store_kwargs)
+        elif shots == None: # If few-shot is enabled, keep training set. 
             val_dataset = make_dataset(
                 dataset_str=val_dataset_str,
                 transform=train_image_transform,
                 target_transform=train_target_transform
             )
+            if feature_store_dir is not None:
+                val_dataset = make_feature_store(encoder, val_dataset, "val", val_dataset_str,
+                                                 batch_size=batch_size, augment=True, **store_kwargs)
             train_dataset = torch.utils.data.ConcatDataset([train_dataset, val_dataset])
             logger.info("Retraining model with combined dataset from train and validation")
 
@@ -501,26 +700,35 @@ def run_eval_segmentation(
             sampler_advance=start_iter-1,
             drop_last=False,
             persistent_workers=False,
+            collate_fn=collate_fn
         )
         logger.info("Using the most optimal hp")
-        hyperparameters = extract_hyperparameters_from_model(val_results_dict["best_segmentor"]["name"])
+        hyperparameters = extract_hyperparameters_from_model(best_segmentor_name)
         learning_rate = hyperparameters["lr"]
-      
-        decoders, optim_param_groups = setup_decoders(
-            embed_dim,
-            learning_rate,
-            num_of_classes,
-            decoder_type,
-            is_3d=is_3d,
-            image_size=image_size,
-            patch_size=patch_size
-        )
+
+        if retrain_mode == "warm-start":
+            logger.info(f"Warm-starting the most optimal decoder on the validation set for {warm_start_epochs} epochs.")
+            decoders, optim_param_groups = setup_warm_start_decoder(
+                remove_ddp_wrapper(decoders), best_segmentor_name, learning_rate[0]
+            )
+            retrain_epochs = warm_start_epochs
+        else:
+            decoders, optim_param_groups = setup_decoders(
+                embed_dim,
+                learning_rate,
+                num_of_classes,
+                decoder_type,
+                is_3d=is_3d,
+                image_size=image_size,
+                patch_size=patch_size
+            )
+            retrain_epochs = epochs
 
         output_dir += os.sep + 'optimal'
         os.makedirs(output_dir, exist_ok=True)
 
         optimizer = torch.optim.SGD(optim_param_groups, momentum=0.9, weight_decay=0)
-        max_iter = epochs * epoch_length
+        max_iter = retrain_epochs * epoch_length
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, max_iter, eta_min=0)
         checkpointer = Checkpointer(decoders, output_dir, optimizer=optimizer, scheduler=scheduler)
 
@@ -549,16 +757,35 @@ def run_eval_segmentation(
     results_dict["best_segmentor"] = val_results_dict["best_segmentor"]
     logger.info("Test Results Dict " + str(results_dict))
 
+    if tta_transforms is not None or ensemble_size > 1:
+        trained_decoders = remove_ddp_wrapper(decoders).decoders_dict
+        ensemble = sorted(trained_decoders, key=lambda k: selection_scores.get(k, -1.0), reverse=True)[:ensemble_size]
+        logger.info(f"Test-time augmentation and ensembling of {ensemble}")
+        engine = TTAEngine(encoder, {k: trained_decoders[k] for k in ensemble}, transforms=tta_transforms or ["identity"],
+                           micro_batch_size=tta_micro_batch_size)
+        tta_results, tta_timings = evaluate_tta(engine, test_dataset, num_of_classes, num_workers=num_workers)
+        results_dict["tta"] = {"decoders": ensemble, "results": tta_results, "timings": tta_timings}
+        logger.info(f"Test-time augmentation results: {results_dict['tta']}")
+
     test_dataset_name = test_dataset_str.split(":")[0]
     if test_dataset_name == "BTCV":
-        save_test_results(feature_model=feature_model, 
-                          decoder=decoders.module.decoders_dict[results_dict["best_segmentor"]],
-                          dataset=test_dataset,
-                          output_dir=output_dir)
+        full_resolution_transform, _ = make_segmentation_eval_transforms(resize_size=None)
+        full_resolution_dataset = make_dataset(dataset_str=test_dataset_str, transform=full_resolution_transform)
+        save_test_results(feature_model=encoder, 
+                          decoder=remove_ddp_wrapper(decoders).decoders_dict[results_dict["best_segmentor"]["name"]],
+                          dataset=full_resolution_dataset,
+                          output_dir=output_dir,
+                          window_size=image_size,
+                          stride=inference_stride,
+                          batch_size=inference_batch_size,
+                          compression=prediction_compression,
+                          num_writers=prediction_writers)
 
     return results_dict
 
 def main(args):
+    if not get_backbone_spec(args.backbone).patch_tokens: # fail before loading the backbone weights
+        raise ValueError(f"The {args.backbone} backbone does not provide patch tokens for segmentation")
     model, autocast_dtype = setup_and_build_model(args)
     run = partial(run_eval_segmentation,
         model=model,
@@ -580,7 +807,21 @@ def main(args):
         val_metric_type=args.val_metric_type,
         image_size=args.image_size,
         loss_function=args.loss_function,
-        backbone=args.backbone
+        backbone=args.backbone,
+        prune_fraction=args.prune_fraction,
+        min_heads=args.min_heads,
+        retrain_mode=args.retrain_mode,
+        warm_start_epochs=args.warm_start_epochs,
+        holdout_fraction=args.holdout_fraction,
+        feature_store_dir=args.feature_store_dir,
+        pretrained_weights=args.pretrained_weights,
+        inference_stride=args.inference_stride,
+        inference_batch_size=args.inference_batch_size,
+        prediction_compression=args.prediction_compression,
+        prediction_writers=args.prediction_writers,
+        tta_transforms=args.tta_transforms,
+        ensemble_size=args.ensemble_size,
+        tta_micro_batch_size=args.tta_micro_batch_size,
     )
     if args.shots != None:
         for shot in args.shots:
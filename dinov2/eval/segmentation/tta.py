@@ -0,0 +1,127 @@
+import logging
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import dinov2.distributed as distributed
+from dinov2.eval.metrics import MultiHeadSegmentationMetrics
+from dinov2.eval.utils import Model3DWrapper
+
+
+logger = logging.getLogger("dinov2")
+
+
+# name: (transform of the images, inverse transform of the logits), on [B, C, H, W]
+TTA_TRANSFORMS = {
+    "identity": (lambda x: x, lambda x: x),
+    "hflip": (lambda x: x.flip(-1), lambda x: x.flip(-1)),
+    "vflip": (lambda x: x.flip(-2), lambda x: x.flip(-2)),
+    "rot90": (lambda x: torch.rot90(x, 1, dims=(-2, -1)), lambda x: torch.rot90(x, -1, dims=(-2, -1))),
+    "rot180": (lambda x: torch.rot90(x, 2, dims=(-2, -1)), lambda x: torch.rot90(x, -2, dims=(-2, -1))),
+    "rot270": (lambda x: torch.rot90(x, 3, dims=(-2, -1)), lambda x: torch.rot90(x, -3, dims=(-2, -1))),
+}
+
+
+class TTAEngine(nn.Module):
+    """
+    Test-time augmentation and ensembling of segmentation decoders sharing a backbone. The augmented views of
+    a micro-batch of slices are stacked into a single batch for `encoder` (a `DINOV2Encoder`, only its 2D forward
+    is used), every decoder runs on the same features, the geometric transforms are inverted on the logits, and
+    the views and decoders are fused by averaging their probabilities ("probs") or logits ("logits").
+    At most `micro_batch_size` views go through the backbone at once, whatever the number of slices.
+    """
+
+    FUSIONS = ("probs", "logits")
+
+    def __init__(self, encoder, decoders, transforms=("identity",), micro_batch_size=32, fusion="probs"):
+        super().__init__()
+        for name in transforms:
+            assert name in TTA_TRANSFORMS, f"Unknown test-time augmentation {name}"
+        assert fusion in self.FUSIONS, f"Unknown fusion {fusion}"
+        self.encoder = encoder
+        # slices are batched here, the per-volume wrappers are not needed
+        self.decoders = nn.ModuleDict(
+            {k: v.model if isinstance(v, Model3DWrapper) else v for k, v in decoders.items()}
+        )
+        self.transforms = list(transforms)
+        self.micro_batch_size = micro_batch_size
+        self.fusion = fusion
+
+    @torch.no_grad()
+    def _fuse(self, images):
+        num_images, num_views = images.shape[0], len(self.transforms)
+        views = torch.cat([TTA_TRANSFORMS[name][0](images) for name in self.transforms])
+        features = self.encoder.forward_(views)
+        fused = None
+        for decoder in self.decoders.values():
+            logits = decoder(features).float()
+            if self.fusion == "probs":
+                logits = logits.softmax(dim=1)
+            for i, name in enumerate(self.transforms):
+                view = TTA_TRANSFORMS[name][1](logits[i * num_images : (i + 1) * num_images])
+                fused = view if fused is None else fused + view
+        return fused / (num_views * len(self.decoders))
+
+    def _fuse_micro_batches(self, images):
+        # micro-batches of slices, so that at most `micro_batch_size` views go through the backbone at once
+        chunk_size = max(1, self.micro_batch_size // len(self.transforms))
+        for i in range(0, images.shape[0], chunk_size):
+            yield self._fuse(images[i : i + chunk_size])
+
+    @torch.no_grad()
+    def forward(self, images):
+        """Fused probabilities (or logits) of the slices `images` [S, C, H, W], as [S, num_classes, H, W]"""
+        return torch.cat(list(self._fuse_micro_batches(images)))
+
+    @torch.no_grad()
+    def predict(self, images):
+        """Predicted labels [S, H, W], only the labels of each micro-batch are kept"""
+        return torch.cat([fused.argmax(dim=1) for fused in self._fuse_micro_batches(images)])
+
+
+@torch.no_grad()
+def evaluate_tta(engine, dataset, num_classes, name="tta", num_workers=2):
+    """
+    Evaluates `engine` on `dataset` one volume (or 2D image) at a time, the volumes being split between the
+    processes. Returns the metrics of `MultiHeadSegmentationMetrics` and wall times per volume, in seconds.
+    """
+    is_3d = dataset.is_3d()
+    indices = list(range(distributed.get_global_rank(), len(dataset), distributed.get_global_size()))
+    data_loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices), batch_size=None, num_workers=num_workers
+    )
+    metric = MultiHeadSegmentationMetrics([name], num_classes=num_classes, per_volume=is_3d).cuda()
+
+    volume_times = []
+    num_slices = 0
+    for images, targets in data_loader:
+        images = images.cuda(non_blocking=True)
+        if images.dim() == 3:  # single image
+            images = images.unsqueeze(0)
+        targets = torch.as_tensor(targets).cuda(non_blocking=True)
+
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        preds = engine.predict(images)
+        torch.cuda.synchronize()
+        volume_times.append(time.perf_counter() - start)
+        num_slices += images.shape[0]
+
+        metric.update(preds.unsqueeze(0), targets, volume_sizes=[images.shape[0]] if is_3d else None)
+
+    volume_times = np.array(volume_times)
+    timings = {
+        "mean_volume_time": float(volume_times.mean()),
+        "median_volume_time": float(np.median(volume_times)),
+        "max_volume_time": float(volume_times.max()),
+        "slices_per_second": float(num_slices / volume_times.sum()),
+    }
+    logger.info(
+        f"Test-time augmentation ({', '.join(engine.transforms)}) over {len(engine.decoders)} decoder(s): "
+        f"{timings['mean_volume_time']:.2f}s per volume on average (median {timings['median_volume_time']:.2f}s, "
+        f"max {timings['max_volume_time']:.2f}s), {timings['slices_per_second']:.1f} slices/s"
+    )
+    results = {k: v.item() for k, v in metric.compute()[name].items()}
+    return results, timings
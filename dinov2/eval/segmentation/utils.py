@@ -1,5 +1,7 @@
+import gzip
 import os
-import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import nibabel as nib
 
 import torch
@@ -144,6 +146,34 @@ class LinearPostprocessor(nn.Module):
             "target": targets,
         }
 
+class AllDecodersPostprocessor(nn.Module):
+    """
+    Predicted labels of all the decoders, stacked as [num_decoders, ...], for `MultiHeadSegmentationMetrics`.
+    The targets are concatenated (3D) and moved to the device once per batch instead of once per decoder.
+    """
+    def __init__(self, decoders):
+        super().__init__()
+        self.decoders = decoders
+
+    def forward(self, samples, targets):
+        volume_sizes = None
+        if not isinstance(targets, torch.Tensor): # if 3D targets, keep track of the volume boundaries
+            volume_sizes = [len(volume_targets) for volume_targets in targets]
+            targets = torch.cat(targets, dim=0)
+        targets = targets.cuda(non_blocking=True).type(torch.int64)
+
+        preds = []
+        for logits in self.decoders(samples).values():
+            if isinstance(logits, list) or (isinstance(logits, torch.Tensor) and len(logits.size()) > 4) : # if 3D output
+                logits = torch.cat(logits, dim=0)
+            preds.append(logits.argmax(dim=1))
+
+        return {
+            "preds": torch.stack(preds),
+            "target": targets,
+            "volume_sizes": volume_sizes,
+        }
+
 class AllDecoders(nn.Module):
     def __init__(self, decoders_dict, decoder_type):
         super().__init__()
@@ -186,27 +216,122 @@ def setup_decoders(embed_dim, learning_rates, num_classes=14, decoder_type="line
 
     return decoders, optim_param_groups
 
-def save_test_results(feature_model, decoder, dataset, output_dir):
+def setup_warm_start_decoder(decoders, name, learning_rate):
+    """
+    Keeps only the already trained decoder `name` of the grid, so that the final training can
+    continue from its weights instead of starting from scratch
+    """
+    decoder = decoders.decoders_dict[name]
+    optim_param_groups = [{"params": decoder.parameters(), "lr": learning_rate}]
+
+    decoders = AllDecoders({name: decoder}, decoders.decoder_type)
+    if distributed.is_enabled():
+        decoders = nn.parallel.DistributedDataParallel(decoders)
+
+    return decoders, optim_param_groups
+
+def gaussian_weight_map(window_size, sigma_scale=0.125, device=None):
+    """Importance map of a window, highest at its center, to blend overlapping window predictions"""
+    coords = torch.arange(window_size, dtype=torch.float32, device=device) - (window_size - 1) / 2
+    gaussian_1d = torch.exp(-(coords**2) / (2 * (window_size * sigma_scale) ** 2))
+    weights = torch.outer(gaussian_1d, gaussian_1d)
+    weights = weights / weights.max()
+    return weights.clamp(min=weights[weights > 0].min())
+
+def _window_starts(size, window_size, stride):
+    if size <= window_size:
+        return [0]
+    starts = list(range(0, size - window_size + 1, stride))
+    if starts[-1] != size - window_size: # last window flush with the border
+        starts.append(size - window_size)
+    return starts
+
+@torch.no_grad()
+def sliding_window_inference(images, encoder, decoder, window_size=448, stride=None, batch_size=16, sigma_scale=0.125):
+    """
+    Tiled inference of 2D `images` [B, C, H, W] of any resolution: the images are covered with overlapping
+    `window_size` windows (every `stride` pixels, half a window by default), the windows of all the images are
+    sent through `encoder` and `decoder` by batches of `batch_size`, and their logits are blended with gaussian
+    weights into [B, num_classes, H, W] full-resolution logits. `decoder` must output `window_size` logit maps.
+    """
+    stride = stride or window_size // 2
+    num_images, _, height, width = images.shape
+    pad_h, pad_w = max(window_size - height, 0), max(window_size - width, 0)
+    if pad_h or pad_w: # images smaller than a window
+        images = nn.functional.pad(images, (0, pad_w, 0, pad_h))
+    padded_height, padded_width = images.shape[-2:]
+
+    windows = [
+        (b, y, x)
+        for b in range(num_images)
+        for y in _window_starts(padded_height, window_size, stride)
+        for x in _window_starts(padded_width, window_size, stride)
+    ]
+    weights = gaussian_weight_map(window_size, sigma_scale=sigma_scale, device=images.device)
+    logits = weight_sum = None
+    for i in range(0, len(windows), batch_size):
+        batch_windows = windows[i : i + batch_size]
+        crops = torch.stack([images[b, :, y : y + window_size, x : x + window_size] for b, y, x in batch_windows])
+        window_logits = decoder(encoder(crops)).float()
+        if logits is None:
+            num_classes = window_logits.shape[1]
+            logits = torch.zeros(num_images, num_classes, padded_height, padded_width, device=images.device)
+            weight_sum = torch.zeros(num_images, 1, padded_height, padded_width, device=images.device)
+        for (b, y, x), window_logit in zip(batch_windows, window_logits):
+            logits[b, :, y : y + window_size, x : x + window_size] += window_logit * weights
+            weight_sum[b, :, y : y + window_size, x : x + window_size] += weights
+
+    return (logits / weight_sum)[..., :height, :width]
+
+PREDICTION_COMPRESSIONS = {"none": 0, "fast": 1, "best": 9}
+
+def _write_nifti(nifti_img, path, compresslevel):
+    if compresslevel:
+        with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+            f.write(nifti_img.to_bytes())
+    else:
+        with open(path, "wb") as f:
+            f.write(nifti_img.to_bytes())
+
+def save_test_results(feature_model, decoder, dataset, output_dir, window_size=448, stride=None, batch_size=16,
+                      compression="fast", num_writers=4, num_workers=2):
+    """
+    Saves the predictions of `decoder` on the volumes of `dataset` as NIfTI files, using tiled inference at the
+    resolution of the dataset images. `feature_model` is a `DINOV2Encoder`, only its 2D forward is used.
+    Volumes are loaded by `num_workers` data loader workers and written by a pool of `num_writers` threads while
+    the next volume is predicted, with at most `num_writers` volumes in flight. `compression` is "none" (.nii),
+    "fast" or "best" (gzip level 1 or 9, .gz).
+    """
+    assert compression in PREDICTION_COMPRESSIONS, f"Unknown compression {compression}"
+    compresslevel = PREDICTION_COMPRESSIONS[compression]
     test_results_path = output_dir + os.sep + "test_results" 
-    decoder.resize_image = False
     os.makedirs(test_results_path, exist_ok=True)
-    for i, (img, _) in enumerate(dataset):
+    decoder = decoder.model if isinstance(decoder, Model3DWrapper) else decoder # slices are batched below
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers)
+
+    with ThreadPoolExecutor(max_workers=num_writers) as writers:
+        pending = deque()
+        for i, (img, _) in enumerate(data_loader):
 
-        img_name = dataset.images[i]
-        _, affine_matrix = dataset.get_image_data(i, return_affine_matrix=True)
+            img_name = dataset.images[i]
+            affine_matrix = dataset.get_affine_matrix(i)
 
-        img = img.cuda(non_blocking=True) 
+            img = img.cuda(non_blocking=True) 
+            if img.dim() == 3: # single slice
+                img = img.unsqueeze(0)
 
-        features = feature_model(img.unsqueeze(0))
-        output = decoder(features, up_size=512)[0]
-        output = output.argmax(dim=1)
+            output = sliding_window_inference(img, feature_model.forward_, decoder, window_size=window_size,
+                                              stride=stride, batch_size=batch_size)
+            output = output.argmax(dim=1).to(torch.uint8)
 
-        nifti_img = nib.Nifti1Image(output
-                                    .cpu()
-                                    .numpy()
-                                    .astype(np.uint8)
-                                    .transpose(1, 2, 0), affine_matrix)    
-        file_output_dir = test_results_path + os.sep + img_name + ".gz"
+            nifti_img = nib.Nifti1Image(output
+                                        .cpu()
+                                        .numpy()
+                                        .transpose(1, 2, 0), affine_matrix)    
+            file_output_dir = test_results_path + os.sep + img_name + (".gz" if compresslevel else "")
+            while len(pending) >= num_writers: # bounds the volumes held in memory when writing is the bottleneck
+                pending.popleft().result()
+            pending.append(writers.submit(_write_nifti, nifti_img, file_output_dir, compresslevel))
 
-        # Save the NIfTI image
-        nib.save(nifti_img, file_output_dir)
\ No newline at end of file
+        for future in pending: # re-raises write errors
+            future.result()
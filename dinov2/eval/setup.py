@@ -14,13 +14,12 @@ os.environ["CUDA_VISIBLE_DEVICES"]="0"
 import torch
 import torch.backends.cudnn as cudnn
 
+from dinov2.layers import ATTENTION_BACKENDS, set_attention_backend
 from dinov2.logging import logging
 from dinov2.models import build_model_from_cfg
 from dinov2.utils.config import setup
 import dinov2.utils.utils as dinov2_utils
-from dinov2.eval.utils import (ViTLargeImagenet21k, ResNet152ImageNet1k, VGG19ImageNet1k, DenseNet201ImageNet1k, SAMLarge,
-                               MAEViTLargeImagenet1k, CLIPLarge, OpenCLIPHuge, ViTLargeMSN, BiomedCLIPBase)
-from transformers import ViTForImageClassification
+from dinov2.eval.backbones import DINOV2_BACKBONE, build_backbone, get_backbone_spec
 
 
 logger = logging.getLogger("dinov2")
@@ -51,6 +50,46 @@ def get_args_parser(
         type=str,
         help="Output directory to write results and logs",
     )
+    parser.add_argument(
+        "--truncate-depth",
+        default=None,
+        type=int,
+        help="Keep only the first blocks of a DINOv2 backbone, to evaluate mid-depth features at a lower cost",
+    )
+    parser.add_argument(
+        "--attention-backend",
+        default=None,
+        type=str,
+        choices=ATTENTION_BACKENDS,
+        help="Attention implementation of DINOv2 backbones, xformers if available, otherwise sdpa by default",
+    )
+    parser.add_argument(
+        "--token-merging-ratio",
+        default=None,
+        type=float,
+        help="Fraction of the tokens merged after each block of a DINOv2 backbone (ToMe), to speed up inference",
+    )
+    parser.add_argument(
+        "--patch-drop-threshold",
+        default=None,
+        type=float,
+        help="Leave out the patches whose pixel standard deviation is not above this threshold (constant "
+        "background) from the sequence of a DINOv2 backbone, at inference",
+    )
+    parser.add_argument(
+        "--patch-drop-fill",
+        default="zero",
+        type=str,
+        choices=["zero", "mask_token"],
+        help="Features of the dropped patches in dense outputs: zeros or the learned mask token",
+    )
+    parser.add_argument(
+        "--token-chunk-size",
+        default=None,
+        type=int,
+        help="Process the attention queries and FFN tokens of a DINOv2 backbone by chunks of this many tokens at "
+        "inference, to extract high-resolution features with larger batches",
+    )
     parser.add_argument(
         "--opts",
         help="Extra configuration options",
@@ -70,41 +109,34 @@ def get_autocast_dtype(config):
         return torch.float
 
 
-def build_model_for_eval(config, pretrained_weights, backbone):
-    if backbone == "vit-large-imagenet21k":
-        model = ViTLargeImagenet21k()
-        logger.info("Using vit-large-imagenet21k backbone")
-    elif backbone == "resnet-152-imagenet1k":
-        model = ResNet152ImageNet1k()
-        logger.info("Using resnet-152-imagenet1k backbone")
-    elif backbone == "vgg-19-imagenet1k":
-        model = VGG19ImageNet1k()
-        logger.info("Using vgg-19-imagenet1k backbone")
-    elif backbone == "densenet-201-imagenet1k":
-        model = DenseNet201ImageNet1k()
-        logger.info("Using densenet-201-imagenet1k backbone")
-    elif backbone == "sam-large":
-        model = SAMLarge()
-        logger.info("Using sam-large backbone")
-    elif backbone == "mae-large-imagenet1k":
-        model = MAEViTLargeImagenet1k()
-        logger.info("Using mae-large-imagenet1k backbone")
-    elif backbone == "clip-large":
-        model = CLIPLarge()
-        logger.info("Using clip-large backbone")
-    elif backbone == "openclip-huge":
-        model = OpenCLIPHuge()
-        logger.info("Using openclip-huge backbone")
-    elif backbone == "msn-large-imagenet1k":
-        model = ViTLargeMSN()
-        logger.info("Using msn-large-imagenet1k backbone")
-    elif backbone == "biomedclip-base":
-        model = BiomedCLIPBase()
-        logger.info("Using biomedclip-base backbone")
+def build_model_for_eval(
+    config,
+    pretrained_weights,
+    backbone,
+    truncate_depth=None,
+    token_merging_ratio=None,
+    patch_drop_threshold=None,
+    patch_drop_fill="zero",
+    token_chunk_size=None,
+):
+    if get_backbone_spec(backbone).name != DINOV2_BACKBONE:
+        model = build_backbone(backbone)
     else:
         model, _ = build_model_from_cfg(config, only_teacher=True)
         dinov2_utils.load_pretrained_weights(model, pretrained_weights, "teacher")
         logger.info("Using DINOv2 backbone")
+        if truncate_depth is not None:
+            model = model.truncated(truncate_depth)
+            logger.info(f"Keeping the first {truncate_depth} blocks of the backbone")
+        if token_merging_ratio is not None:
+            model.set_token_merging(token_merging_ratio)
+            logger.info(f"Merging {token_merging_ratio} of the tokens after each block")
+        if patch_drop_threshold is not None:
+            model.set_patch_dropping(patch_drop_threshold, fill=patch_drop_fill)
+            logger.info(f"Dropping the patches with a standard deviation below {patch_drop_threshold}")
+        if token_chunk_size is not None:
+            model.set_token_chunking(token_chunk_size)
+            logger.info(f"Processing the tokens by chunks of {token_chunk_size} at inference")
     model.eval()
     model.cuda()
     return model
@@ -113,6 +145,17 @@ def build_model_for_eval(config, pretrained_weights, backbone):
 def setup_and_build_model(args) -> Tuple[Any, torch.dtype]:
     cudnn.benchmark = True
     config = setup(args)
-    model = build_model_for_eval(config, args.pretrained_weights, args.backbone)
+    if args.attention_backend is not None:
+        set_attention_backend(args.attention_backend)
+    model = build_model_for_eval(
+        config,
+        args.pretrained_weights,
+        args.backbone,
+        truncate_depth=args.truncate_depth,
+        token_merging_ratio=args.token_merging_ratio,
+        patch_drop_threshold=args.patch_drop_threshold,
+        patch_drop_fill=args.patch_drop_fill,
+        token_chunk_size=args.token_chunk_size,
+    )
     autocast_dtype = get_autocast_dtype(config)
     return model, autocast_dtype
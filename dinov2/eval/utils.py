@@ -5,17 +5,11 @@
 # LICENSE file in the root directory of this source tree.
 
 import logging
+from abc import ABC, abstractmethod
 from typing import Dict, Optional
 from builtins import range
 
-from sklearn.neighbors import NearestNeighbors
-from skmultilearn.base import MLClassifierBase
-from skmultilearn.utils import get_matrix_in_format
-from transformers import ViTForImageClassification, SamModel, CLIPModel, ViTMSNModel
-from open_clip import create_model_from_pretrained, get_tokenizer
 import ast
-import numpy as np
-import scipy.sparse as sparse
 
 import torch
 from torch import nn
@@ -57,150 +51,128 @@ class ModelWithNormalize(torch.nn.Module):
     def forward(self, samples):
         return nn.functional.normalize(self.model(samples), dim=1, p=2)
     
-class ViTLargeImagenet21k(nn.Module):
-    def __init__(self):
+class HFViTBackbone(nn.Module, ABC):
+    """
+    Base of the Hugging Face ViT wrappers. Subclasses implement `_embed` (patch + position embeddings) and
+    `_blocks` (the transformer layers), the hidden states are computed block by block so that only the
+    requested layers are kept and the blocks after the deepest requested layer are not run at all.
+    Subclasses import transformers in their constructor, so that importing this module (and every data loader
+    worker doing so) does not pay for it.
+    """
+
+    def __init__(self, embed_dim, patch_size):
         super().__init__()
-        self.model = ViTForImageClassification.from_pretrained('google/vit-large-patch16-224')
-        self.embed_dim = 1024
-        self.patch_size = 16
+        self.embed_dim = embed_dim
+        self.patch_size = patch_size
         self.norm = nn.LayerNorm(self.embed_dim, eps=1e-6)
 
-    def forward(self, x):
-        output = self.model.forward(x, output_hidden_states=True)
-        cls = output.hidden_states[-1][:, 0]
-        return cls
-    
-    def forward_features(self, x, masks=None):
-        
-        layer_features = self.model.forward(x, output_hidden_states=True)
+    @abstractmethod
+    def _embed(self, x):
+        pass
+
+    @abstractmethod
+    def _blocks(self):
+        pass
 
-        patch_tokens = layer_features.hidden_states[-1]
-        patch_tokens = patch_tokens[:, 1:]
+    def _run_block(self, block, x):
+        output = block(x)
+        return output[0] if isinstance(output, tuple) else output
 
+    def _get_layers(self, x, layers):
+        # layers: indices of the hidden states to return, 0 is the output of the embeddings
+        x = self._embed(x)
+        outputs = {0: x} if 0 in layers else {}
+        for i, block in enumerate(self._blocks()[: max(layers)], start=1):
+            x = self._run_block(block, x)
+            if i in layers:
+                outputs[i] = x
+        return [outputs[i] for i in layers]
+
+    def forward(self, x):
+        return self._get_layers(x, [len(self._blocks())])[0][:, 0]
 
-        x_norm_patch = self.norm(patch_tokens)
+    def forward_features(self, x, masks=None):
+        patch_tokens = self._get_layers(x, [len(self._blocks())])[0][:, 1:]
         return {
-            "x_norm_patchtokens": x_norm_patch,
+            "x_norm_patchtokens": self.norm(patch_tokens),
         }
-    
+
     def get_intermediate_layers(self, x, n_last_blocks, return_class_token=True):
-        layer_features = self.model.forward(x, output_hidden_states=True)
-        outputs = layer_features.hidden_states[-n_last_blocks: ]
+        # n_last_blocks: number of last blocks, or indices of the blocks to take (as DinoVisionTransformer)
+        num_blocks = len(self._blocks())
+        if isinstance(n_last_blocks, int):
+            layers = list(range(num_blocks - n_last_blocks + 1, num_blocks + 1))
+        else:
+            layers = [i + 1 for i in n_last_blocks]
+        outputs = self._get_layers(x, layers)
         class_tokens = [out[:, 0] for out in outputs]
         outputs = [out[:, 1:] for out in outputs]
         if return_class_token:
             return tuple(zip(outputs, class_tokens))
         return tuple(outputs)
-    
-class ViTLargeMSN(nn.Module):
+
+
+class ViTLargeImagenet21k(HFViTBackbone):
     def __init__(self):
-        super().__init__()
+        super().__init__(embed_dim=1024, patch_size=16)
+        from transformers import ViTForImageClassification
+
+        self.model = ViTForImageClassification.from_pretrained('google/vit-large-patch16-224')
+
+    def _embed(self, x):
+        return self.model.vit.embeddings(x)
+
+    def _blocks(self):
+        return self.model.vit.encoder.layer
+
+
+class ViTLargeMSN(HFViTBackbone):
+    def __init__(self):
+        super().__init__(embed_dim=1024, patch_size=16)
+        from transformers import ViTMSNModel
+
         self.model = ViTMSNModel.from_pretrained("facebook/vit-msn-large")
-        self.embed_dim = 1024
-        self.patch_size = 16
-        self.norm = nn.LayerNorm(self.embed_dim, eps=1e-6)
 
-    def forward(self, x):
-        output = self.model.forward(x, output_hidden_states=True)
-        cls = output.hidden_states[-1][:, 0]
-        return cls
-    
-    def forward_features(self, x, masks=None):
-        
-        layer_features = self.model.forward(x, output_hidden_states=True)
+    def _embed(self, x):
+        return self.model.embeddings(x)
 
-        patch_tokens = layer_features.hidden_states[-1]
-        patch_tokens = patch_tokens[:, 1:]
+    def _blocks(self):
+        return self.model.encoder.layer
 
 
-        x_norm_patch = self.norm(patch_tokens)
-        return {
-            "x_norm_patchtokens": x_norm_patch,
-        }
-    
-    def get_intermediate_layers(self, x, n_last_blocks, return_class_token=True):
-        layer_features = self.model.forward(x, output_hidden_states=True)
-        outputs = layer_features.hidden_states[-n_last_blocks: ]
-        class_tokens = [out[:, 0] for out in outputs]
-        outputs = [out[:, 1:] for out in outputs]
-        if return_class_token:
-            return tuple(zip(outputs, class_tokens))
-        return tuple(outputs)
+class HFCLIPVisionBackbone(HFViTBackbone):
+    def __init__(self, model_name, embed_dim):
+        super().__init__(embed_dim=embed_dim, patch_size=14)
+        from transformers import CLIPModel
 
+        self.model = CLIPModel.from_pretrained(model_name).vision_model
 
-class CLIPLarge(nn.Module):
-    def __init__(self):
-        super().__init__()
-        self.model = CLIPModel.from_pretrained('openai/clip-vit-large-patch14')
-        self.model = self.model.vision_model
-        self.embed_dim = 1024
-        self.patch_size = 14
-        self.norm = nn.LayerNorm(self.embed_dim, eps=1e-6)
+    def _embed(self, x):
+        return self.model.pre_layrnorm(self.model.embeddings(x))
 
-    def forward(self, x):
-        output = self.model.forward(x, output_hidden_states=True)
-        cls = output.hidden_states[-1][:, 0]
-        return cls
-    
-    def forward_features(self, x, masks=None):
-        
-        layer_features = self.model.forward(x, output_hidden_states=True)
+    def _blocks(self):
+        return self.model.encoder.layers
 
-        patch_tokens = layer_features.hidden_states[-1]
-        patch_tokens = patch_tokens[:, 1:]
+    def _run_block(self, block, x):
+        output = block(x, None, None)  # no attention masks
+        return output[0] if isinstance(output, tuple) else output
 
-        x_norm_patch = self.norm(patch_tokens)
-        return {
-            "x_norm_patchtokens": x_norm_patch,
-        }
-    
-    def get_intermediate_layers(self, x, n_last_blocks, return_class_token=True):
-        layer_features = self.model.forward(x, output_hidden_states=True)
-        outputs = layer_features.hidden_states[-n_last_blocks: ]
-        class_tokens = [out[:, 0] for out in outputs]
-        outputs = [out[:, 1:] for out in outputs]
-        if return_class_token:
-            return tuple(zip(outputs, class_tokens))
-        return tuple(outputs)
 
-class OpenCLIPHuge(nn.Module):
+class CLIPLarge(HFCLIPVisionBackbone):
     def __init__(self):
-        super().__init__()
-        self.model = CLIPModel.from_pretrained('laion/CLIP-ViT-H-14-laion2B-s32B-b79K')
-        self.model = self.model.vision_model
-        self.embed_dim = 1280
-        self.patch_size = 14
-        self.norm = nn.LayerNorm(self.embed_dim, eps=1e-6)
+        super().__init__('openai/clip-vit-large-patch14', embed_dim=1024)
 
-    def forward(self, x):
-        output = self.model.forward(x, output_hidden_states=True)
-        cls = output.hidden_states[-1][:, 0]
-        return cls
-    
-    def forward_features(self, x, masks=None):
-        
-        layer_features = self.model.forward(x, output_hidden_states=True)
 
-        patch_tokens = layer_features.hidden_states[-1]
-        patch_tokens = patch_tokens[:, 1:]
+class OpenCLIPHuge(HFCLIPVisionBackbone):
+    def __init__(self):
+        super().__init__('laion/CLIP-ViT-H-14-laion2B-s32B-b79K', embed_dim=1280)
 
-        x_norm_patch = self.norm(patch_tokens)
-        return {
-            "x_norm_patchtokens": x_norm_patch,
-        }
-    
-    def get_intermediate_layers(self, x, n_last_blocks, return_class_token=True):
-        layer_features = self.model.forward(x, output_hidden_states=True)
-        outputs = layer_features.hidden_states[-n_last_blocks: ]
-        class_tokens = [out[:, 0] for out in outputs]
-        outputs = [out[:, 1:] for out in outputs]
-        if return_class_token:
-            return tuple(zip(outputs, class_tokens))
-        return tuple(outputs)
 
 class BiomedCLIPBase(nn.Module):
     def __init__(self):
         super().__init__()
+        from open_clip import create_model_from_pretrained
+
         self.model, _ = create_model_from_pretrained('hf-hub:microsoft/BiomedCLIP-PubMedBERT_256-vit_base_patch16_224')
         self.model = self.model.visual
         self.embed_dim = 512
@@ -214,40 +186,19 @@ class BiomedCLIPBase(nn.Module):
         outputs = self.model(x)
         return [(None, outputs)]
 
-class MAEViTLargeImagenet1k(nn.Module):
+class MAEViTLargeImagenet1k(HFViTBackbone):
     def __init__(self):
-        super().__init__()
+        super().__init__(embed_dim=1024, patch_size=16)
+        from transformers import ViTForImageClassification
+
         self.model = ViTForImageClassification.from_pretrained('facebook/vit-mae-large')
-        self.embed_dim = 1024
-        self.patch_size = 16
-        self.norm = nn.LayerNorm(self.embed_dim, eps=1e-6)
 
-    def forward(self, x):
-        output = self.model.forward(x, output_hidden_states=True)
-        cls = output.hidden_states[-1][:, 0]
-        return cls
-    
-    def forward_features(self, x, masks=None):
-        
-        layer_features = self.model.forward(x, output_hidden_states=True)
+    def _embed(self, x):
+        return self.model.vit.embeddings(x)
 
-        patch_tokens = layer_features.hidden_states[-1]
-        patch_tokens = patch_tokens[:, 1:]
+    def _blocks(self):
+        return self.model.vit.encoder.layer
 
-        x_norm_patch = self.norm(patch_tokens)
-        return {
-            "x_norm_patchtokens": x_norm_patch,
-        }
-    
-    def get_intermediate_layers(self, x, n_last_blocks, return_class_token=True):
-        layer_features = self.model.forward(x, output_hidden_states=True)
-        outputs = layer_features.hidden_states[-n_last_blocks: ]
-        class_tokens = [out[:, 0] for out in outputs]
-        outputs = [out[:, 1:] for out in outputs]
-        if return_class_token:
-            return tuple(zip(outputs, class_tokens))
-        return tuple(outputs)
-    
 class ResNet152ImageNet1k(nn.Module):
     def __init__(self):
         super().__init__()
@@ -265,6 +216,8 @@ class ResNet152ImageNet1k(nn.Module):
 class SAMLarge(nn.Module):
     def __init__(self):
         super().__init__()
+        from transformers import SamModel
+
         self.model = SamModel.from_pretrained("facebook/sam-vit-large")
         self.model = self.model.vision_encoder
         self.model.neck = torch.nn.Identity()
@@ -453,8 +406,15 @@ def extract_features_with_dataloader(model, data_loader, sample_count, gather_on
     return features, all_labels
 
 
-class MLkNN(MLClassifierBase):
+class MLkNN:
     """kNN classification method adapted for multi-label classification
+
+    Dense torch implementation: the train features, labels and the prior/conditional tables stay on the
+    device of the train features, test queries are processed in batches of `batch_size` against the
+    whole train set (cosine similarity on L2-normalized features), and outputs are preallocated.
+    If an approximate `index` (see dinov2.eval.classification.ann.IVFIndex) is given, neighbours are
+    searched in it instead of brute-force; it is built on the train features if it is not trained yet.
+
     References
     ----------
     If you use this classifier please cite the original paper introducing the method:
@@ -473,126 +433,79 @@ class MLkNN(MLClassifierBase):
 
     """
 
-    def __init__(self, k=10, s=1.0, ignore_first_neighbours=0, n_jobs=None, metric="cosine"):
-        super(MLkNN, self).__init__()
+    def __init__(self, k=10, s=1.0, ignore_first_neighbours=0, batch_size=1024, index=None):
         self.k = k  # Number of neighbours
         self.s = s  # Smooth parameter
         self.ignore_first_neighbours = ignore_first_neighbours
-        self.n_jobs = n_jobs
-        self.knn_ = NearestNeighbors(n_neighbors=self.k, metric=metric)
-        self.copyable_attrs = ["k", "s", "ignore_first_neighbours", "n_jobs"]
+        self.batch_size = batch_size
+        self.index = index
+
+    def _kneighbors(self, X):
+        X = nn.functional.normalize(X.to(self._train_features), dim=1, p=2)
+        for start in range(0, X.shape[0], self.batch_size):
+            if self.index is not None:
+                _, indices = self.index.search(X[start : start + self.batch_size], self.k + self.ignore_first_neighbours)
+                indices = indices.clamp(min=0)  # lists with less than k candidates
+            else:
+                similarity = torch.mm(X[start : start + self.batch_size], self._train_features.T)
+                indices = similarity.topk(self.k + self.ignore_first_neighbours, dim=1, largest=True, sorted=True).indices
+            yield start, indices[:, self.ignore_first_neighbours :]
+
+    def _deltas(self, neighbors):
+        # number of neighbours carrying each label, [B, num_labels] in [0, k]
+        return self._labels[neighbors].sum(dim=1).long()
 
     def _compute_prior(self, y):
-        prior_prob_true = np.array(
-            (self.s + y.sum(axis=0)) / (self.s * 2 + self._num_instances)
-        )[0]
+        prior_prob_true = (self.s + y.sum(dim=0)) / (self.s * 2 + self._num_instances)
         prior_prob_false = 1 - prior_prob_true
 
         return (prior_prob_true, prior_prob_false)
 
     def _compute_cond(self, X, y):
-        self.knn_.fit(X)
-        c = sparse.lil_matrix((self._num_labels, self.k + 1), dtype="i8")
-        cn = sparse.lil_matrix((self._num_labels, self.k + 1), dtype="i8")
-
-        label_info = get_matrix_in_format(y, "dok")
-
-        neighbors = [
-            a[self.ignore_first_neighbours :]
-            for a in self.knn_.kneighbors(
-                X, self.k + self.ignore_first_neighbours, return_distance=False
-            )
-        ]
-
-        for instance in range(self._num_instances):
-            deltas = label_info[neighbors[instance], :].sum(axis=0)
-            for label in range(self._num_labels):
-                if label_info[instance, label] == 1:
-                    c[label, deltas[0, label]] += 1
-                else:
-                    cn[label, deltas[0, label]] += 1
-
-        c_sum = c.sum(axis=1)
-        cn_sum = cn.sum(axis=1)
-
-        cond_prob_true = sparse.lil_matrix(
-            (self._num_labels, self.k + 1), dtype="float"
-        )
-        cond_prob_false = sparse.lil_matrix(
-            (self._num_labels, self.k + 1), dtype="float"
-        )
-        for label in range(self._num_labels):
-            for neighbor in range(self.k + 1):
-                cond_prob_true[label, neighbor] = (self.s + c[label, neighbor]) / (
-                    self.s * (self.k + 1) + c_sum[label, 0]
-                )
-                cond_prob_false[label, neighbor] = (self.s + cn[label, neighbor]) / (
-                    self.s * (self.k + 1) + cn_sum[label, 0]
-                )
+        device = self._train_features.device
+        c = torch.zeros(self._num_labels * (self.k + 1), device=device)
+        cn = torch.zeros(self._num_labels * (self.k + 1), device=device)
+        label_offsets = torch.arange(self._num_labels, device=device) * (self.k + 1)
+
+        for start, neighbors in self._kneighbors(X):
+            deltas = self._deltas(neighbors)
+            flat_indices = deltas + label_offsets
+            has_label = y[start : start + deltas.shape[0]] > 0
+            c.index_add_(0, flat_indices[has_label], torch.ones_like(flat_indices[has_label], dtype=c.dtype))
+            cn.index_add_(0, flat_indices[~has_label], torch.ones_like(flat_indices[~has_label], dtype=cn.dtype))
+
+        c = c.view(self._num_labels, self.k + 1)
+        cn = cn.view(self._num_labels, self.k + 1)
+        cond_prob_true = (self.s + c) / (self.s * (self.k + 1) + c.sum(dim=1, keepdim=True))
+        cond_prob_false = (self.s + cn) / (self.s * (self.k + 1) + cn.sum(dim=1, keepdim=True))
         return cond_prob_true, cond_prob_false
 
     def fit(self, X, y):
-        self._label_cache = get_matrix_in_format(y, "lil")
-        self._num_instances = self._label_cache.shape[0]
-        self._num_labels = self._label_cache.shape[1]
+        self._train_features = nn.functional.normalize(X.float(), dim=1, p=2)
+        if self.index is not None and not self.index.is_trained:
+            self.index.train(self._train_features).add(self._train_features)
+        self._labels = y.to(self._train_features.device).float()
+        self._num_instances, self._num_labels = self._labels.shape
         # Computing the prior probabilities
-        self._prior_prob_true, self._prior_prob_false = self._compute_prior(
-            self._label_cache
-        )
+        self._prior_prob_true, self._prior_prob_false = self._compute_prior(self._labels)
         # Computing the posterior probabilities
-        self._cond_prob_true, self._cond_prob_false = self._compute_cond(
-            X, self._label_cache
-        )
+        self._cond_prob_true, self._cond_prob_false = self._compute_cond(X, self._labels)
         return self
 
-    def predict(self, X):
-        result = sparse.lil_matrix((X.shape[0], self._num_labels), dtype="i8")
-        neighbors = [
-            a[self.ignore_first_neighbours :]
-            for a in self.knn_.kneighbors(
-                X, self.k + self.ignore_first_neighbours, return_distance=False
-            )
-        ]
-        for instance in range(X.shape[0]):
-            deltas = self._label_cache[neighbors[instance],].sum(axis=0)
-
-            for label in range(self._num_labels):
-                p_true = (
-                    self._prior_prob_true[label]
-                    * self._cond_prob_true[label, deltas[0, label]]
-                )
-                p_false = (
-                    self._prior_prob_false[label]
-                    * self._cond_prob_false[label, deltas[0, label]]
-                )
-                result[instance, label] = int(p_true >= p_false)
+    def predict_proba(self, X):
+        result = torch.empty(X.shape[0], self._num_labels, device=self._train_features.device)
+        label_indices = torch.arange(self._num_labels, device=self._train_features.device).unsqueeze(0)
+        for start, neighbors in self._kneighbors(X):
+            deltas = self._deltas(neighbors)
+            p_true = self._prior_prob_true * self._cond_prob_true[label_indices, deltas]
+            p_false = self._prior_prob_false * self._cond_prob_false[label_indices, deltas]
+            result[start : start + deltas.shape[0]] = p_true / (p_true + p_false)
 
         return result
 
-    def predict_proba(self, X):
-        result = sparse.lil_matrix((X.shape[0], self._num_labels), dtype="float")
-        neighbors = [
-            a[self.ignore_first_neighbours :]
-            for a in self.knn_.kneighbors(
-                X, self.k + self.ignore_first_neighbours, return_distance=False
-            )
-        ]
-        for instance in range(X.shape[0]):
-            deltas = self._label_cache[neighbors[instance],].sum(axis=0)
-
-            for label in range(self._num_labels):
-                p_true = (
-                    self._prior_prob_true[label]
-                    * self._cond_prob_true[label, deltas[0, label]]
-                )
-                p_false = (
-                    self._prior_prob_false[label]
-                    * self._cond_prob_false[label, deltas[0, label]]
-                )
-                result[instance, label] = p_true / (p_true + p_false)
+    def predict(self, X):
+        return (self.predict_proba(X) >= 0.5).long()
 
-        return result
-    
 def apply_method_to_nested_values(d, method_name, nested_types=(dict)):
     result = {}
     for key, value in d.items():
@@ -689,6 +602,68 @@ def extract_hyperparameters_from_model(segmentor):
             hyperparameters[key] = [value]
     return hyperparameters
 
+def prune_heads(heads, names, optimizer, scheduler=None):
+    """
+    Removes the heads in `names` from the ModuleDict `heads`, along with their optimizer
+    param groups (and optimizer state), keeping the scheduler base lrs aligned with the groups.
+    """
+    names = [name for name in names if name in heads]
+    if len(names) == 0:
+        return []
+    pruned_params = {id(p) for name in names for p in heads[name].parameters()}
+    keep = []
+    for i, group in enumerate(optimizer.param_groups):
+        if any(id(p) in pruned_params for p in group["params"]):
+            for p in group["params"]:
+                optimizer.state.pop(p, None)
+        else:
+            keep.append(i)
+    optimizer.param_groups = [optimizer.param_groups[i] for i in keep]
+    if scheduler is not None:
+        scheduler.base_lrs = [scheduler.base_lrs[i] for i in keep]
+        if hasattr(scheduler, "_last_lr"):
+            scheduler._last_lr = [scheduler._last_lr[i] for i in keep]
+    for name in names:
+        del heads[name]
+    return names
+
+class SuccessiveHalving:
+    """
+    Successive-halving over a grid of heads (AllClassifiers / AllDecoders): at every evaluation,
+    the bottom `prune_fraction` of the remaining heads by validation score are removed from the
+    module dict and the optimizer, so that only the promising configurations keep training.
+    """
+
+    def __init__(self, prune_fraction=0.5, min_heads=1):
+        assert 0.0 < prune_fraction < 1.0, "prune_fraction must be in (0, 1)"
+        self.prune_fraction = prune_fraction
+        self.min_heads = max(min_heads, 1)
+        self.pruned = []
+
+    def select(self, scores):
+        n_prune = min(int(len(scores) * self.prune_fraction), len(scores) - self.min_heads)
+        if n_prune <= 0:
+            return []
+        ranked = sorted(scores, key=lambda name: scores[name])
+        return ranked[:n_prune]
+
+    def step(self, heads, scores, optimizer, scheduler=None):
+        names = prune_heads(heads, self.select(scores), optimizer, scheduler)
+        self.pruned += names
+        for name in names:
+            logger.info(f"Successive halving: pruned {name} (score {scores[name]:.4f})")
+        logger.info(f"Successive halving: {len(heads)} heads remaining")
+        return names
+
+    def restore(self, checkpointer, heads, optimizer, scheduler=None, resume=True):
+        """Re-applies the pruning recorded in the last checkpoint so that it can be resumed from"""
+        if not (resume and checkpointer.has_checkpoint()):
+            return []
+        checkpoint = torch.load(checkpointer.get_checkpoint_file(), map_location="cpu")
+        names = prune_heads(heads, checkpoint.get("pruned_heads", []), optimizer, scheduler)
+        self.pruned += names
+        return names
+
 def collate_fn_3d(batch):
     # batch is a list of tuples where each tuple is (video, label)
     videos, labels = zip(*batch)
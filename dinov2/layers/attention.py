@@ -9,7 +9,10 @@
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/models/vision_transformer.py
 
 import logging
+import os
+from typing import List, Optional
 
+import torch
 from torch import Tensor
 from torch import nn
 
@@ -25,6 +28,106 @@ except ImportError:
     logger.warning("xFormers not available")
     XFORMERS_AVAILABLE = False
 
+SDPA_AVAILABLE = hasattr(nn.functional, "scaled_dot_product_attention")
+
+# "xformers": memory_efficient_attention (CUDA only, CPU inputs use "sdpa")
+# "sdpa": torch.nn.functional.scaled_dot_product_attention (flash / memory-efficient kernels when available)
+# "math": explicit softmax(q @ k.T) @ v, materializing the N x N attention matrix
+ATTENTION_BACKENDS = ("xformers", "sdpa", "math")
+
+
+def _default_attention_backend() -> str:
+    backend = os.environ.get("DINOV2_ATTENTION_BACKEND")
+    if backend is not None:
+        assert backend in ATTENTION_BACKENDS, f"Unknown attention backend {backend}"
+        return backend
+    if XFORMERS_AVAILABLE:
+        return "xformers"
+    return "sdpa" if SDPA_AVAILABLE else "math"
+
+
+_attention_backend = _default_attention_backend()
+
+
+def set_attention_backend(backend: str) -> None:
+    global _attention_backend
+    assert backend in ATTENTION_BACKENDS, f"Unknown attention backend {backend}"
+    assert backend != "xformers" or XFORMERS_AVAILABLE, "xFormers is not available"
+    assert backend != "sdpa" or SDPA_AVAILABLE, "scaled_dot_product_attention requires torch >= 2.0"
+    _attention_backend = backend
+    logger.info(f"Using the {backend} attention backend")
+
+
+def get_attention_backend() -> str:
+    return _attention_backend
+
+
+class BlockDiagonalMask:
+    """
+    Stand-in for xFormers' `fmha.BlockDiagonalMask` when another backend runs nested tensors: the sequences
+    of lengths `seqlens` are concatenated along dim 1 of a [1, sum(seqlens), C] tensor and only attend to
+    themselves. The attention is computed on each run of equal-length sequences stacked as a batch, which is
+    the block-diagonal mask without materializing it.
+    """
+
+    def __init__(self, seqlens: List[int]) -> None:
+        self.seqlens = list(seqlens)
+        self._batch_sizes: Optional[List[int]] = None
+        self.runs = []  # (number of sequences, sequence length)
+        for seqlen in self.seqlens:
+            if self.runs and self.runs[-1][1] == seqlen:
+                self.runs[-1] = (self.runs[-1][0] + 1, seqlen)
+            else:
+                self.runs.append((1, seqlen))
+
+    @classmethod
+    def from_seqlens(cls, seqlens: List[int]) -> "BlockDiagonalMask":
+        return cls(seqlens)
+
+    @classmethod
+    def from_tensor_list(cls, tensors: List[Tensor]):
+        """Mask of the sequences of the [batch_size, seqlen, ...] `tensors`, and their concatenation along dim 1"""
+        seqlens = [x.shape[1] for x in tensors for _ in range(x.shape[0])]
+        attn_bias = cls(seqlens)
+        attn_bias._batch_sizes = [x.shape[0] for x in tensors]
+        return attn_bias, torch.cat([x.reshape(1, -1, *x.shape[2:]) for x in tensors], dim=1)
+
+    def split_runs(self, x: Tensor) -> List[Tensor]:
+        # [1, sum(seqlens), ...] -> [num_sequences, seqlen, ...] for each run
+        chunks = x.split([count * seqlen for count, seqlen in self.runs], dim=1)
+        return [chunk.reshape(count, seqlen, *x.shape[2:]) for chunk, (count, seqlen) in zip(chunks, self.runs)]
+
+    def split(self, x: Tensor) -> List[Tensor]:
+        """Splits the concatenated [1, sum(seqlens), ...] tensor back into [batch_size, seqlen, ...] tensors"""
+        assert self._batch_sizes is not None, "split needs the batch sizes of the concatenated tensors"
+        seqlens, start = [], 0
+        for batch_size in self._batch_sizes:
+            seqlens.append(self.seqlens[start])
+            start += batch_size
+        chunks = x.split([b * seqlen for b, seqlen in zip(self._batch_sizes, seqlens)], dim=1)
+        return [chunk.reshape(b, seqlen, *x.shape[2:]) for chunk, b, seqlen in zip(chunks, self._batch_sizes, seqlens)]
+
+
+class PackedSequenceMask:
+    """
+    Attention bias of sequences packed into the rows of a dense [num_rows, row_length, C] tensor (see
+    dinov2.layers.packing): `mask` [num_rows, 1, row_length, row_length] is True where a query and a key belong
+    to the same sequence (padding tokens only attend to themselves), which both the "sdpa" and "math" backends
+    take as an attention mask. `token_sequence` [num_rows * row_length] is the sequence of every token, padding
+    tokens having the index `num_sequences`.
+    """
+
+    def __init__(self, mask: Tensor, token_sequence: Tensor, num_sequences: int) -> None:
+        self.mask = mask
+        self.token_sequence = token_sequence
+        self.num_sequences = num_sequences
+
+    def drop_path(self, x: Tensor, drop_prob: float) -> Tensor:
+        """Stochastic depth of the residual `x` [num_rows, row_length, C], with one draw per packed sequence"""
+        keep_prob = 1 - drop_prob
+        keep = x.new_empty(self.num_sequences + 1).bernoulli_(keep_prob).div_(keep_prob)
+        return x * keep[self.token_sequence].view(*x.shape[:2], 1)
+
 
 class Attention(nn.Module):
     def __init__(
@@ -45,18 +148,44 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim, bias=proj_bias)
         self.proj_drop = nn.Dropout(proj_drop)
+        self.query_chunk_size = None  # inference only, see Block.set_token_chunking
+
+    def _attention(self, q: Tensor, k: Tensor, v: Tensor, backend: str, attn_mask: Optional[Tensor] = None) -> Tensor:
+        # q, k, v: [B, num_heads, N, head_dim], attn_mask: boolean, True where the query attends to the key
+        if backend == "sdpa":
+            dropout_p = self.attn_drop.p if self.training else 0.0
+            return nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+        attn = (q * self.scale) @ k.transpose(-2, -1)
+        if attn_mask is not None:
+            attn = attn.masked_fill(~attn_mask, float("-inf"))
+        attn = attn.softmax(dim=-1)
+        attn = self.attn_drop(attn)
+        return attn @ v
+
+    def forward(self, x: Tensor, attn_bias=None) -> Tensor:
+        backend = "math" if _attention_backend == "math" or not SDPA_AVAILABLE else "sdpa"
+        if isinstance(attn_bias, BlockDiagonalMask):
+            return torch.cat([self.forward(run).reshape(1, -1, x.shape[-1]) for run in attn_bias.split_runs(x)], dim=1)
+        attn_mask = attn_bias.mask if isinstance(attn_bias, PackedSequenceMask) else None
+        assert attn_bias is None or attn_mask is not None, (
+            f"Attention bias {type(attn_bias).__name__} requires the xformers backend"
+        )
 
-    def forward(self, x: Tensor) -> Tensor:
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
 
-        q, k, v = qkv[0] * self.scale, qkv[1], qkv[2]
-        attn = q @ k.transpose(-2, -1)
-
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
-
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        q, k, v = qkv.unbind(0)
+        if self.query_chunk_size and N > self.query_chunk_size and not self.training:
+            # [B, num_heads, query_chunk_size, N] attention matrices instead of [B, num_heads, N, N]
+            q_chunks = q.split(self.query_chunk_size, dim=2)
+            mask_chunks = [None] * len(q_chunks) if attn_mask is None else attn_mask.split(self.query_chunk_size, dim=2)
+            x = torch.cat(
+                [self._attention(q_chunk, k, v, backend, mask) for q_chunk, mask in zip(q_chunks, mask_chunks)], dim=2
+            )
+        else:
+            x = self._attention(q, k, v, backend, attn_mask)
+
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -64,9 +193,13 @@ class Attention(nn.Module):
 
 class MemEffAttention(Attention):
     def forward(self, x: Tensor, attn_bias=None) -> Tensor:
-        if not XFORMERS_AVAILABLE:
-            assert attn_bias is None, "xFormers is required for nested tensors usage"
-            return super().forward(x)
+        if (
+            _attention_backend != "xformers"
+            or not XFORMERS_AVAILABLE
+            or not x.is_cuda
+            or isinstance(attn_bias, PackedSequenceMask)
+        ):
+            return super().forward(x, attn_bias=attn_bias)
 
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads)
@@ -9,12 +9,14 @@
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/layers/patch_embed.py
 
 import logging
-from typing import Callable, List, Any, Tuple, Dict
+from contextlib import contextmanager
+from typing import Callable, List, Any, Tuple, Dict, Optional
 
 import torch
+import torch.utils.checkpoint
 from torch import nn, Tensor
 
-from .attention import Attention, MemEffAttention
+from .attention import Attention, BlockDiagonalMask, MemEffAttention, PackedSequenceMask, get_attention_backend
 from .drop_path import DropPath
 from .layer_scale import LayerScale
 from .mlp import Mlp
@@ -79,43 +81,138 @@ class Block(nn.Module):
 
         self.sample_drop_ratio = drop_path
 
+        self.token_chunk_size = None  # see set_token_chunking
+        self.activation_checkpointing = False  # see set_activation_checkpointing
+
+    def set_token_chunking(self, chunk_size=None) -> None:
+        """
+        Inference only: the FFN processes the tokens by chunks of `chunk_size` and the attention its queries by
+        chunks of `chunk_size` (against all the keys), bounding the activations of high-resolution inputs to
+        those of `chunk_size` tokens. None disables chunking.
+        """
+        self.token_chunk_size = chunk_size
+        if isinstance(self.attn, Attention):
+            self.attn.query_chunk_size = chunk_size
+
+    def set_activation_checkpointing(self, enabled: bool = True) -> None:
+        """Recompute the activations of the block in the backward pass instead of keeping them (fine-tuning)"""
+        self.activation_checkpointing = enabled
+
     def forward(self, x: Tensor) -> Tensor:
+        if self.activation_checkpointing and torch.is_grad_enabled():
+            # the recomputation happens after the step: the sample subsets are drawn from the RNG, whose state
+            # checkpoint restores, rather than from the sample plan
+            with stochastic_depth_plan(None):
+                return torch.utils.checkpoint.checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x)
+
+    def _forward(self, x: Tensor) -> Tensor:
+        if not (self.training and self.sample_drop_ratio > 0.0):
+            # no closures and the layer scale fused into the residual add, which torch.compile traces cleanly
+            x = add_scaled_residual(x, self.attn(self.norm1(x)), self.ls1)
+            if self.token_chunk_size and x.shape[1] > self.token_chunk_size and not self.training:
+                # the FFN hidden activations are the largest of the block
+                return torch.cat(
+                    [
+                        add_scaled_residual(chunk, self.mlp(self.norm2(chunk)), self.ls2)
+                        for chunk in x.split(self.token_chunk_size, dim=1)
+                    ],
+                    dim=1,
+                )
+            x = add_scaled_residual(x, self.mlp(self.norm2(x)), self.ls2)
+            return x
+
         def attn_residual_func(x: Tensor) -> Tensor:
             return self.ls1(self.attn(self.norm1(x)))
 
         def ffn_residual_func(x: Tensor) -> Tensor:
             return self.ls2(self.mlp(self.norm2(x)))
 
-        if self.training and self.sample_drop_ratio > 0.1:
+        if self.sample_drop_ratio > 0.1:
             # the overhead is compensated only for a drop path rate larger than 0.1
             x = drop_add_residual_stochastic_depth(
                 x,
                 residual_func=attn_residual_func,
                 sample_drop_ratio=self.sample_drop_ratio,
             )
+            # x is now owned by the block: the FFN residual is added into it rather than into a new tensor
             x = drop_add_residual_stochastic_depth(
                 x,
                 residual_func=ffn_residual_func,
                 sample_drop_ratio=self.sample_drop_ratio,
+                inplace=True,
             )
-        elif self.training and self.sample_drop_ratio > 0.0:
+        else:
             x = x + self.drop_path1(attn_residual_func(x))
             x = x + self.drop_path1(ffn_residual_func(x))  # FIXME: drop_path2
-        else:
-            x = x + attn_residual_func(x)
-            x = x + ffn_residual_func(x)
         return x
 
 
+def add_scaled_residual(x: Tensor, residual: Tensor, layer_scale: nn.Module) -> Tensor:
+    """x + layer_scale(residual), as a single addcmul when layer_scale is a LayerScale"""
+    if isinstance(layer_scale, LayerScale) and not layer_scale.inplace:
+        return torch.addcmul(x, layer_scale.gamma, residual)
+    return x + layer_scale(residual)
+
+
+class StochasticDepthPlan:
+    """
+    Sample subsets of the stochastic-depth residuals of one training step. Instead of a torch.randperm per
+    residual, the subsets of `num_draws` residuals with the same batch size are drawn at once (one random
+    permutation per row of a [num_draws, batch_size] matrix) and handed out in turn. The subsets are sorted,
+    for more local gathers and index_adds.
+    """
+
+    def __init__(self, num_draws: int) -> None:
+        self.num_draws = num_draws
+        self._branges: Dict[Tuple, Tensor] = {}
+        self._next: Dict[Tuple, int] = {}
+
+    def brange(self, b: int, sample_subset_size: int, device) -> Tensor:
+        key = (b, sample_subset_size, device)
+        if self._next.get(key, self.num_draws) >= self.num_draws:
+            permutations = torch.rand(self.num_draws, b, device=device).argsort(dim=1)
+            self._branges[key] = permutations[:, :sample_subset_size].sort(dim=1).values
+            self._next[key] = 0
+        self._next[key] += 1
+        return self._branges[key][self._next[key] - 1]
+
+
+_stochastic_depth_plan: Optional[StochasticDepthPlan] = None
+
+
+@contextmanager
+def stochastic_depth_plan(plan: Optional[StochasticDepthPlan]):
+    """Draws the sample subsets of the stochastic-depth residuals from `plan` (from torch.randperm if None)"""
+    global _stochastic_depth_plan
+    previous_plan, _stochastic_depth_plan = _stochastic_depth_plan, plan
+    try:
+        yield plan
+    finally:
+        _stochastic_depth_plan = previous_plan
+
+
+def sample_brange(b: int, sample_subset_size: int, device) -> Tensor:
+    if _stochastic_depth_plan is not None:
+        return _stochastic_depth_plan.brange(b, sample_subset_size, device)
+    return (torch.randperm(b, device=device))[:sample_subset_size]
+
+
 def drop_add_residual_stochastic_depth(
     x: Tensor,
     residual_func: Callable[[Tensor], Tensor],
     sample_drop_ratio: float = 0.0,
+    inplace: bool = False,
 ) -> Tensor:
+    """
+    x + the residual of a random subset of the samples, rescaled. With `inplace`, the residual is added into x,
+    which is only valid when x is not used elsewhere (not the block input, which the caller may keep): the
+    residual is computed on a gathered copy of the subset, so autograd does not need the previous values of x.
+    """
     # 1) extract subset using permutation
     b, n, d = x.shape
     sample_subset_size = max(int(b * (1 - sample_drop_ratio)), 1)
-    brange = (torch.randperm(b, device=x.device))[:sample_subset_size]
+    brange = sample_brange(b, sample_subset_size, x.device)
     x_subset = x[brange]
 
     # 2) apply residual_func to get residual
@@ -127,6 +224,8 @@ def drop_add_residual_stochastic_depth(
     residual_scale_factor = b / sample_subset_size
 
     # 3) add the residual
+    if inplace:
+        return x_flat.index_add_(0, brange, residual.to(dtype=x.dtype), alpha=residual_scale_factor).view_as(x)
     x_plus_residual = torch.index_add(x_flat, 0, brange, residual.to(dtype=x.dtype), alpha=residual_scale_factor)
     return x_plus_residual.view_as(x)
 
@@ -134,48 +233,64 @@ def drop_add_residual_stochastic_depth(
 def get_branges_scales(x, sample_drop_ratio=0.0):
     b, n, d = x.shape
     sample_subset_size = max(int(b * (1 - sample_drop_ratio)), 1)
-    brange = (torch.randperm(b, device=x.device))[:sample_subset_size]
+    brange = sample_brange(b, sample_subset_size, x.device)
     residual_scale_factor = b / sample_subset_size
     return brange, residual_scale_factor
 
 
-def add_residual(x, brange, residual, residual_scale_factor, scaling_vector=None):
-    if scaling_vector is None:
-        x_flat = x.flatten(1)
-        residual = residual.flatten(1)
-        x_plus_residual = torch.index_add(x_flat, 0, brange, residual.to(dtype=x.dtype), alpha=residual_scale_factor)
-    else:
-        x_plus_residual = scaled_index_add(
+def add_residual(x, brange, residual, residual_scale_factor, scaling_vector=None, inplace=False):
+    # inplace: see drop_add_residual_stochastic_depth, the xFormers kernel always writes a new tensor
+    if XFORMERS_AVAILABLE and x.is_cuda and scaling_vector is not None:
+        return scaled_index_add(
             x, brange, residual.to(dtype=x.dtype), scaling=scaling_vector, alpha=residual_scale_factor
         )
-    return x_plus_residual
+    x_flat = x.flatten(1)
+    if scaling_vector is not None:
+        residual = residual * scaling_vector
+    residual = residual.flatten(1).to(dtype=x.dtype)
+    if inplace:
+        return x_flat.index_add_(0, brange, residual, alpha=residual_scale_factor)
+    return torch.index_add(x_flat, 0, brange, residual, alpha=residual_scale_factor)
 
 
 attn_bias_cache: Dict[Tuple, Any] = {}
 
 
+def make_block_diagonal_attn_bias(seqlens, is_cuda):
+    """Block-diagonal attention bias for sequences of lengths `seqlens` packed along dim 1, for the current backend"""
+    if XFORMERS_AVAILABLE and get_attention_backend() == "xformers" and is_cuda:
+        return fmha.BlockDiagonalMask.from_seqlens(seqlens)
+    return BlockDiagonalMask.from_seqlens(seqlens)
+
+
 def get_attn_bias_and_cat(x_list, branges=None):
     """
     this will perform the index select, cat the tensors, and provide the attn_bias from cache
     """
     batch_sizes = [b.shape[0] for b in branges] if branges is not None else [x.shape[0] for x in x_list]
+    # xFormers masks only work with its kernels, the other attention backends take a BlockDiagonalMask
+    use_xformers = XFORMERS_AVAILABLE and get_attention_backend() == "xformers" and x_list[0].is_cuda
     all_shapes = tuple((b, x.shape[1]) for b, x in zip(batch_sizes, x_list))
-    if all_shapes not in attn_bias_cache.keys():
+    cache_key = (use_xformers, all_shapes)
+    if cache_key not in attn_bias_cache.keys():
         seqlens = []
         for b, x in zip(batch_sizes, x_list):
             for _ in range(b):
                 seqlens.append(x.shape[1])
-        attn_bias = fmha.BlockDiagonalMask.from_seqlens(seqlens)
+        mask_class = fmha.BlockDiagonalMask if use_xformers else BlockDiagonalMask
+        attn_bias = mask_class.from_seqlens(seqlens)
         attn_bias._batch_sizes = batch_sizes
-        attn_bias_cache[all_shapes] = attn_bias
+        attn_bias_cache[cache_key] = attn_bias
 
-    if branges is not None:
+    if branges is not None and use_xformers:
         cat_tensors = index_select_cat([x.flatten(1) for x in x_list], branges).view(1, -1, x_list[0].shape[-1])
+    elif branges is not None:
+        cat_tensors = torch.cat([x.index_select(0, b).reshape(1, -1, x.shape[-1]) for x, b in zip(x_list, branges)], dim=1)
     else:
         tensors_bs1 = tuple(x.reshape([1, -1, *x.shape[2:]]) for x in x_list)
         cat_tensors = torch.cat(tensors_bs1, dim=1)
 
-    return attn_bias_cache[all_shapes], cat_tensors
+    return attn_bias_cache[cache_key], cat_tensors
 
 
 def drop_add_residual_stochastic_depth_list(
@@ -183,6 +298,7 @@ def drop_add_residual_stochastic_depth_list(
     residual_func: Callable[[Tensor, Any], Tensor],
     sample_drop_ratio: float = 0.0,
     scaling_vector=None,
+    inplace: bool = False,
 ) -> Tensor:
     # 1) generate random set of indices for dropping samples in the batch
     branges_scales = [get_branges_scales(x, sample_drop_ratio=sample_drop_ratio) for x in x_list]
@@ -197,7 +313,7 @@ def drop_add_residual_stochastic_depth_list(
 
     outputs = []
     for x, brange, residual, residual_scale_factor in zip(x_list, branges, residual_list, residual_scale_factors):
-        outputs.append(add_residual(x, brange, residual, residual_scale_factor, scaling_vector).view_as(x))
+        outputs.append(add_residual(x, brange, residual, residual_scale_factor, scaling_vector, inplace).view_as(x))
     return outputs
 
 
@@ -227,26 +343,39 @@ class NestedTensorBlock(Block):
                 residual_func=ffn_residual_func,
                 sample_drop_ratio=self.sample_drop_ratio,
                 scaling_vector=self.ls2.gamma if isinstance(self.ls1, LayerScale) else None,
+                inplace=True,  # the outputs of the attention residual are owned by the block
             )
             return x_list
         else:
-
-            def attn_residual_func(x: Tensor, attn_bias=None) -> Tensor:
-                return self.ls1(self.attn(self.norm1(x), attn_bias=attn_bias))
-
-            def ffn_residual_func(x: Tensor, attn_bias=None) -> Tensor:
-                return self.ls2(self.mlp(self.norm2(x)))
-
             attn_bias, x = get_attn_bias_and_cat(x_list)
-            x = x + attn_residual_func(x, attn_bias=attn_bias)
-            x = x + ffn_residual_func(x)
+            x = add_scaled_residual(x, self.attn(self.norm1(x), attn_bias=attn_bias), self.ls1)
+            x = add_scaled_residual(x, self.mlp(self.norm2(x)), self.ls2)
             return attn_bias.split(x)
 
-    def forward(self, x_or_x_list):
-        if isinstance(x_or_x_list, Tensor):
+    def forward_packed(self, x: Tensor, attn_bias) -> Tensor:
+        """
+        Sequences of different lengths packed in x, attending only to themselves through `attn_bias`: a
+        block-diagonal bias (see make_block_diagonal_attn_bias) for x [1, sum(seqlens), C], at inference, or a
+        PackedSequenceMask for rows of packed sequences (see dinov2.layers.packing), with stochastic depth
+        drawn per sequence in training
+        """
+        if self.training and self.sample_drop_ratio > 0.0:
+            assert isinstance(attn_bias, PackedSequenceMask), "Stochastic depth requires a PackedSequenceMask"
+            residual = self.ls1(self.attn(self.norm1(x), attn_bias=attn_bias))
+            x = x + attn_bias.drop_path(residual, self.sample_drop_ratio)
+            residual = self.ls2(self.mlp(self.norm2(x)))
+            x = x + attn_bias.drop_path(residual, self.sample_drop_ratio)
+            return x
+        x = add_scaled_residual(x, self.attn(self.norm1(x), attn_bias=attn_bias), self.ls1)
+        x = add_scaled_residual(x, self.mlp(self.norm2(x)), self.ls2)
+        return x
+
+    def forward(self, x_or_x_list, attn_bias=None):
+        if attn_bias is not None:
+            return self.forward_packed(x_or_x_list, attn_bias)
+        elif isinstance(x_or_x_list, Tensor):
             return super().forward(x_or_x_list)
         elif isinstance(x_or_x_list, list):
-            assert XFORMERS_AVAILABLE, "Please install xFormers for nested tensors usage"
             return self.forward_nested(x_or_x_list)
         else:
             raise AssertionError
@@ -0,0 +1,84 @@
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from torch import Tensor
+
+from .attention import PackedSequenceMask
+
+
+logger = logging.getLogger("dinov2")
+
+
+class SequencePacker:
+    """
+    Packs the token sequences of several [batch_size, seqlen, C] tensors (e.g. the global and local crops of a
+    multi-crop step) into the rows of a dense [num_rows, row_length, C] tensor, with a PackedSequenceMask so that
+    every sequence only attends to itself. The sequences are placed first-fit, longest first, and the end of the
+    rows is padded. `row_length` defaults to the longest sequence, e.g. one 16 x 16 global crop or five 7 x 7
+    local crops (with their class tokens) per row.
+    """
+
+    def __init__(self, shapes: Sequence[Tuple[int, int]], row_length: Optional[int] = None, device=None) -> None:
+        # shapes: (batch_size, seqlen) of the packed tensors
+        self.shapes = list(shapes)
+        seqlens = [seqlen for batch_size, seqlen in self.shapes for _ in range(batch_size)]
+        self.row_length = row_length or max(seqlens)
+        assert max(seqlens) <= self.row_length, f"{max(seqlens)} tokens do not fit in rows of {self.row_length}"
+
+        row_lengths: List[int] = []  # used length of each row
+        offsets = [0] * len(seqlens)  # start of each sequence in the flattened rows
+        for i in sorted(range(len(seqlens)), key=lambda i: -seqlens[i]):
+            row = next((r for r, used in enumerate(row_lengths) if used + seqlens[i] <= self.row_length), None)
+            if row is None:
+                row = len(row_lengths)
+                row_lengths.append(0)
+            offsets[i] = row * self.row_length + row_lengths[row]
+            row_lengths[row] += seqlens[i]
+        self.num_rows = len(row_lengths)
+        self.num_tokens = sum(seqlens)
+
+        # position of every token in the flattened rows, in the order of the concatenated input sequences
+        self.index = torch.cat([torch.arange(o, o + n) for o, n in zip(offsets, seqlens)]).to(device)
+        num_sequences = len(seqlens)
+        token_sequence = torch.full((self.num_rows * self.row_length,), num_sequences, dtype=torch.long)
+        token_sequence[self.index.cpu()] = torch.repeat_interleave(torch.arange(num_sequences), torch.tensor(seqlens))
+        # padding tokens get distinct ids so that they only attend to themselves (no fully masked rows)
+        ids = torch.where(
+            token_sequence < num_sequences, token_sequence, num_sequences + torch.arange(len(token_sequence))
+        ).view(self.num_rows, self.row_length)
+        mask = (ids.unsqueeze(2) == ids.unsqueeze(1)).unsqueeze(1)
+        self.attn_bias = PackedSequenceMask(mask.to(device), token_sequence.to(device), num_sequences)
+
+    @property
+    def padding_waste(self) -> float:
+        """Fraction of the packed tokens that are padding"""
+        return 1 - self.num_tokens / (self.num_rows * self.row_length)
+
+    def pack(self, x_list: List[Tensor]) -> Tensor:
+        tokens = torch.cat([x.flatten(0, 1) for x in x_list])
+        C = tokens.shape[-1]
+        packed = tokens.new_zeros(self.num_rows * self.row_length, C).index_copy(0, self.index, tokens)
+        return packed.view(self.num_rows, self.row_length, C)
+
+    def unpack(self, packed: Tensor) -> List[Tensor]:
+        tokens = packed.reshape(-1, packed.shape[-1]).index_select(0, self.index)
+        chunks = tokens.split([batch_size * seqlen for batch_size, seqlen in self.shapes])
+        return [chunk.view(batch_size, seqlen, -1) for chunk, (batch_size, seqlen) in zip(chunks, self.shapes)]
+
+
+sequence_packer_cache: Dict[Tuple, SequencePacker] = {}
+
+
+def get_sequence_packer(x_list: List[Tensor], row_length: Optional[int] = None) -> SequencePacker:
+    """SequencePacker of the [batch_size, seqlen, C] tensors of `x_list`, cached by their shapes"""
+    shapes = tuple((x.shape[0], x.shape[1]) for x in x_list)
+    cache_key = (shapes, row_length, x_list[0].device)
+    if cache_key not in sequence_packer_cache:
+        packer = SequencePacker(shapes, row_length, device=x_list[0].device)
+        logger.info(
+            f"Packing {len(shapes)} tensors of shapes {shapes} into {packer.num_rows} rows of {packer.row_length} "
+            f"tokens, padding waste {packer.padding_waste:.1%}"
+        )
+        sequence_packer_cache[cache_key] = packer
+    return sequence_packer_cache[cache_key]
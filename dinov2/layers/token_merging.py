@@ -0,0 +1,79 @@
+# References:
+#   https://github.com/facebookresearch/ToMe/blob/main/tome/merge.py
+
+import math
+from typing import Callable, Tuple
+
+import torch
+from torch import Tensor
+
+
+def bipartite_soft_matching(metric: Tensor, r: int) -> Tuple[Callable[[Tensor, str], Tensor], Tensor]:
+    """
+    ToMe bipartite soft matching: tokens are alternately split into sets A and B, and the `r` tokens of A most
+    similar (cosine on `metric` [B, N, C]) to a token of B are merged into it. The class token (first token)
+    is never merged and stays first. Returns the merge function, taking [B, N, C] tensors to [B, N - r, C], and
+    the index [B, N] of the output token each input token ends up in.
+    """
+    B, N, _ = metric.shape
+    num_a = math.ceil(N / 2)
+    with torch.no_grad():
+        metric = metric / metric.norm(dim=-1, keepdim=True)
+        a, b = metric[:, ::2], metric[:, 1::2]
+        scores = a @ b.transpose(-1, -2)
+        scores[:, 0] = -math.inf  # protect the class token
+
+        node_max, node_idx = scores.max(dim=-1)
+        edge_idx = node_max.argsort(dim=-1, descending=True)
+        unm_idx = edge_idx[:, r:].sort(dim=-1).values  # unmerged tokens of A, in their original order
+        src_idx = edge_idx[:, :r]  # merged tokens of A
+        dst_idx = node_idx.gather(dim=-1, index=src_idx)  # and the tokens of B they are merged into
+
+        num_unm = num_a - r
+        new_a = torch.empty(B, num_a, dtype=torch.long, device=metric.device)
+        new_a.scatter_(1, unm_idx, torch.arange(num_unm, device=metric.device).expand(B, -1))
+        new_a.scatter_(1, src_idx, num_unm + dst_idx)
+        token_index = torch.empty(B, N, dtype=torch.long, device=metric.device)
+        token_index[:, ::2] = new_a
+        token_index[:, 1::2] = num_unm + torch.arange(N - num_a, device=metric.device)
+
+    def merge(x: Tensor, mode: str = "sum") -> Tensor:
+        src, dst = x[:, ::2], x[:, 1::2]
+        C = x.shape[-1]
+        unm = src.gather(dim=-2, index=unm_idx.unsqueeze(-1).expand(-1, -1, C))
+        src = src.gather(dim=-2, index=src_idx.unsqueeze(-1).expand(-1, -1, C))
+        dst = dst.scatter_reduce(-2, dst_idx.unsqueeze(-1).expand(-1, -1, C), src, reduce=mode)
+        return torch.cat([unm, dst], dim=1)
+
+    return merge, token_index
+
+
+class TokenMerger:
+    """
+    Merges tokens between the blocks of a ViT (eval only). Merged tokens are size-weighted averages, and the
+    output token of every input token is tracked so that `unmerge` gives back [B, N, C] tensors: pooled
+    outputs then weigh every original patch equally and patch outputs keep their spatial layout.
+    """
+
+    def __init__(self, x: Tensor, merge_ratios) -> None:
+        B, N, _ = x.shape
+        self.merge_ratios = merge_ratios
+        self.size = torch.ones(B, N, 1, dtype=x.dtype, device=x.device)
+        self.token_map = torch.arange(N, device=x.device).expand(B, -1)
+
+    def __call__(self, x: Tensor, block_index: int) -> Tensor:
+        if block_index >= len(self.merge_ratios):
+            return x
+        N = x.shape[1]
+        r = min(int(self.merge_ratios[block_index] * N), (N - 1) // 2)
+        if r <= 0:
+            return x
+        merge, token_index = bipartite_soft_matching(x, r)
+        x = merge(x * self.size, "sum")
+        self.size = merge(self.size, "sum")
+        x = x / self.size
+        self.token_map = token_index.gather(1, self.token_map)
+        return x
+
+    def unmerge(self, x: Tensor) -> Tensor:
+        return x.gather(1, self.token_map.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
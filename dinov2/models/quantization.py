@@ -0,0 +1,53 @@
+import copy
+import logging
+
+import torch
+from torch import nn
+
+from dinov2.layers import SwiGLUFFN
+
+
+logger = logging.getLogger("dinov2")
+
+
+# nn.Linear layers of the transformer blocks: attention (qkv, proj), Mlp (fc1, fc2), SwiGLUFFN (w12, w3)
+QUANTIZED_LINEAR_NAMES = ("qkv", "proj", "fc1", "fc2", "w12", "w3")
+
+
+def _unfuse_swiglu(model):
+    # the xFormers SwiGLU uses its weights in a fused op instead of calling its nn.Linear layers
+    for name, module in list(model.named_modules()):
+        if isinstance(module, SwiGLUFFN) or not hasattr(module, "w3"):
+            continue
+        if hasattr(module, "w12"):
+            w12 = module.w12
+        else:  # unpacked weights
+            w12 = nn.Linear(module.w1.in_features, 2 * module.w1.out_features, bias=module.w1.bias is not None)
+            w12.weight.data = torch.cat([module.w1.weight.data, module.w2.weight.data])
+            if module.w1.bias is not None:
+                w12.bias.data = torch.cat([module.w1.bias.data, module.w2.bias.data])
+        ffn = SwiGLUFFN(w12.in_features, w12.out_features // 2, module.w3.out_features, bias=module.w3.bias is not None)
+        ffn.w12, ffn.w3 = w12, module.w3
+        parent_name, _, child_name = name.rpartition(".")
+        setattr(model.get_submodule(parent_name) if parent_name else model, child_name, ffn)
+
+
+def quantize_dynamic_int8(model, inplace=False):
+    """
+    CPU inference copy of a DinoVisionTransformer whose block nn.Linear layers (see QUANTIZED_LINEAR_NAMES) have
+    dynamically quantized int8 weights, activations being quantized on the fly: no calibration is needed. The
+    patch embedding and the norms stay in float32, the model keeps its forward_features /
+    get_intermediate_layers API.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model = model.cpu().float().eval()
+    _unfuse_swiglu(model)
+    layer_names = {
+        name
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.startswith("blocks.") and name.rpartition(".")[2] in QUANTIZED_LINEAR_NAMES
+    }
+    model = torch.ao.quantization.quantize_dynamic(model, layer_names, dtype=torch.qint8, inplace=True)
+    logger.info(f"Quantized {len(layer_names)} linear layers to int8")
+    return model
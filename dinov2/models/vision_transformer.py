@@ -8,7 +8,9 @@
 #   https://github.com/facebookresearch/dino/blob/main/vision_transformer.py
 #   https://github.com/rwightman/pytorch-image-models/tree/master/timm/models/vision_transformer.py
 
+from contextlib import nullcontext
 from functools import partial
+import copy
 import math
 import logging
 from typing import Sequence, Tuple, Union, Callable
@@ -19,10 +21,15 @@ import torch.utils.checkpoint
 from torch.nn.init import trunc_normal_
 
 from dinov2.layers import Mlp, PatchEmbed, SwiGLUFFNFused, MemEffAttention, NestedTensorBlock as Block
+from dinov2.layers.block import StochasticDepthPlan, make_block_diagonal_attn_bias, stochastic_depth_plan
+from dinov2.layers.packing import get_sequence_packer
+from dinov2.layers.token_merging import TokenMerger
 
 
 logger = logging.getLogger("dinov2")
 
+POS_EMBED_CACHE_SIZE = 8  # number of input resolutions whose interpolated positional embeddings are kept
+
 
 def named_apply(fn: Callable, module: nn.Module, name="", depth_first=True, include_root=False) -> nn.Module:
     if not depth_first and include_root:
@@ -36,9 +43,9 @@ def named_apply(fn: Callable, module: nn.Module, name="", depth_first=True, incl
 
 
 class BlockChunk(nn.ModuleList):
-    def forward(self, x):
+    def forward(self, x, attn_bias=None):
         for b in self:
-            x = b(x)
+            x = b(x) if attn_bias is None or isinstance(b, nn.Identity) else b(x, attn_bias=attn_bias)
         return x
 
 
@@ -155,6 +162,18 @@ class DinoVisionTransformer(nn.Module):
 
         self.mask_token = nn.Parameter(torch.zeros(1, embed_dim))
 
+        self.token_merge_ratios = None  # see set_token_merging
+        self.sequence_packing, self.packing_row_length = False, None  # see set_sequence_packing
+        self.packing_padding_waste = None
+        self.patch_drop_threshold, self.patch_drop_fill = None, "zero"  # see set_patch_dropping
+
+        # interpolated positional embeddings, by token grid (see interpolate_pos_encoding)
+        self._pos_embed_cache = {}
+        self._pos_embed_cache_version = None
+
+        self._compiled_blocks = None  # see compile
+        self._compiled_shapes = set()
+
         self.init_weights()
 
     def init_weights(self):
@@ -168,6 +187,27 @@ class DinoVisionTransformer(nn.Module):
         N = self.pos_embed.shape[1] - 1
         if npatch == N and w == h:
             return self.pos_embed
+        # without gradients to the positional embedding, reuse the interpolation done for this token grid as long
+        # as pos_embed is not modified in place (optimizer / EMA steps, weight loading bump its version)
+        use_cache = not (torch.is_grad_enabled() and self.pos_embed.requires_grad)
+        if use_cache:
+            cache_key = (w // self.patch_size, h // self.patch_size, previous_dtype, x.device,
+                         torch.is_inference_mode_enabled())
+            version = (self.pos_embed._version, self.pos_embed.data_ptr())
+            if self._pos_embed_cache_version != version:
+                self._pos_embed_cache.clear()
+                self._pos_embed_cache_version = version
+            if cache_key in self._pos_embed_cache:
+                return self._pos_embed_cache[cache_key]
+            pos_embed = self._interpolate_pos_encoding(x, w, h, previous_dtype)
+            if len(self._pos_embed_cache) >= POS_EMBED_CACHE_SIZE:
+                self._pos_embed_cache.pop(next(iter(self._pos_embed_cache)))
+            self._pos_embed_cache[cache_key] = pos_embed
+            return pos_embed
+        return self._interpolate_pos_encoding(x, w, h, previous_dtype)
+
+    def _interpolate_pos_encoding(self, x, w, h, previous_dtype):
+        N = self.pos_embed.shape[1] - 1
         pos_embed = self.pos_embed.float()
         class_pos_embed = pos_embed[:, 0]
         patch_pos_embed = pos_embed[:, 1:]
@@ -201,8 +241,17 @@ class DinoVisionTransformer(nn.Module):
 
     def forward_features_list(self, x_list, masks_list):
         x = [self.prepare_tokens_with_masks(x, masks) for x, masks in zip(x_list, masks_list)]
-        for blk in self.blocks:
-            x = blk(x)
+        if self.sequence_packing:
+            packer = get_sequence_packer(x, self.packing_row_length)
+            self.packing_padding_waste = packer.padding_waste
+            x = packer.pack(x)
+            for blk in self.blocks:
+                x = blk(x, attn_bias=packer.attn_bias)
+            x = packer.unpack(x)
+        else:
+            with self._stochastic_depth_plan():
+                for blk in self.blocks:
+                    x = blk(x)
 
         all_x = x
         output = []
@@ -222,10 +271,22 @@ class DinoVisionTransformer(nn.Module):
         if isinstance(x, list):
             return self.forward_features_list(x, masks)
 
+        keep = self._foreground_patches(x) if self._drops_patches(masks) else None
         x = self.prepare_tokens_with_masks(x, masks)
 
-        for blk in self.blocks:
-            x = blk(x)
+        merger = self._token_merger(x)
+        if keep is not None:
+            x = self._forward_dropped_patches(x, keep)[0]
+        elif merger is None and self._compiled_blocks is not None and not self.training:
+            x = self._forward_compiled_blocks(x)
+        elif merger is None:
+            with self._stochastic_depth_plan():
+                for blk in self.blocks:
+                    x = blk(x)
+        else:
+            for i, blk in enumerate(self._iter_blocks()):
+                x = merger(blk(x), i)
+            x = merger.unmerge(x)
 
         x_norm = self.norm(x)
         return {
@@ -235,32 +296,210 @@ class DinoVisionTransformer(nn.Module):
             "masks": masks,
         }
 
+    def _stochastic_depth_plan(self):
+        # in training, the sample subsets of the stochastic-depth residuals (two per block) are drawn once per step
+        if not self.training or not any(blk.sample_drop_ratio > 0.0 for blk in self._iter_blocks()):
+            return nullcontext()
+        return stochastic_depth_plan(StochasticDepthPlan(num_draws=2 * self.n_blocks))
+
     def _get_intermediate_layers_not_chunked(self, x, n=1):
+        keep = self._foreground_patches(x) if self._drops_patches() else None
         x = self.prepare_tokens_with_masks(x)
         # If n is an int, take the n last blocks. If it's a list, take them
         output, total_block_len = [], len(self.blocks)
         blocks_to_take = range(total_block_len - n, total_block_len) if isinstance(n, int) else n
-        for i, blk in enumerate(self.blocks):
+        if keep is not None:
+            return self._forward_dropped_patches(x, keep, blocks_to_take)
+        last_block = max(blocks_to_take)  # the blocks after it are not needed
+        merger = self._token_merger(x)
+        for i, blk in enumerate(self.blocks[: last_block + 1]):
             x = blk(x)
             if i in blocks_to_take:
-                output.append(x)
+                output.append(x if merger is None else merger.unmerge(x))
+            if merger is not None:
+                x = merger(x, i)
         assert len(output) == len(blocks_to_take), f"only {len(output)} / {len(blocks_to_take)} blocks found"
         return output
 
     def _get_intermediate_layers_chunked(self, x, n=1):
+        keep = self._foreground_patches(x) if self._drops_patches() else None
         x = self.prepare_tokens_with_masks(x)
         output, i, total_block_len = [], 0, len(self.blocks[-1])
         # If n is an int, take the n last blocks. If it's a list, take them
         blocks_to_take = range(total_block_len - n, total_block_len) if isinstance(n, int) else n
+        if keep is not None:
+            return self._forward_dropped_patches(x, keep, blocks_to_take)
+        last_block = max(blocks_to_take)  # the blocks after it are not needed
+        merger = self._token_merger(x)
         for block_chunk in self.blocks:
-            for blk in block_chunk[i:]:  # Passing the nn.Identity()
+            for blk in block_chunk[i : last_block + 1]:  # Passing the nn.Identity()
                 x = blk(x)
                 if i in blocks_to_take:
-                    output.append(x)
+                    output.append(x if merger is None else merger.unmerge(x))
+                if merger is not None:
+                    x = merger(x, i)
                 i += 1
+            if i > last_block:
+                break
         assert len(output) == len(blocks_to_take), f"only {len(output)} / {len(blocks_to_take)} blocks found"
         return output
 
+    def _iter_blocks(self):
+        # the blocks one by one, also when they are chunked
+        if not self.chunked_blocks:
+            yield from self.blocks
+            return
+        i = 0
+        for block_chunk in self.blocks:
+            for blk in block_chunk[i:]:  # Passing the nn.Identity()
+                yield blk
+                i += 1
+
+    def set_token_merging(self, merge_ratio=None):
+        """
+        Opt-in token merging (ToMe) for inference: after each block, a fraction `merge_ratio` of the tokens is
+        merged into the most similar remaining tokens (bipartite soft matching). `merge_ratio` is a float for
+        all the blocks or a list with one ratio per block, None disables merging. Outputs keep one token per
+        patch, the merged tokens being copied back to all the patches they cover.
+        """
+        if merge_ratio is None or isinstance(merge_ratio, (list, tuple)):
+            self.token_merge_ratios = merge_ratio
+        else:
+            self.token_merge_ratios = [merge_ratio] * (self.n_blocks - 1)  # nothing to gain after the last block
+        return self
+
+    def _token_merger(self, x):
+        if self.training or not self.token_merge_ratios:
+            return None
+        return TokenMerger(x, self.token_merge_ratios)
+
+    def set_token_chunking(self, chunk_size=None):
+        """
+        Inference with the attention queries and the FFN tokens of every block processed by chunks of
+        `chunk_size` tokens (see Block.set_token_chunking), e.g. to extract features of high-resolution inputs
+        with larger batches. None disables chunking.
+        """
+        for blk in self._iter_blocks():
+            blk.set_token_chunking(chunk_size)
+        return self
+
+    def set_activation_checkpointing(self, enabled=True):
+        """Per-block activation checkpointing when gradients flow through the blocks, for fine-tuning"""
+        for blk in self._iter_blocks():
+            blk.set_activation_checkpointing(enabled)
+        return self
+
+    def set_sequence_packing(self, enabled=True, row_length=None):
+        """
+        Runs the crops of forward_features_list (e.g. the global and local crops of a multi-crop step) as one
+        batch of dense rows of `row_length` tokens (the longest sequence by default) into which their sequences
+        are packed, with an attention mask for the "sdpa" and "math" backends instead of xFormers block-diagonal
+        masks (see dinov2.layers.packing). The fraction of padding tokens of the last call is kept in
+        `packing_padding_waste`.
+        """
+        self.sequence_packing = enabled
+        self.packing_row_length = row_length
+        return self
+
+    def set_patch_dropping(self, threshold=None, fill="zero"):
+        """
+        Opt-in inference mode for inputs with large constant backgrounds: patches whose pixels have a standard
+        deviation (max over the channels, in normalized input units) not above `threshold` are left out of the
+        token sequence, and the remaining tokens of the batch are packed into one variable-length sequence with a
+        block-diagonal attention bias. Dense outputs are scattered back to all the patches, the dropped ones
+        being filled with zeros (`fill="zero"`) or with the learned mask token (`fill="mask_token"`).
+        None disables dropping. It takes precedence over token merging.
+        """
+        assert fill in ("zero", "mask_token"), f"Unknown fill {fill}"
+        self.patch_drop_threshold = threshold
+        self.patch_drop_fill = fill
+        return self
+
+    def _drops_patches(self, masks=None):
+        return self.patch_drop_threshold is not None and not self.training and masks is None
+
+    def _foreground_patches(self, images):
+        # [B, num_patches] mask of the patches to keep
+        p = self.patch_size
+        patches = images.unfold(2, p, p).unfold(3, p, p)  # [B, C, H / p, W / p, p, p]
+        return patches.flatten(4).std(dim=-1).amax(dim=1).flatten(1) > self.patch_drop_threshold
+
+    def _forward_dropped_patches(self, x, keep, blocks_to_take=None):
+        # x [B, 1 + num_patches, C] tokens, keep [B, num_patches]: outputs of the blocks in `blocks_to_take`
+        # (the last one by default), unpacked to [B, 1 + num_patches, C]
+        B, N, C = x.shape
+        keep = torch.cat([torch.ones_like(keep[:, :1]), keep], dim=1)  # the class token is always kept
+        attn_bias = make_block_diagonal_attn_bias(keep.sum(dim=1).tolist(), x.is_cuda)
+        if blocks_to_take is None:
+            blocks_to_take = [self.n_blocks - 1]
+        last_block = max(blocks_to_take)
+
+        def unpack(packed):
+            if self.patch_drop_fill == "mask_token":
+                out = self.mask_token.to(packed.dtype).expand(B, N, C).clone()
+            else:
+                out = packed.new_zeros(B, N, C)
+            out[keep] = packed[0]
+            return out
+
+        output, packed = [], x[keep].unsqueeze(0)
+        for i, blk in enumerate(self._iter_blocks()):
+            if i > last_block:
+                break
+            packed = blk.forward_packed(packed, attn_bias)
+            if i in blocks_to_take:
+                output.append(unpack(packed))
+        return output
+
+    def compile(self, **compile_kwargs):
+        """
+        Compiles the block stack with torch.compile for inference (eval mode, without token merging or patch
+        dropping, which keep running eagerly). Graphs are specialized to the input shape: one is compiled the
+        first time a (batch size, number of tokens, dtype, device) is seen and reused afterwards. The
+        `compile_kwargs` (e.g. mode="max-autotune") are passed to torch.compile.
+        """
+        compile_kwargs.setdefault("dynamic", False)
+        # a function of the model rather than a bound method, so that copies of the model compile their own graphs
+        self._compiled_blocks = torch.compile(_forward_blocks, **compile_kwargs)
+        self._compiled_shapes = set()
+        return self
+
+    def _forward_compiled_blocks(self, x):
+        shape_key = (tuple(x.shape), x.dtype, x.device)
+        if shape_key not in self._compiled_shapes:
+            self._compiled_shapes.add(shape_key)
+            logger.info(f"Compiling the blocks for inputs of shape {tuple(x.shape)} ({x.dtype}, {x.device})")
+        # one graph per shape: the recompilation limit of torch.compile is raised for these blocks only, the
+        # process-wide setting of the other compiled modules is left unchanged
+        cache_size_limit = max(torch._dynamo.config.cache_size_limit, len(self._compiled_shapes))
+        with torch._dynamo.config.patch(cache_size_limit=cache_size_limit):
+            return self._compiled_blocks(self, x)
+
+    def truncated(self, depth):
+        """
+        Copy of the model with only its first `depth` blocks and no head, e.g. to evaluate mid-depth features
+        (its last block is then block `depth - 1` of this model). The dropped blocks are not copied.
+        """
+        assert 0 < depth <= self.n_blocks, f"Cannot keep {depth} blocks out of {self.n_blocks}"
+        if self.chunked_blocks:  # chunks are padded with nn.Identity() to keep the block indices
+            kept_blocks, chunk_start = nn.ModuleList(), 0
+            for chunk in self.blocks:
+                if chunk_start >= depth:
+                    break
+                kept_blocks.append(BlockChunk(list(chunk)[:depth]))
+                chunk_start = len(chunk)
+        else:
+            kept_blocks = self.blocks[:depth]
+        blocks, head = self.blocks, self.head
+        self.blocks, self.head = nn.ModuleList(), nn.Identity()
+        try:
+            model = copy.deepcopy(self)
+        finally:
+            self.blocks, self.head = blocks, head
+        model.blocks = copy.deepcopy(kept_blocks)
+        model.n_blocks = depth
+        return model
+
     def get_intermediate_layers(
         self,
         x: torch.Tensor,
@@ -295,6 +534,12 @@ class DinoVisionTransformer(nn.Module):
             return self.head(ret["x_norm_clstoken"])
 
 
+def _forward_blocks(model: DinoVisionTransformer, x):
+    for blk in model._iter_blocks():
+        x = blk(x)
+    return x
+
+
 def init_weights_vit_timm(module: nn.Module, name: str = ""):
     """ViT weight initialization, original timm impl (for reproducibility)"""
     if isinstance(module, nn.Linear):
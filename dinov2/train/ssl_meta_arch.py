@@ -13,6 +13,7 @@ from torch import nn
 from dinov2.loss import DINOLoss, iBOTPatchLoss, KoLeoLoss
 from dinov2.models import build_model_from_cfg
 from dinov2.layers import DINOHead
+from dinov2.layers.attention import BlockDiagonalMask
 from dinov2.utils.utils import has_batchnorms
 from dinov2.utils.param_groups import get_params_groups_with_decay, fuse_params_groups
 from dinov2.fsdp import get_fsdp_wrapper, ShardedGradScaler, get_fsdp_modules, reshard_fsdp_model
@@ -25,7 +26,6 @@ try:
     XFORMERS_AVAILABLE = True
 except ImportError:
     XFORMERS_AVAILABLE = False
-assert XFORMERS_AVAILABLE, "xFormers is required for DINOv2 training"
 
 
 logger = logging.getLogger("dinov2")
@@ -50,6 +50,10 @@ class SSLMetaArch(nn.Module):
             logger.info(f"OPTIONS -- pretrained weights: loading from {cfg.student.pretrained_weights}")
             student_backbone.load_state_dict(chkpt["model"], strict=False)
 
+        if cfg.student.sequence_packing:
+            logger.info("OPTIONS -- packing the student crops into rows of tokens")
+            student_backbone.set_sequence_packing(row_length=cfg.student.packing_row_length)
+
         self.embed_dim = embed_dim
         self.dino_out_dim = cfg.dino.head_n_prototypes
 
@@ -114,6 +118,7 @@ class SSLMetaArch(nn.Module):
                 logger.info("OPTIONS -- IBOT -- head shared with DINO")
 
         self.need_to_synchronize_fsdp_streams = True
+        self._ema_param_lists = None  # see get_ema_param_lists
 
         self.student = nn.ModuleDict(student_model_dict)
         self.teacher = nn.ModuleDict(teacher_model_dict)
@@ -265,7 +270,8 @@ class SSLMetaArch(nn.Module):
                 ]
 
         # 2: run
-        _attn_bias, cat_inputs = fmha.BlockDiagonalMask.from_tensor_list(inputs_for_student_head_list)
+        mask_class = fmha.BlockDiagonalMask if XFORMERS_AVAILABLE else BlockDiagonalMask
+        _attn_bias, cat_inputs = mask_class.from_tensor_list(inputs_for_student_head_list)
         outputs_list = _attn_bias.split(self.student.dino_head(cat_inputs))
 
         # 3a: local crops cls tokens
@@ -356,16 +362,37 @@ class SSLMetaArch(nn.Module):
             ) = self.student.backbone._streams = self.teacher.backbone._streams
             self.need_to_synchronize_fsdp_streams = False
 
-    def update_teacher(self, m):
-        student_param_list = []
-        teacher_param_list = []
-        with torch.no_grad():
+    def get_ema_param_lists(self):
+        """
+        Aligned lists of the teacher and student parameters updated by the EMA: the flat parameters of their
+        FSDP modules (one contiguous buffer per wrapped module, sharded the same way for both), or the parameters
+        themselves when the models are not wrapped. The FSDP flat parameters are kept for the whole training, so
+        the lists are only collected once.
+        """
+        if self._ema_param_lists is None:
+            student_param_list = []
+            teacher_param_list = []
             for k in self.student.keys():
-                for ms, mt in zip(get_fsdp_modules(self.student[k]), get_fsdp_modules(self.teacher[k])):
+                student_fsdp_modules = get_fsdp_modules(self.student[k])
+                teacher_fsdp_modules = get_fsdp_modules(self.teacher[k])
+                if not student_fsdp_modules:
+                    student_param_list += list(self.student[k].parameters())
+                    teacher_param_list += list(self.teacher[k].parameters())
+                for ms, mt in zip(student_fsdp_modules, teacher_fsdp_modules):
                     student_param_list += ms.params
                     teacher_param_list += mt.params
-            torch._foreach_mul_(teacher_param_list, m)
-            torch._foreach_add_(teacher_param_list, student_param_list, alpha=1 - m)
+            self._ema_param_lists = teacher_param_list, student_param_list
+        return self._ema_param_lists
+
+    def update_teacher(self, m):
+        teacher_param_list, student_param_list = self.get_ema_param_lists()
+        with torch.no_grad():
+            if hasattr(torch, "_foreach_lerp_"):
+                # teacher + (1 - m) * (student - teacher): one multi-tensor kernel and one pass over the weights
+                torch._foreach_lerp_(teacher_param_list, student_param_list, 1 - m)
+            else:
+                torch._foreach_mul_(teacher_param_list, m)
+                torch._foreach_add_(teacher_param_list, student_param_list, alpha=1 - m)
 
     def train(self):
         super().train()
@@ -401,3 +428,4 @@ class SSLMetaArch(nn.Module):
             self.student[k] = get_fsdp_wrapper(student_model_cfg, modules_to_wrap={BlockChunk})(self.student[k])
             teacher_model_cfg = self.cfg.compute_precision.teacher[k]
             self.teacher[k] = get_fsdp_wrapper(teacher_model_cfg, modules_to_wrap={BlockChunk})(self.teacher[k])
+        self._ema_param_lists = None  # the wrapped models have new (flat) parameters
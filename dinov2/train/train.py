@@ -282,6 +282,8 @@ def do_train(cfg, model, resume=False):
         metric_logger.update(last_layer_lr=last_layer_lr)
         metric_logger.update(current_batch_size=current_batch_size)
         metric_logger.update(total_loss=losses_reduced, **loss_dict_reduced)
+        if cfg.student.sequence_packing:
+            metric_logger.update(packing_padding_waste=model.student.backbone.packing_padding_waste)
 
         # checkpointing and testing
 
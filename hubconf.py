@@ -28,6 +28,7 @@ def _make_dinov2_model(
     ffn_layer: str = "mlp",
     block_chunks: int = 0,
     pretrained: bool = True,
+    quantized: bool = False,
     **kwargs,
 ):
     from dinov2.models import vision_transformer as vits
@@ -48,6 +49,11 @@ def _make_dinov2_model(
         state_dict = torch.hub.load_state_dict_from_url(url, map_location="cpu")
         model.load_state_dict(state_dict, strict=False)
 
+    if quantized:  # int8 CPU inference
+        from dinov2.models.quantization import quantize_dynamic_int8
+
+        model = quantize_dynamic_int8(model, inplace=True)
+
     return model
 
 
@@ -0,0 +1,92 @@
+"""
+Latency and peak memory of a MemEffAttention layer with each available attention backend, on dense batches and
+on nested (block-diagonal) multi-crop lists. Outputs are checked against the explicit "math" backend.
+
+    python scripts/benchmark_attention.py --device cuda --dim 1024 --num-heads 16 --tokens 257 1025
+"""
+
+import argparse
+import time
+
+import torch
+
+from dinov2.layers import MemEffAttention, set_attention_backend
+from dinov2.layers.attention import SDPA_AVAILABLE, XFORMERS_AVAILABLE
+from dinov2.layers.block import get_attn_bias_and_cat
+
+
+def available_backends(device):
+    backends = ["math"]
+    if SDPA_AVAILABLE:
+        backends.append("sdpa")
+    if XFORMERS_AVAILABLE and device.type == "cuda":
+        backends.append("xformers")
+    return backends  # "math" first, as the reference
+
+
+def run_attention(attention, inputs):
+    if isinstance(inputs, list):  # nested tensors, as in NestedTensorBlock
+        attn_bias, x = get_attn_bias_and_cat(inputs)
+        return attention(x, attn_bias=attn_bias)
+    return attention(inputs)
+
+
+@torch.no_grad()
+def measure(attention, inputs, device, repeats, warmup=3):
+    for _ in range(warmup):
+        run_attention(attention, inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = run_attention(attention, inputs)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / repeats
+    peak_memory = torch.cuda.max_memory_allocated() / 2**20 if device.type == "cuda" else float("nan")
+    return output, elapsed, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--num-heads", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[257, 1025], help="Sequence lengths (with class token)")
+    parser.add_argument("--nested", type=int, nargs="+", default=[257, 37], help="Sequence lengths of a nested list")
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype) if device.type == "cuda" else torch.float32
+    attention = MemEffAttention(args.dim, num_heads=args.num_heads, qkv_bias=True).to(device, dtype).eval()
+
+    cases = [(f"dense N={n}", torch.randn(args.batch_size, n, args.dim, device=device, dtype=dtype)) for n in args.tokens]
+    cases.append(
+        (
+            f"nested N={'+'.join(map(str, args.nested))}",
+            [torch.randn(args.batch_size, n, args.dim, device=device, dtype=dtype) for n in args.nested],
+        )
+    )
+
+    print(f"{'case':24s} {'backend':10s} {'latency (ms)':>12s} {'peak (MiB)':>11s} {'max |diff|':>11s}")
+    for name, inputs in cases:
+        reference = None
+        for backend in available_backends(device):
+            set_attention_backend(backend)
+            try:
+                output, elapsed, peak_memory = measure(attention, inputs, device, args.repeats)
+            except RuntimeError as e:  # e.g. out of memory with the explicit attention matrix
+                print(f"{name:24s} {backend:10s} failed: {str(e).splitlines()[0]}")
+                continue
+            if reference is None:
+                reference = output.float()
+            diff = (output.float() - reference).abs().max().item()
+            print(f"{name:24s} {backend:10s} {elapsed * 1000:12.2f} {peak_memory:11.1f} {diff:11.2e}")
+
+
+if __name__ == "__main__":
+    main()
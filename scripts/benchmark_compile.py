@@ -0,0 +1,74 @@
+"""
+Eager vs torch.compile (see DinoVisionTransformer.compile) inference throughput of a randomly initialized DINOv2
+backbone, for each batch size and resolution. The compiled outputs are checked against the eager ones, and the
+compilation time of each new input shape is reported separately.
+
+    python scripts/benchmark_compile.py --arch vit_small --device cpu --batch-sizes 1 8 --resolutions 224 448
+"""
+
+import argparse
+import time
+
+import torch
+
+from dinov2.layers import set_attention_backend
+from dinov2.models import vision_transformer as vits
+
+
+@torch.no_grad()
+def measure(model, x, repeats):
+    start = time.perf_counter()
+    output = model.forward_features(x)["x_norm_clstoken"]  # warmup, and compilation for a new shape
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    first_call = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        model.forward_features(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return output, first_call, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--arch", default="vit_small", choices=["vit_small", "vit_base", "vit_large", "vit_giant2"])
+    parser.add_argument("--patch-size", type=int, default=14)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32", choices=["float16", "bfloat16", "float32"])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[224])
+    parser.add_argument("--mode", default=None, help="torch.compile mode, e.g. max-autotune")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--num-threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    set_attention_backend("sdpa")  # xFormers kernels are opaque to torch.compile
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    model = vits.__dict__[args.arch](patch_size=args.patch_size, img_size=518, init_values=1.0, block_chunks=0)
+    model = model.to(device, dtype).eval()
+    compiled_model = vits.__dict__[args.arch](patch_size=args.patch_size, img_size=518, init_values=1.0, block_chunks=0)
+    compiled_model.load_state_dict(model.state_dict())
+    compiled_model = compiled_model.to(device, dtype).eval().compile(mode=args.mode)
+
+    print(
+        f"{'batch':>5s} {'res':>5s} {'eager img/s':>12s} {'compiled img/s':>15s} {'speedup':>8s} "
+        f"{'compile (s)':>12s} {'max |diff|':>11s}"
+    )
+    for resolution in args.resolutions:
+        for batch_size in args.batch_sizes:
+            x = torch.randn(batch_size, 3, resolution, resolution, device=device, dtype=dtype)
+            reference, _, eager_time = measure(model, x, args.repeats)
+            output, compile_time, compiled_time = measure(compiled_model, x, args.repeats)
+            diff = (output.float() - reference.float()).abs().max().item()
+            print(
+                f"{batch_size:5d} {resolution:5d} {batch_size / eager_time:12.1f} {batch_size / compiled_time:15.1f} "
+                f"{eager_time / compiled_time:8.2f} {compile_time:12.1f} {diff:11.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
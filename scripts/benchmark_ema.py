@@ -0,0 +1,84 @@
+"""
+Time per step of the teacher EMA update (see SSLMetaArch.update_teacher) for a DINOv2 backbone, with:
+- "per-tensor": a mul_ / add_ pair for every parameter
+- "foreach": torch._foreach_mul_ + torch._foreach_add_ over the parameter lists
+- "foreach-lerp": one torch._foreach_lerp_ over the parameter lists
+- "flat-lerp": one torch._foreach_lerp_ over one flat buffer per block (as the FSDP flat parameters)
+
+    python scripts/benchmark_ema.py --arch vit_giant2 --device cuda
+"""
+
+import argparse
+import time
+
+import torch
+
+from dinov2.models import vision_transformer as vits
+
+
+def flat_buffers(model):
+    # one contiguous buffer per block and one for the remaining parameters, as with FSDP wrapping each block
+    groups = [list(blk.parameters()) for blk in model.blocks]
+    block_params = {p for group in groups for p in group}
+    groups.append([p for p in model.parameters() if p not in block_params])
+    return [torch.cat([p.detach().flatten() for p in group]) for group in groups]
+
+
+def per_tensor(teacher_params, student_params, m):
+    for pt, ps in zip(teacher_params, student_params):
+        pt.mul_(m).add_(ps, alpha=1 - m)
+
+
+def foreach(teacher_params, student_params, m):
+    torch._foreach_mul_(teacher_params, m)
+    torch._foreach_add_(teacher_params, student_params, alpha=1 - m)
+
+
+def foreach_lerp(teacher_params, student_params, m):
+    torch._foreach_lerp_(teacher_params, student_params, 1 - m)
+
+
+@torch.no_grad()
+def measure(update, teacher_params, student_params, device, repeats, m=0.996):
+    update(teacher_params, student_params, m)  # warmup
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        update(teacher_params, student_params, m)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--arch", default="vit_large", choices=["vit_small", "vit_base", "vit_large", "vit_giant2"])
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    student = vits.__dict__[args.arch](patch_size=14, init_values=1.0, block_chunks=0).to(device)
+    teacher = vits.__dict__[args.arch](patch_size=14, init_values=1.0, block_chunks=0).to(device)
+    teacher.load_state_dict(student.state_dict())
+    teacher_params = [p.detach() for p in teacher.parameters()]
+    student_params = [p.detach() for p in student.parameters()]
+    teacher_flat, student_flat = flat_buffers(teacher), flat_buffers(student)
+    num_params = sum(p.numel() for p in student_params)
+    print(f"{args.arch}: {len(student_params)} tensors, {num_params / 1e6:.1f}M params, {len(student_flat)} buffers")
+
+    modes = [
+        ("per-tensor", per_tensor, teacher_params, student_params),
+        ("foreach", foreach, teacher_params, student_params),
+    ]
+    if hasattr(torch, "_foreach_lerp_"):
+        modes.append(("foreach-lerp", foreach_lerp, teacher_params, student_params))
+        modes.append(("flat-lerp", foreach_lerp, teacher_flat, student_flat))
+    print(f"{'mode':14s} {'ms / step':>10s}")
+    for name, update, t, s in modes:
+        print(f"{name:14s} {measure(update, t, s, device, args.repeats) * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
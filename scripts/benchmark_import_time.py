@@ -0,0 +1,76 @@
+"""
+Import time of the eval modules, each measured in fresh interpreters. Fails (exit code 1) if one of them
+imports a heavy optional dependency (transformers, open_clip, peft) at module import, or is slower than
+--max-seconds.
+
+    python scripts/benchmark_import_time.py --repeats 5 --max-seconds 10
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+MODULES = [
+    "dinov2.eval.utils",
+    "dinov2.eval.setup",
+    "dinov2.eval.classification.knn",
+    "dinov2.eval.classification.linear",
+    "dinov2.eval.segmentation.segmentation",
+]
+LAZY_DEPENDENCIES = ["transformers", "open_clip", "peft"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = [name for name in {lazy!r} if name in sys.modules]
+print(json.dumps({{"seconds": elapsed, "loaded": loaded}}))
+"""
+
+
+def measure(module, repeats):
+    times, loaded = [], []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(module=module, lazy=LAZY_DEPENDENCIES)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result["seconds"])
+        loaded = result["loaded"]
+    return statistics.median(times), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-seconds", type=float, default=None, help="Maximum median import time of a module")
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        try:
+            seconds, loaded = measure(module, args.repeats)
+        except subprocess.CalledProcessError as e:
+            print(f"{module:45s} import failed:\n{e.stderr}")
+            failures.append(module)
+            continue
+        print(f"{module:45s} {seconds:6.2f}s  eager optional imports: {', '.join(loaded) or '-'}")
+        if loaded or (args.max_seconds is not None and seconds > args.max_seconds):
+            failures.append(module)
+
+    if failures:
+        print(f"Import time regressions: {', '.join(failures)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+"""
+Accuracy vs throughput of token merging (see DinoVisionTransformer.set_token_merging) on a classification
+dataset: for each merge ratio, the normalized class token features of the train and val sets are extracted and
+the val set is classified with a weighted k-NN on the train features (top-1 accuracy), or with the ML-kNN of the
+multilabel k-NN evaluation on multilabel datasets such as NIHChestXray (macro AUROC).
+
+    python scripts/benchmark_token_merging.py --config-file <config> --pretrained-weights <teacher_checkpoint.pth> \
+        --output-dir <dir> --train-dataset <train> --val-dataset <val> --ratios 0 0.05 0.1 0.2
+"""
+
+from functools import partial
+import sys
+import time
+
+import torch
+
+from dinov2.data import make_dataset
+from dinov2.data.transforms import make_classification_eval_transform
+from dinov2.eval.classification import mlknn
+from dinov2.eval.metrics import MetricType
+from dinov2.eval.setup import get_args_parser as get_setup_args_parser
+from dinov2.eval.setup import setup_and_build_model
+from dinov2.eval.utils import ModelWithNormalize, extract_features
+
+
+def get_args_parser():
+    parser = get_setup_args_parser(description="DINOv2 token merging benchmark")
+    parser.add_argument("--train-dataset", dest="train_dataset_str", type=str, required=True)
+    parser.add_argument("--val-dataset", dest="val_dataset_str", type=str, required=True)
+    parser.add_argument("--ratios", type=float, nargs="+", default=[0.0, 0.05, 0.1, 0.2])
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--nb-knn", type=int, default=20)
+    parser.add_argument("--temperature", type=float, default=0.07)
+    parser.add_argument("--backbone", type=str, default="dinov2")
+    return parser
+
+
+@torch.no_grad()
+def knn_accuracy(train_features, train_labels, val_features, val_labels, k, temperature, batch_size=1024):
+    num_classes = int(train_labels.max()) + 1
+    correct = 0
+    for i in range(0, val_features.shape[0], batch_size):
+        sims, indices = (val_features[i : i + batch_size] @ train_features.T).topk(k, dim=1)
+        votes = torch.zeros(sims.shape[0], num_classes, device=sims.device)
+        votes.scatter_add_(1, train_labels[indices], (sims / temperature).exp())
+        correct += (votes.argmax(dim=1) == val_labels[i : i + batch_size]).sum().item()
+    return correct / val_features.shape[0]
+
+
+def mlknn_auroc(train_features, train_labels, val_features, val_labels, k, class_names):
+    results = mlknn.eval_knn_on_features(
+        train_features=train_features,
+        train_labels=train_labels,
+        test_features=val_features,
+        test_labels=val_labels,
+        labels=list(class_names),
+        num_classes=train_labels.shape[1],
+        nb_knn=[k],
+        metric_type=MetricType.MULTILABEL_AUROC,
+    )
+    return results[f"{k}"]["auroc"]
+
+
+def main(args):
+    model, _ = setup_and_build_model(args)
+    transform = make_classification_eval_transform()
+    train_dataset = make_dataset(dataset_str=args.train_dataset_str, transform=transform)
+    val_dataset = make_dataset(dataset_str=args.val_dataset_str, transform=transform)
+    feature_model = ModelWithNormalize(model)
+    is_multilabel = val_dataset.is_multilabel()
+
+    print(f"{'ratio':>6s} {'images/s':>10s} {'auroc' if is_multilabel else 'top-1':>7s}")
+    for ratio in args.ratios:
+        model.set_token_merging(ratio or None)
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.cuda.amp.autocast(dtype=torch.half):
+            extract = partial(extract_features, feature_model, batch_size=args.batch_size, num_workers=args.num_workers)
+            train_features, train_labels = extract(train_dataset)
+            val_features, val_labels = extract(val_dataset)
+        torch.cuda.synchronize()
+        throughput = (len(train_dataset) + len(val_dataset)) / (time.perf_counter() - start)
+        if is_multilabel:
+            score = mlknn_auroc(
+                train_features, train_labels, val_features, val_labels, args.nb_knn, val_dataset.class_names
+            )
+        else:
+            score = knn_accuracy(
+                train_features, train_labels.long(), val_features, val_labels.long(), args.nb_knn, args.temperature
+            )
+        print(f"{ratio:6.2f} {throughput:10.1f} {score:7.4f}")
+    return 0
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    sys.exit(main(args))
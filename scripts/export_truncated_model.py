@@ -0,0 +1,44 @@
+"""
+Exports the first --truncate-depth blocks of a pretrained DINOv2 backbone (without its head) as a smaller
+checkpoint. The checkpoint is loaded like the full one, with the same --truncate-depth:
+
+    python scripts/export_truncated_model.py --config-file <config> --pretrained-weights <teacher_checkpoint.pth> \
+        --truncate-depth 12 --output-dir <dir>
+    python dinov2/run/eval/linear.py --config-file <config> --pretrained-weights <dir>/truncated_12.pth \
+        --truncate-depth 12 ...
+"""
+
+import os
+import sys
+
+import torch
+
+from dinov2.eval.setup import get_args_parser
+from dinov2.models import build_model_from_cfg
+from dinov2.utils.config import get_cfg_from_args
+import dinov2.utils.utils as dinov2_utils
+
+
+def main(args):
+    assert args.truncate_depth is not None, "--truncate-depth is required"
+    config = get_cfg_from_args(args)
+    model, _ = build_model_from_cfg(config, only_teacher=True)
+    dinov2_utils.load_pretrained_weights(model, args.pretrained_weights, "teacher")
+    num_blocks, num_params = model.n_blocks, sum(p.numel() for p in model.parameters())
+
+    model = model.truncated(args.truncate_depth)
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"truncated_{args.truncate_depth}.pth")
+    torch.save({"teacher": model.state_dict()}, output_path)
+    print(
+        f"Saved {args.truncate_depth} / {num_blocks} blocks to {output_path}: "
+        f"{sum(p.numel() for p in model.parameters()) / 1e6:.1f}M / {num_params / 1e6:.1f}M parameters"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    description = "DINOv2 truncated backbone export"
+    args_parser = get_args_parser(description=description)
+    args = args_parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,93 @@
+import pytest
+import torch
+
+from dinov2.layers import get_attention_backend, set_attention_backend
+from dinov2.layers.attention import SDPA_AVAILABLE
+from dinov2.layers.packing import SequencePacker
+from dinov2.models.vision_transformer import vit_small
+
+
+BACKENDS = ["math", "sdpa"] if SDPA_AVAILABLE else ["math"]
+
+
+def make_inputs(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    global_crops = torch.randn(4, 3, 224, 224, generator=generator)
+    local_crops = torch.randn(16, 3, 98, 98, generator=generator)
+    masks = torch.rand(4, 256, generator=generator) > 0.7
+    return [global_crops, local_crops], [masks, None]
+
+
+def make_model(block_chunks):
+    torch.manual_seed(0)
+    return vit_small(patch_size=14, img_size=224, block_chunks=block_chunks, init_values=1e-5, drop_path_rate=0.0)
+
+
+@pytest.fixture(autouse=True)
+def restore_attention_backend():
+    backend = get_attention_backend()
+    yield
+    set_attention_backend(backend)
+
+
+def test_padding_waste():
+    # 16 x 16 global crops fill a row of 257 tokens, 7 x 7 local crops go five to a row (250 tokens)
+    packer = SequencePacker([(4, 257), (16, 50)])
+    assert packer.row_length == 257
+    assert packer.num_rows == 4 + 4
+    assert packer.padding_waste == pytest.approx(1 - (4 * 257 + 16 * 50) / (8 * 257))
+
+    packer = SequencePacker([(2, 10), (3, 5)], row_length=10)
+    assert packer.num_rows == 4
+    assert packer.padding_waste == pytest.approx(1 - 35 / 40)
+
+
+def test_pack_unpack_roundtrip():
+    packer = SequencePacker([(3, 7), (5, 3)], row_length=8)
+    x_list = [torch.randn(3, 7, 4), torch.randn(5, 3, 4)]
+    for x, y in zip(x_list, packer.unpack(packer.pack(x_list))):
+        assert torch.equal(x, y)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+@pytest.mark.parametrize("block_chunks", [0, 2])
+def test_packed_matches_forward_features_list_eval(backend, block_chunks):
+    set_attention_backend(backend)
+    model = make_model(block_chunks).eval()
+    x_list, masks_list = make_inputs()
+    with torch.no_grad():
+        reference = model.forward_features(x_list, masks_list)
+        model.set_sequence_packing(True)
+        outputs = model.forward_features(x_list, masks_list)
+
+    assert model.packing_padding_waste == pytest.approx(1 - (4 * 257 + 16 * 50) / (8 * 257))
+    for ref, out in zip(reference, outputs):
+        for key in ("x_norm_clstoken", "x_norm_patchtokens", "x_prenorm"):
+            torch.testing.assert_close(out[key], ref[key], atol=2e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_packed_matches_forward_features_list_train(backend):
+    set_attention_backend(backend)
+    x_list, masks_list = make_inputs()
+    gradients = []
+    for packing in (False, True):
+        model = make_model(block_chunks=0).train().set_sequence_packing(packing)
+        outputs = model.forward_features(x_list, masks_list)
+        loss = sum(out["x_norm_clstoken"].square().mean() + out["x_norm_patchtokens"].mean() for out in outputs)
+        loss.backward()
+        gradients.append({name: p.grad.clone() for name, p in model.named_parameters() if p.grad is not None})
+
+    reference, packed = gradients
+    assert reference.keys() == packed.keys()
+    for name in reference:
+        torch.testing.assert_close(packed[name], reference[name], atol=1e-5, rtol=1e-3, msg=name)
+
+
+def test_packed_train_with_stochastic_depth_runs():
+    model = vit_small(patch_size=14, img_size=224, block_chunks=0, init_values=1e-5, drop_path_rate=0.3)
+    model.train().set_sequence_packing(True)
+    x_list, masks_list = make_inputs()
+    outputs = model.forward_features(x_list, masks_list)
+    sum(out["x_norm_clstoken"].sum() for out in outputs).backward()
+    assert model.pos_embed.grad is not None and torch.isfinite(model.pos_embed.grad).all()